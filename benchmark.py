@@ -0,0 +1,147 @@
+"""
+Measures migrator throughput on one machine, with no services: builds a synthetic legacy tree in a temporary
+data_dir, and an embedded SQLite database (see src/storage) with posts and Discord messages referencing it,
+migrates it the way `sdkdd.py apply` does, and checks nothing still points at the legacy tree.
+Needs a config.py like sdkdd.py does; data_dir, storage and dry_run are overridden for the run.
+
+    python benchmark.py --files 2000 --posts 50000 --processes 4
+"""
+import datetime
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import click
+import config
+
+from src.async_engine import migrate_async
+from src.mover import prepare_shard_tree
+from src.results import ResultLog
+from src.scheduler import LaneScheduler
+from src.storage import SQLiteStorage, open_storage
+from src.worker import init_worker
+
+# legacy layout -> share of the files
+LAYOUTS = {'files': 0.4, 'attachments': 0.3, 'discord': 0.1, 'inline': 0.2}
+
+
+def write_file(root: str, web_path: str, size: int):
+    path = os.path.join(root, web_path.lstrip('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def build(root: str, storage: SQLiteStorage, files: int, posts: int, size: int, keyed: bool):
+    """Writes `files` legacy files and their owners, plus `posts` posts that don't reference any. Returns the work to migrate."""
+    random.seed(files)
+    now = datetime.datetime.now()
+    work = []
+    layouts = random.choices(list(LAYOUTS), weights=list(LAYOUTS.values()), k=files)
+    for (i, layout) in enumerate(layouts):
+        (user_id, post_id) = (str(random.randrange(1000)), str(100000 + i))
+        if layout == 'discord':
+            (server_id, channel_id) = (str(random.randrange(10)), str(random.randrange(100)))
+            web_path = f'/attachments/{server_id}/{channel_id}/{post_id}/{i}.png'
+            path = write_file(root, web_path, size)
+            storage.add_discord_message(server_id, channel_id, post_id, now, attachments=[{'name': f'{i}.png', 'path': web_path}])
+            owner = {'_server_id': server_id, '_channel_id': channel_id, '_message_id': post_id}
+            work.append(('attachments', path, owner if keyed else {}))
+            continue
+        if layout == 'files':
+            web_path = f'/files/{user_id}/{post_id}/{i}.png'
+            path = write_file(root, web_path, size)
+            storage.add_post('patreon', user_id, post_id, now, file={'name': f'{i}.png', 'path': web_path})
+        elif layout == 'attachments':
+            web_path = f'/attachments/{user_id}/{post_id}/{i}.png'
+            path = write_file(root, web_path, size)
+            storage.add_post('patreon', user_id, post_id, now, attachments=[{'name': f'{i}.png', 'path': web_path}])
+        else:
+            web_path = f'/inline/{i}.png'
+            path = write_file(root, web_path, size)
+            # (found by the time it was added, right after the file was written)
+            added = datetime.datetime.fromtimestamp(os.stat(path).st_mtime) + datetime.timedelta(seconds=30)
+            storage.add_post('patreon', user_id, post_id, added, content=f'<p><img src="{web_path}"></p>')
+        work.append((layout, path, {'_service': 'patreon', '_user_id': user_id, '_post_id': post_id} if keyed else {}))
+    for i in range(posts):
+        file_hash = '%064x' % random.getrandbits(256)
+        added = now - datetime.timedelta(seconds=random.randrange(365 * 24 * 3600))
+        storage.add_post(
+            'fanbox', str(random.randrange(1000)), str(i), added,
+            content='<p>nothing to see here</p>', file={'name': 'x.png', 'path': f'/{file_hash[0:2]}/{file_hash[2:4]}/{file_hash}.png'}
+        )
+    storage.commit()
+    random.shuffle(work)
+    return work
+
+
+def count_legacy_references(storage: SQLiteStorage):
+    """The posts and messages still pointing at a legacy tree."""
+    (posts,) = storage.conn.execute('''
+        SELECT count(*) FROM posts
+        WHERE json_extract(file, '$.path') LIKE '/files/%' OR attachments LIKE '%"/attachments/%' OR content LIKE '%/inline/%'
+    ''').fetchone()
+    (messages,) = storage.conn.execute('''SELECT count(*) FROM discord_posts WHERE attachments LIKE '%"/attachments/%' ''').fetchone()
+    return posts + messages
+
+
+@click.command()
+@click.option('--files', default=1000, help='legacy files to migrate')
+@click.option('--posts', default=10000, help='extra posts referencing none of them, for the lookups to get through')
+@click.option('--size-kb', default=64, help='size of every file')
+@click.option('--processes', default=multiprocessing.cpu_count(), help='migration workers')
+@click.option('--engine', type=click.Choice(['processes', 'asyncio']), default='processes')
+@click.option('--keyed', is_flag=True, help="give the migrators each file's owner, like `sql_file` and --from-tsv do")
+@click.option('--keep', is_flag=True, help='keep the data_dir and database around afterwards')
+def benchmark(files, posts, size_kb, processes, engine, keyed, keep):
+    root = tempfile.mkdtemp(prefix='sdkdd_benchmark_')
+    config.data_dir = root
+    config.storage = f"sqlite:{os.path.join(root, 'benchmark.db')}"
+    config.dry_run = False
+    config.ban_url = None
+    config.sql_file = None
+    try:
+        click.echo(f'Building {files} files and {files + posts} posts in {root}...')
+        storage = open_storage()
+        work = build(root, storage, files, posts, size_kb * 1024, keyed)
+        migration_id = int(time.time())
+        storage.create_migration_log(migration_id)
+        storage.commit()
+        storage.close()
+        prepare_shard_tree(root)
+
+        # forked, so the workers get the config set up above (a forkserver would import config.py afresh)
+        context = multiprocessing.get_context('fork')
+        result_log = ResultLog(migration_id, context)
+        result_log.start()
+        started = time.monotonic()
+        if engine == 'asyncio':
+            init_worker(None, result_log.queue, measure_startup=False)
+            migrate_async(work, migration_id)
+        else:
+            with context.Pool(processes, initializer=init_worker, initargs=(None, result_log.queue)) as pool:
+                LaneScheduler(pool, processes, migration_id).run(work)
+                pool.close()
+                pool.join()
+        elapsed = time.monotonic() - started
+        result_log.stop()
+
+        storage = open_storage()
+        (migrated,) = storage.conn.execute(f'SELECT count(*) FROM sdkdd_migration_{migration_id}').fetchone()
+        leftovers = count_legacy_references(storage)
+        storage.close()
+        click.echo(f'{migrated}/{files} files migrated in {elapsed:.2f}s: {migrated / elapsed:.1f} files/s, {migrated * size_kb / 1024 / elapsed:.1f} MiB/s.')
+        click.echo(f'{leftovers} posts/messages still reference the legacy trees.')
+    finally:
+        if keep:
+            click.echo(f'Kept {root}.')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -12,8 +12,10 @@ conn = psycopg2.connect(
     port = 5432,
     cursor_factory=RealDictCursor
 )
-cursor = conn.cursor()
-cursor.execute("SELECT * FROM discord_posts")
+# stream the table from a server-side cursor instead of loading all of it into memory first
+cursor = conn.cursor('sdkdd_dump')
+cursor.itersize = getattr(config, 'scan_itersize', 2000)
+cursor.execute('SELECT server, channel, id, attachments FROM discord_posts')
 
 sys.stdout.write('\t'.join(['discord_server_id', 'discord_channel_id', 'discord_message_id', 'file_path']) + '\n')
 
@@ -12,8 +12,10 @@ conn = psycopg2.connect(
     port = 5432,
     cursor_factory=RealDictCursor
 )
-cursor = conn.cursor()
-cursor.execute("SELECT * FROM posts")
+# stream the table from a server-side cursor instead of loading all of it into memory first
+cursor = conn.cursor('sdkdd_dump')
+cursor.itersize = getattr(config, 'scan_itersize', 2000)
+cursor.execute('SELECT service, "user", id, file, attachments, content FROM posts')
 
 sys.stdout.write('\t'.join(['service', 'user_id', 'post_id', 'file_path']) + '\n')
 
@@ -28,7 +30,7 @@ for post in cursor:
             sys.stdout.write('\t'.join([post['service'], post['user'], post['id'], attachment_path]) + '\n')
     
     for inline in BeautifulSoup(post['content'], 'html.parser').select('img[src^="https://kemono.party/"]'):
-        inline_path = image['src'].replace('https://kemono.party', '')
+        inline_path = inline['src'].replace('https://kemono.party', '')
         sys.stdout.write('\t'.join([post['service'], post['user'], post['id'], inline_path]) + '\n')
 
     for inline in BeautifulSoup(post['content'], 'html.parser').select('img[src^="/"]'):
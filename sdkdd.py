@@ -3,157 +3,263 @@ import config
 import os
 import time
 import click
-import psycopg2
-import sqlite3
 from click_default_group import DefaultGroup
 
-from src.utils import remove_prefix
-from src.migrators.files import migrate_file
-from src.migrators.attachments import migrate_attachment
-from src.migrators.inline import migrate_inline
-
-def scan_files_for_apply(pool, migration_id, dir = os.path.join(config.data_dir, 'files')):
-    if not os.path.exists(os.path.join(config.data_dir, 'files')):
-        print('"files" directory is missing, and will be skipped.')
-        return
-    
-    with os.scandir(dir) as it:
-        for entry in it:
-            if entry.is_file():
-                pool.apply_async(migrate_file, args=(entry.path, migration_id))
-            else:
-                scan_files_for_apply(pool, migration_id, dir = entry.path)
-
-def scan_attachments_for_apply(pool, migration_id, dir = os.path.join(config.data_dir, 'attachments')):
-    if not os.path.exists(os.path.join(config.data_dir, 'attachments')):
-        print('"attachments" directory is missing, and will be skipped.')
-        return
-    
-    with os.scandir(dir) as it:
-        for entry in it:
-            if entry.is_file():
-                pool.apply_async(migrate_attachment, args=(entry.path, migration_id))
-            else:
-                scan_attachments_for_apply(pool, migration_id, dir = entry.path)
-
-def scan_inline_for_apply(pool, migration_id, dir = os.path.join(config.data_dir, 'inline')):
-    if not os.path.exists(os.path.join(config.data_dir, 'inline')):
-        print('"inline" directory is missing, and will be skipped.')
-        return
-    
-    with os.scandir(dir) as it:
-        for entry in it:
-            if entry.is_file():
-                pool.apply_async(migrate_inline, args=(entry.path, migration_id))
-            else:
-                scan_inline_for_apply(pool, migration_id, dir = entry.path)
+from src import instrument
+from src.async_engine import migrate_async
+from src.census import census as take_census
+from src.manifest import is_manifest, migrate_manifest, write_manifest
+from src.known_hashes import write_known_hashes
+from src.mover import prepare_shard_tree
+from src.profiler import merge as merge_profiles
+from src.planner import iter_planned_work, plan as plan_migration
+from src.results import ResultLog
+from src.reclaim import ACTIONS as RECLAIM_ACTIONS, reclaim as reclaim_leftovers
+from src.throttle import Controller, create_limiter
+from src.thumbnails import get_thumb_dir, index_thumbnails, migrate_thumbnails
+from src.scanner import MIGRATORS, iter_tsv_work, iter_work
+from src.scheduler import LaneScheduler
+from src.sweep import sweep as sweep_references
+from src.verifier import verify as verify_hash_tree
+from src.storage import open_storage
+from src.utils import get_connection
+from src.watcher import watch as watch_legacy_trees
+from src.work_queue import enqueue as enqueue_work, work_in_parallel
+from src.worker import get_context, init_worker
 
 @click.group(cls=DefaultGroup, default='apply', default_if_no_args=True)
 def cli():
     pass
 
-@cli.command()
-def apply():
-    timestamp = int(time.time())
+def prepare_migration(timestamp):
     if (not config.dry_run):
-        conn = psycopg2.connect(
-            host = config.database_host,
-            dbname = config.database_dbname,
-            user = config.database_user,
-            password = config.database_password,
-            port = 5432
-        )
-        cursor = conn.cursor()
-        cursor.execute(
-            f"""
-                CREATE TABLE sdkdd_migration_{timestamp} (
-                    "old_location" text NOT NULL,
-                    "new_location" text NOT NULL,
-                    "ctime" timestamp NOT NULL,
-                    "mtime" timestamp NOT NULL
-                );
-            """
-        )
-        conn.commit()
-        conn.close()
+        storage = open_storage()
+        storage.create_migration_log(timestamp)
+        storage.commit()
+        storage.close()
+
+        # create the whole `ab/cd` tree once, instead of a `makedirs` for every migrated file
+        for root in (config.data_dir, get_thumb_dir()):
+            if os.path.isdir(root) and prepare_shard_tree(root):
+                print(f'Created hash shard directories in {root}.')
     else:
         print('(You are running `sdkdd` dry. Nothing will actually be updated/moved. Feel free to exit anytime.)\n')
-    
-    with multiprocessing.Pool(config.processes or multiprocessing.cpu_count()) as pool:
-        if not config.sql_file:
-            if (config.scan_files):
-                scan_files_for_apply(pool, timestamp)
-            if (config.scan_attachments):
-                scan_attachments_for_apply(pool, timestamp)
-            if (config.scan_inline):
-                scan_inline_for_apply(pool, timestamp)
-        else:
-            if config.discord_sql:
-                sqlite_conn = sqlite3.connect(config.sql_file)
-                messages_to_fix = sqlite_conn.execute('''
-                    SELECT
-                        discord_posts_dump.discord_server_id,
-                        discord_posts_dump.discord_channel_id,
-                        discord_posts_dump.discord_message_id,
-                        discord_posts_dump.file_path
-                    FROM discord_posts_dump, hashdeep_to_migrate
-                    WHERE
-                        discord_posts_dump.file_path = hashdeep_to_migrate.path
-                        AND discord_posts_dump.file_path not in (
-                          SELECT a.file_path
-                          FROM discord_posts_dump a, migration_log b
-                          WHERE b.migration_original_path = a.file_path
-                        )
-                ''')
-                for (message_server, message_channel, message_id, file_location) in messages_to_fix:
-                    absolute_file_location = os.path.join(config.data_dir, remove_prefix(file_location, '/'))
-                    if file_location.startswith('/attachments/') and config.scan_attachments:
-                        pool.apply_async(migrate_attachment, args=(absolute_file_location, timestamp), kwds={
-                            '_server_id': message_server,
-                            '_channel_id': message_channel,
-                            '_message_id': message_id
-                        })
-            else:
-                posts_to_fix = sqlite_conn.execute('''
-                    SELECT
-                        posts_dump.service,
-                        posts_dump.user_id,
-                        posts_dump.post_id,
-                        posts_dump.file_path
-                    FROM posts_dump, hashdeep_to_migrate
-                    WHERE
-                        posts_dump.file_path = hashdeep_to_migrate.path
-                        AND posts_dump.file_path not in (
-                          SELECT a.file_path
-                          FROM posts_dump a, migration_log b
-                          WHERE b.migration_original_path = a.file_path
-                        )
-                ''')
-                for (post_service, post_user_id, post_id, file_location) in posts_to_fix:
-                    absolute_file_location = os.path.join(config.data_dir, remove_prefix(file_location, '/'))
-                    
-                    if file_location.startswith('/files/') and config.scan_files:
-                        pool.apply_async(migrate_file, args=(absolute_file_location, timestamp), kwds={
-                            '_service': post_service,
-                            '_user_id': post_user_id,
-                            '_post_id': post_id
-                        })
-                    elif file_location.startswith('/attachments/') and config.scan_attachments:
-                        pool.apply_async(migrate_attachment, args=(absolute_file_location, timestamp), kwds={
-                            '_service': post_service,
-                            '_user_id': post_user_id,
-                            '_post_id': post_id
-                        })
-                    elif file_location.startswith('/inline/') and config.scan_inline:
-                        pool.apply_async(migrate_inline, args=(absolute_file_location, timestamp), kwds={
-                            '_service': post_service,
-                            '_user_id': post_user_id,
-                            '_post_id': post_id
-                        })
 
+def preload_known_hashes(timestamp):
+    """Writes the hashes already in the file tracking table and the hash tree to sdkdd_known_hashes_<timestamp>.bin, for the workers."""
+    known_hashes_file = f'sdkdd_known_hashes_{timestamp}.bin'
+    click.echo('Preloading known hashes...')
+    storage = open_storage()
+    try:
+        (hashes, files) = write_known_hashes(known_hashes_file, storage, config.data_dir)
+    finally:
+        storage.close()
+    click.echo(f'{hashes} hashes in the file tracking table, {files} files in the hash tree.')
+    return known_hashes_file
+
+def wants_known_hashes(tsv_file, resumed):
+    """`preload_known_hashes`, which by default is only worth it on full runs (not --from-tsv, nor a resumed --manifest)."""
+    preload = getattr(config, 'preload_known_hashes', None)
+    if preload is None:
+        preload = not (tsv_file or resumed)
+    return preload and not config.dry_run
+
+def iter_source(plan_file, tsv_file):
+    """The work to migrate: a plan, `dumper.py`/`discord_dumper.py` output, or a scan of the legacy trees."""
+    if plan_file:
+        return iter_planned_work(plan_file)
+    if tsv_file:
+        return iter_tsv_work(tsv_file)
+    return iter_work()
+
+def run_engine(engine, work, manifest_file, timestamp, processes, context, worker_args):
+    """Migrates `work` (or the manifest) on the chosen engine, `worker_args` being what `init_worker` gets."""
+    if engine == 'asyncio':
+        init_worker(*worker_args, measure_startup=False)
+        migrate_async(work, timestamp)
+        return
+    with context.Pool(processes, initializer=init_worker, initargs=worker_args, maxtasksperchild=getattr(config, 'worker_max_tasks', None)) as pool:
+        if manifest_file:
+            migrate_manifest(pool, manifest_file, timestamp)
+        else:
+            LaneScheduler(pool, processes, timestamp).run(work)
         pool.close()
         pool.join()
 
+def start_logging(limiter, timestamp, context):
+    """Starts the throttle controller (if throttling) and the result log. Returns `(controller, result_log)`."""
+    controller = None
+    if limiter:
+        controller = Controller(limiter)
+        controller.start()
+    result_log = ResultLog(timestamp, context)
+    result_log.start()
+    return (controller, result_log)
+
+def stop_logging(controller, result_log):
+    """Stops what `start_logging` started, flushing the last results. Also called when the run failed, so nothing is left running."""
+    if controller:
+        controller.stop()
+    result_log.stop()
+
+def start_reports(timestamp, profile):
+    """Snapshots the database's statement stats (when instrumenting) and creates the profile directory (with --profile)."""
+    stats = None
+    if instrument.enabled():
+        stats_conn = get_connection()
+        stats = (stats_conn, instrument.snapshot_statements(stats_conn))
+    profile_dir = None
+    if profile:
+        profile_dir = f'sdkdd_profile_{timestamp}'
+        os.makedirs(profile_dir, exist_ok=True)
+    return (stats, profile_dir)
+
+def finish_reports(timestamp, result_log, stats, profile_dir):
+    """Writes the query report and merges the workers' profiles, for what `start_reports` started."""
+    if stats:
+        (stats_conn, statements_before) = stats
+        instrument.write_report(
+            f'sdkdd_queries_{timestamp}.txt',
+            instrument.merge_stats(result_log.query_stats),
+            statements_before,
+            instrument.snapshot_statements(stats_conn)
+        )
+        stats_conn.close()
+        print(f'Query report written to sdkdd_queries_{timestamp}.txt.')
+    if profile_dir:
+        merge_profiles(profile_dir, profile_dir)
+
+@cli.command()
+@click.option('--plan', 'plan_file', default=None, help='execute a plan written by `sdkdd.py plan` instead of scanning')
+@click.option('--from-tsv', 'tsv_file', type=click.File('r'), default=None, help='migrate the files in `dumper.py`/`discord_dumper.py` output as it is read (`-` for stdin) instead of scanning')
+@click.option('--profile', is_flag=True, help='profile every worker, and write the merged profile to sdkdd_profile_<epoch time>.*')
+@click.option('--engine', type=click.Choice(['processes', 'asyncio']), default='processes', help='a pool of `processes` workers, or many migrations at once in this process (see the `async_*` options)')
+@click.option('--manifest', 'manifest_file', default=None, help='scan into this manifest first (or resume from it if it exists), and migrate from it')
+def apply(plan_file, tsv_file, profile, engine, manifest_file):
+    if (len([option for option in (plan_file, tsv_file, manifest_file) if option]) > 1):
+        raise click.UsageError('Only one of --plan, --from-tsv and --manifest can be used at a time.')
+    if (profile and engine == 'asyncio'):
+        raise click.UsageError('--profile only works with the processes engine.')
+    if (manifest_file and (engine == 'asyncio' or config.sql_file)):
+        raise click.UsageError('--manifest only works with the processes engine, when scanning (no `sql_file`).')
+    resumed = manifest_file and is_manifest(manifest_file)
+    if (manifest_file and not resumed):
+        click.echo(f'Scanning into {manifest_file}...')
+        click.echo(f'{write_manifest(manifest_file, iter_work())} files to migrate.')
+    timestamp = int(time.time())
+    prepare_migration(timestamp)
+    known_hashes_file = preload_known_hashes(timestamp) if wants_known_hashes(tsv_file, resumed) else None
+    try:
+        processes = config.processes or multiprocessing.cpu_count()
+        context = get_context()
+        limiter = create_limiter(processes, context)
+        (controller, result_log) = start_logging(limiter, timestamp, context)
+        try:
+            (stats, profile_dir) = start_reports(timestamp, profile)
+            worker_args = (limiter, result_log.queue, profile_dir, known_hashes_file)
+            run_engine(engine, iter_source(plan_file, tsv_file), manifest_file, timestamp, processes, context, worker_args)
+        finally:
+            stop_logging(controller, result_log)
+        finish_reports(timestamp, result_log, stats, profile_dir)
+    finally:
+        if known_hashes_file:
+            os.remove(known_hashes_file)
+
+    if (not config.dry_run):
+        migrate_thumbnails(timestamp)
+
+@cli.command()
+def watch():
+    """Migrates files as they are written to the legacy trees (by Kitsune instances that haven't upgraded), until stopped."""
+    timestamp = int(time.time())
+    prepare_migration(timestamp)
+    processes = config.processes or multiprocessing.cpu_count()
+    context = get_context()
+    limiter = create_limiter(processes, context)
+    (controller, result_log) = start_logging(limiter, timestamp, context)
+    try:
+        with context.Pool(processes, initializer=init_worker, initargs=(limiter, result_log.queue), maxtasksperchild=getattr(config, 'worker_max_tasks', None)) as pool:
+            watch_legacy_trees(pool, timestamp)
+            click.echo('Stopping, waiting for migrations in progress...')
+            pool.close()
+            pool.join()
+    finally:
+        stop_logging(controller, result_log)
+
+    if (not config.dry_run):
+        migrate_thumbnails(timestamp)
+
+@cli.command()
+@click.option('--output', 'plan_file', default='sdkdd_plan.db', help='SQLite file to write the plan to')
+def plan(plan_file):
+    """Hashes and looks up everything to migrate read-only, and writes the result to a plan for `apply --plan`."""
+    plan_migration(plan_file)
+    click.echo(f'\nPlan written to {plan_file}. Run it with `python3 sdkdd.py apply --plan {plan_file}`.')
+
+@cli.command()
+def enqueue():
+    """Fills a `sdkdd_work_<epoch time>` queue that `sdkdd.py work` processes on any number of hosts."""
+    timestamp = int(time.time())
+    if (not config.dry_run):
+        for root in (config.data_dir, get_thumb_dir()):
+            if os.path.isdir(root) and prepare_shard_tree(root):
+                print(f'Created hash shard directories in {root}.')
+    queued = enqueue_work(timestamp)
+    click.echo(f'Queued {queued} files. Start `python3 sdkdd.py work {timestamp}` on every host that should take part.')
+
+@cli.command()
+@click.argument('migration_id')
+@click.option('--processes', type=int, default=None, help='worker processes on this host (defaults to the `processes` option)')
+def work(migration_id, processes):
+    """Migrates files from the `sdkdd_work_<migration_id>` queue until it is drained."""
+    if (config.dry_run):
+        click.echo('(`work` only runs wet, since it marks queued files as done. Use `apply` for a dry run.)')
+        return
+    work_in_parallel(int(migration_id), processes)
+    click.echo(f'Queue drained. Once every host is done, run `python3 sdkdd.py thumbnails {migration_id}`.')
+
+@cli.command()
+@click.argument('migration_id')
+def thumbnails(migration_id):
+    """Moves the thumbnails of an earlier migration (`sdkdd_migration_<migration_id>`) to their hashed locations."""
+    if (config.dry_run):
+        click.echo('(You are running `sdkdd` dry. Thumbnails are only indexed, not moved.)')
+        click.echo(f'Found {len(index_thumbnails(get_thumb_dir()))} legacy thumbnails.')
+        return
+    migrate_thumbnails(int(migration_id))
+
+@cli.command()
+@click.option('--action', type=click.Choice(RECLAIM_ACTIONS), default='report', help='what to do with verified duplicate leftovers')
+@click.option('--state', 'state_file', default='sdkdd_reclaim.db', help='progress file, to resume an interrupted run')
+def reclaim(action, state_file):
+    """Verifies the leftovers in `files`, `attachments`, and `inline` against the hash tree, and reclaims their space."""
+    if (config.dry_run and action != 'report'):
+        click.echo('(You are running `sdkdd` dry. Leftovers will only be reported.)\n')
+        action = 'report'
+    reclaim_leftovers(action, state_file)
+
+@cli.command()
+@click.option('--output', 'output_file', default='shinofix.txt', help='where to write files that don\'t match their hash, for `hashfixer.py`')
+@click.option('--extensions', 'extensions_file', default='sdkdd_verify_extensions.txt', help='where to write files whose extension doesn\'t match their type')
+@click.option('--rehash', is_flag=True, help='re-hash files the hash cache says are unchanged since they were last hashed')
+def verify(output_file, extensions_file, rehash):
+    """Re-hashes the whole hash tree, and lists files that don't match their name for `hashfixer.py`."""
+    verify_hash_tree(output_file, extensions_file, refresh=rehash)
+    click.echo(f'Fix the files listed in {output_file} with `python3 hashfixer.py` (which reads ./shinofix.txt).')
+
+@cli.command()
+@click.option('--output', 'report_file', default='sdkdd_sweep.tsv', help='where to write broken references and unregistered files')
+def sweep(report_file):
+    """Checks that every file referenced from posts and Discord messages exists in the hash tree."""
+    sweep_references(report_file)
+
+@cli.command()
+@click.option('--sample', 'sample_size', type=int, default=0, help='hash this many random files to estimate duplicates and hashing speed')
+@click.option('--results', 'results_file', default=None, help='an earlier (dry) run\'s sdkdd_results_<epoch time>.jsonl, to estimate run time from')
+def census(sample_size, results_file):
+    """Counts the files in the legacy trees (without reading them), and estimates how long a migration will take."""
+    take_census(sample_size, results_file)
+
 @cli.command()
 def revert():
     click.echo('revert (unimplemented...)')
@@ -0,0 +1,153 @@
+import asyncio
+import concurrent.futures
+import itertools
+import multiprocessing
+import time
+import traceback
+
+import config
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from . import instrument, results
+from .migrators import attachments, files, inline
+from .migrators.common import (
+    detect_file_type,
+    get_owner,
+    get_web_path,
+    hash_file,
+    move_file,
+    plan_is_keyed,
+    plan_matches,
+    purge_owners,
+    stat_file
+)
+from .mover import close_movers
+from .stages import StageConnection, run_stage
+from .storage import get_backend
+from .utils import get_connection_parameters
+
+# legacy tree -> the database stages of its migrator
+DATABASE_STAGES = {
+    'files': files.resolve_and_write,
+    'attachments': attachments.resolve_and_write,
+    'inline': inline.resolve_and_write,
+}
+
+
+def _update_database(pool, resolve_and_write, *args):
+    connection = StageConnection(pool)
+    try:
+        return resolve_and_write(connection, *args)
+    finally:
+        connection.close()
+
+
+class AsyncEngine:
+    """
+    Runs up to `async_concurrency` migrations at once in this process, as coroutines.
+    The blocking parts of a migration are handed to executors sized for what they wait on:
+    hashing and libmagic to `async_hash_threads` threads (both let go of the GIL), the database stages
+    to one thread per pooled connection (`async_connections`), and stat, move and BAN calls to `async_io_threads`.
+    A file only holds a connection while it's being resolved and written.
+    """
+
+    def __init__(self, migration_id):
+        self.migration_id = migration_id
+        self.concurrency = getattr(config, 'async_concurrency', 256)
+        connections = getattr(config, 'async_connections', 8)
+        # (other storages open a connection per file, see src/storage)
+        self.pool = ThreadedConnectionPool(0, connections, cursor_factory=RealDictCursor, **get_connection_parameters()) if get_backend() == 'postgres' else None
+        self.database = concurrent.futures.ThreadPoolExecutor(connections, thread_name_prefix='sdkdd-db')
+        self.hashing = concurrent.futures.ThreadPoolExecutor(
+            getattr(config, 'async_hash_threads', None) or multiprocessing.cpu_count(),
+            thread_name_prefix='sdkdd-hash'
+        )
+        self.io = concurrent.futures.ThreadPoolExecutor(getattr(config, 'async_io_threads', 32), thread_name_prefix='sdkdd-io')
+        self.reader = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='sdkdd-read')
+
+    async def _stage(self, executor, stage: str, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, run_stage, stage, func, *args)
+
+    async def migrate(self, kind: str, path: str, owner: dict):
+        """The coroutine version of the `src.migrators` functions."""
+        started = time.monotonic()
+        plan = owner.pop('_plan', None)
+        try:
+            stat = await self._stage(self.io, 'stat', stat_file, path)
+            if stat is None:
+                return
+
+            web_path = get_web_path(path)
+            if not plan_matches(plan, stat):
+                # hash and look up again if the file changed since `sdkdd.py plan`
+                plan = None
+            file_hash = await self._stage(self.hashing, 'hash', hash_file, path, stat, plan)
+            (mime, file_ext, new_filename) = await self._stage(self.hashing, 'detect', detect_file_type, path, file_hash, plan)
+
+            (step, owners, updated_rows) = await asyncio.get_running_loop().run_in_executor(
+                self.database, _update_database,
+                self.pool, DATABASE_STAGES[kind],
+                path, self.migration_id, web_path, new_filename, file_hash, stat, mime, file_ext,
+                {key.lstrip('_'): value for (key, value) in owner.items()},
+                plan_is_keyed(plan)
+            )
+
+            await self._stage(self.io, 'move', move_file, path, file_hash, new_filename)
+            await self._stage(self.io, 'purge', purge_owners, owners)
+        except Exception as error:
+            # what `trace_unhandled_exceptions` does for the migrators
+            results.report(step=getattr(error, 'sdkdd_stage', f"migrate_{kind.rstrip('s')}"), old_path=path, error=traceback.format_exc())
+            return
+
+        # done!
+        results.report(
+            kind=kind,
+            old_path=web_path,
+            new_path=new_filename,
+            hash=file_hash,
+            size=stat.st_size,
+            step=step,
+            rows=updated_rows,
+            owner=get_owner(owners),
+            seconds=time.monotonic() - started
+        )
+
+    async def run(self, work):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        def done(task):
+            tasks.discard(task)
+            slots.release()
+
+        work = iter(work)
+        while True:
+            # scanning (or reading a pipe) blocks, so it gets a thread of its own
+            batch = await loop.run_in_executor(self.reader, lambda: list(itertools.islice(work, 64)))
+            if not batch:
+                break
+            for (kind, path, owner) in batch:
+                await slots.acquire()
+                task = loop.create_task(self.migrate(kind, path, dict(owner)))
+                tasks.add(task)
+                task.add_done_callback(done)
+        await asyncio.gather(*tasks)
+
+    def close(self):
+        for executor in (self.reader, self.hashing, self.database, self.io):
+            executor.shutdown()
+        if self.pool:
+            self.pool.closeall()
+
+
+def migrate_async(work, migration_id):
+    """Migrates everything in `work` (`(kind, path, owner)` tuples, like `iter_work` yields) with an `AsyncEngine`."""
+    engine = AsyncEngine(migration_id)
+    try:
+        asyncio.run(engine.run(work))
+    finally:
+        engine.close()
+        close_movers()
+        instrument.send_stats()
@@ -0,0 +1,203 @@
+import collections
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import time
+
+import config
+
+from .hashing import hash_file
+from .scanner import MIGRATORS
+from .sniff import sniff_mime
+from .utils import get_connection
+
+# (upper bound in bytes, label) for the size histogram
+SIZE_BUCKETS = (
+    (1, 'empty'),
+    (16 * 1024, '<16K'),
+    (256 * 1024, '<256K'),
+    (4 * 1024 * 1024, '<4M'),
+    (64 * 1024 * 1024, '<64M'),
+    (1024 * 1024 * 1024, '<1G'),
+    (float('inf'), '>=1G'),
+)
+
+
+def size_bucket(size: int):
+    for (bound, label) in SIZE_BUCKETS:
+        if size < bound:
+            return label
+
+
+def census_tree(task):
+    """
+    Counts what's in one top-level directory of a legacy tree (or the loose files at its root) from metadata alone.
+    Also keeps the `sample_size` files with the smallest random keys, so merging every task's picks gives a uniform sample.
+    """
+    (kind, top, path, recursive, sample_size) = task
+    counts = collections.Counter()
+    sizes = collections.Counter()
+    sample = []
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    counts['directories'] += 1
+                    directories.append(entry.path)
+                continue
+            if entry.is_symlink():
+                counts['symlinks'] += 1
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                counts['special'] += 1
+                continue
+            size = entry.stat(follow_symlinks=False).st_size
+            if entry.name.endswith('.temp'):
+                counts['temp'] += 1
+                continue
+            if size == 0:
+                counts['empty'] += 1
+                continue
+            counts['files'] += 1
+            counts['bytes'] += size
+            sizes[size_bucket(size)] += 1
+            if sample_size:
+                item = (-random.random(), entry.path, size)
+                if len(sample) < sample_size:
+                    heapq.heappush(sample, item)
+                elif item > sample[0]:
+                    heapq.heapreplace(sample, item)
+    return (kind, top, counts, sizes, [(path, size) for (_, path, size) in sample], [-key for (key, _, _) in sample])
+
+
+def _iter_tasks(sample_size: int):
+    for kind in MIGRATORS:
+        root = os.path.join(config.data_dir, kind)
+        if not os.path.isdir(root):
+            continue
+        yield (kind, '(root)', root, False, sample_size)
+        for entry in os.scandir(root):
+            if entry.is_dir(follow_symlinks=False):
+                yield (kind, entry.name, entry.path, True, sample_size)
+
+
+def _hash_sample(sample: list):
+    """Hashes and sniffs the sampled files, returning `(hashes, seconds per file)`."""
+    hashes = []
+    seconds = []
+    for (path, _) in sample:
+        started = time.perf_counter()
+        try:
+            hashes.append(hash_file(path))
+            sniff_mime(path)
+        except OSError:
+            continue
+        seconds.append(time.perf_counter() - started)
+    return (hashes, seconds)
+
+
+def _known_hashes(hashes: list):
+    """Which of `hashes` the `files` table already has, or `None` if the database can't be reached."""
+    try:
+        conn = get_connection()
+    except Exception:
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT hash FROM files WHERE hash = ANY(%s)', (list(set(hashes)),))
+        known = {file_hash for (file_hash,) in cursor}
+    conn.close()
+    return known
+
+
+def _seconds_per_file(results_file: str):
+    """Mean seconds per migrated file in an earlier run's (dry or wet) results JSONL."""
+    seconds = []
+    with open(results_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('new_path') and record.get('seconds') is not None:
+                seconds.append(record['seconds'])
+    return statistics.mean(seconds) if seconds else None
+
+
+def _format_size(size: float):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} PiB'
+
+
+def _format_duration(seconds: float):
+    return f'{int(seconds // 3600)}h{int(seconds % 3600 // 60):02d}m'
+
+
+def census(sample_size: int = 0, results_file: str = None, top: int = 20):
+    """
+    Inventories the legacy trees from every core (metadata only), and prints counts and size histograms
+    per tree and per top-level directory (usually a user). With `sample_size`, that many random files are hashed
+    to estimate how many are duplicates and how long hashing takes; with `results_file` (`sdkdd_results_*.jsonl`
+    from an earlier run, dry runs included), its per-file time is used for the estimate instead.
+    """
+    processes = config.processes or multiprocessing.cpu_count()
+    per_kind = collections.defaultdict(collections.Counter)
+    per_kind_sizes = collections.defaultdict(collections.Counter)
+    per_top = collections.Counter()
+    per_top_files = collections.Counter()
+    candidates = []
+    with multiprocessing.Pool(processes) as pool:
+        for (kind, top_name, counts, sizes, sample, keys) in pool.imap_unordered(census_tree, _iter_tasks(sample_size)):
+            per_kind[kind].update(counts)
+            per_kind_sizes[kind].update(sizes)
+            per_top[f'{kind}/{top_name}'] += counts['bytes']
+            per_top_files[f'{kind}/{top_name}'] += counts['files']
+            candidates.extend(zip(keys, sample))
+
+    totals = collections.Counter()
+    for kind in per_kind:
+        totals.update(per_kind[kind])
+    for (kind, counts) in sorted(per_kind.items()):
+        print(
+            f"{kind}: {counts['files']} files ({_format_size(counts['bytes'])}) in {counts['directories']} directories; "
+            f"skipped: {counts['empty']} empty, {counts['temp']} temp, {counts['symlinks']} symlinks, {counts['special']} special"
+        )
+        print('  sizes: ' + ', '.join(f'{label} {per_kind_sizes[kind][label]}' for (_, label) in SIZE_BUCKETS[1:]))
+    print(f'top {top} directories by size:')
+    for (name, size) in per_top.most_common(top):
+        if not size:
+            break
+        print(f'  {name}: {per_top_files[name]} files, {_format_size(size)}')
+
+    seconds_per_file = None
+    if sample_size and candidates:
+        # the smallest keys across every task are a uniform sample of all files
+        sample = [item for (_, item) in sorted(candidates)[:sample_size]]
+        (hashes, seconds) = _hash_sample(sample)
+        if hashes:
+            # a file is a duplicate if another sampled file has its hash, or the hash tree already does
+            known = _known_hashes(hashes)
+            repeats = collections.Counter(hashes)
+            duplicates = sum(1 for file_hash in hashes if repeats[file_hash] > 1 or (known and file_hash in known))
+            print(
+                f'sample of {len(hashes)} files: {duplicates} ({duplicates / len(hashes):.1%}) are duplicates, '
+                f'about {int(totals["files"] * duplicates / len(hashes))} of all files' +
+                ('' if known is not None else ' (the database is unreachable, so only duplicates within the sample count)')
+            )
+            seconds_per_file = statistics.mean(seconds)
+            print(f'hashing and sniffing took {seconds_per_file * 1000:.1f} ms per file ({_format_size(sum(size for (_, size) in sample) / sum(seconds))}/s) on one core')
+    if results_file:
+        seconds_per_file = _seconds_per_file(results_file) or seconds_per_file
+        print(f'{results_file}: {seconds_per_file * 1000:.1f} ms per file, database work included' if seconds_per_file else f'{results_file} has no migrated files.')
+
+    if seconds_per_file:
+        estimate = totals['files'] * seconds_per_file / processes
+        print(f"estimated run time with processes = {processes}: {_format_duration(estimate)}" + ('' if results_file else ' (hashing only, pass --results from a dry run to include the database)'))
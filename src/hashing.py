@@ -0,0 +1,98 @@
+import hashlib
+import os
+import sqlite3
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def hash_fileobj(f, buffer_size: int = BUFFER_SIZE):
+    """
+    Returns the SHA256 hex digest of an open binary file.
+    Reads into one reused buffer (large enough for `hashlib` to release the GIL while hashing),
+    and tells the kernel the file is read sequentially so readahead can do its thing.
+    """
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+    file_hash = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        size = f.readinto(buffer)
+        if not size:
+            break
+        file_hash.update(view[:size])
+    return file_hash.hexdigest()
+
+
+def hash_file(path: str, buffer_size: int = BUFFER_SIZE):
+    with open(path, 'rb', buffering=0) as f:
+        return hash_fileobj(f, buffer_size)
+
+
+class InodeCache:
+    """
+    SQLite cache of file hashes by `(st_dev, st_ino)`, for files hashed over and over across runs.
+    An entry only counts while the file's size, mtime and ctime are the same as when it was hashed.
+    Safe to share between processes; writes are committed in batches.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS inodes (
+                dev integer NOT NULL,
+                ino integer NOT NULL,
+                size integer NOT NULL,
+                mtime_ns integer NOT NULL,
+                ctime_ns integer NOT NULL,
+                hash text NOT NULL,
+                PRIMARY KEY (dev, ino)
+            )
+        ''')
+        self.conn.commit()
+        self.batch_size = batch_size
+        self._pending = 0
+
+    def get(self, stat: os.stat_result):
+        row = self.conn.execute(
+            'SELECT hash FROM inodes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ?',
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, stat: os.stat_result, file_hash: str):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?, ?, ?)',
+            (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, file_hash)
+        )
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def hash_file_cached(path: str, cache: InodeCache = None, stat: os.stat_result = None, refresh=False):
+    """
+    Returns `(file_hash, cached)`: the hash of `path` from `cache` if it's there and the file hasn't changed,
+    otherwise (or with `refresh`) read from the file and stored in `cache`.
+    """
+    stat = stat or os.stat(path)
+    if cache and not refresh:
+        file_hash = cache.get(stat)
+        if file_hash:
+            return (file_hash, True)
+    file_hash = hash_file(path)
+    if cache:
+        cache.put(stat, file_hash)
+    return (file_hash, False)
@@ -0,0 +1,173 @@
+import collections
+import contextlib
+import contextvars
+import multiprocessing.util
+import random
+import threading
+import time
+
+import config
+import psycopg2
+
+from . import results
+
+_step = contextvars.ContextVar('sdkdd_step', default=None)
+_stats = None
+_lock = threading.Lock()
+
+
+def enabled():
+    return getattr(config, 'instrument_queries', False)
+
+
+def _get_stats():
+    """This process' per-step counters, sent to the result log when it exits."""
+    global _stats
+    with _lock:
+        if _stats is None:
+            _stats = collections.defaultdict(collections.Counter)
+            multiprocessing.util.Finalize(None, send_stats, exitpriority=10)
+        return _stats
+
+
+def send_stats():
+    """Sends this process' counters to the result log (when it exits, or at the end of an `asyncio` engine run)."""
+    if _stats and results.installed():
+        with _lock:
+            stats = {tag: dict(counter) for (tag, counter) in _stats.items()}
+            _stats.clear()
+        results.report(kind='query_stats', stats=stats)
+
+
+@contextlib.contextmanager
+def lookup(kind: str, step):
+    """
+    Tags the queries run inside with the lookup step (see `execute`), and counts it as one execution of that step.
+    Set `found` on the yielded dict when the step found something.
+    """
+    result = {'found': False}
+    if not enabled():
+        yield result
+        return
+    tag = f'{kind}:{step}'
+    token = _step.set(tag)
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        _step.reset(token)
+        stats = _get_stats()
+        with _lock:
+            stats[tag]['calls'] += 1
+            stats[tag]['hits'] += int(bool(result['found']))
+            stats[tag]['seconds'] += time.perf_counter() - started
+
+
+def execute(cursor, query: str, params=None):
+    """
+    `cursor.execute` for lookup queries. While instrumenting, the query is tagged with a comment naming its step,
+    which shows up in `pg_stat_statements` and `pg_stat_activity`, and `instrument_explain_fraction` of executions
+    are run through `EXPLAIN (ANALYZE, BUFFERS)` first. Lookups are read-only, so running them twice is harmless.
+    """
+    tag = _step.get()
+    if tag:
+        query = f'/* sdkdd {tag} */ ' + query
+        if random.random() < getattr(config, 'instrument_explain_fraction', 0.01):
+            _explain(cursor.connection, tag, query, params)
+    cursor.execute(query, params)
+
+
+def _plan_totals(plan: dict, totals: collections.Counter):
+    if 'Scan' in plan.get('Node Type', ''):
+        totals['rows_examined'] += (plan.get('Actual Rows', 0) + plan.get('Rows Removed by Filter', 0)) * plan.get('Actual Loops', 1)
+        if plan['Node Type'] == 'Seq Scan':
+            totals['seq_scans'] += 1
+    for child in plan.get('Plans', []):
+        _plan_totals(child, totals)
+
+
+def _explain(conn, tag: str, query: str, params):
+    totals = collections.Counter()
+    with conn.cursor() as cursor:
+        # in a savepoint, so a failed EXPLAIN doesn't take the lookup's transaction down with it
+        cursor.execute('SAVEPOINT sdkdd_explain')
+        try:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+            row = cursor.fetchone()
+            cursor.execute('RELEASE SAVEPOINT sdkdd_explain')
+        except psycopg2.extensions.QueryCanceledError:
+            raise
+        except psycopg2.Error:
+            # best effort, the lookup itself still runs
+            cursor.execute('ROLLBACK TO SAVEPOINT sdkdd_explain')
+            return
+    (explained,) = row.values() if isinstance(row, dict) else row
+    plan = explained[0]
+    totals['explains'] = 1
+    totals['explain_ms'] = plan.get('Execution Time', 0)
+    # buffer counts of a node include its children's
+    totals['shared_hit'] = plan['Plan'].get('Shared Hit Blocks', 0)
+    totals['shared_read'] = plan['Plan'].get('Shared Read Blocks', 0)
+    _plan_totals(plan['Plan'], totals)
+    stats = _get_stats()
+    with _lock:
+        stats[tag].update(totals)
+
+
+def merge_stats(records: list):
+    """Adds up the `query_stats` records of every worker."""
+    merged = collections.defaultdict(collections.Counter)
+    for record in records:
+        for (tag, counter) in record['stats'].items():
+            merged[tag].update(counter)
+    return merged
+
+
+def snapshot_statements(conn):
+    """`pg_stat_statements` for this database as `{queryid: (query, calls, total ms, rows, blocks hit, blocks read)}`, or `None` if it isn't installed."""
+    for time_column in ('total_exec_time', 'total_time'):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f'''
+                    SELECT queryid, query, calls, {time_column}, rows, shared_blks_hit, shared_blks_read
+                    FROM pg_stat_statements
+                    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+                ''')
+                rows = cursor.fetchall()
+            conn.rollback()
+            return {row[0]: tuple(row[1:]) for row in rows}
+        except psycopg2.Error:
+            # (`total_time` before Postgres 13)
+            conn.rollback()
+    return None
+
+
+def write_report(report_file: str, step_stats: dict, statements_before, statements_after, top: int = 25):
+    """Writes the steps ranked by total time, with what their sampled plans looked like, and the busiest statements of the run."""
+    with open(report_file, 'w') as report:
+        report.write('lookup steps, by total time (rows examined, buffer reads and seq scans from sampled EXPLAIN ANALYZE)\n')
+        report.write(f"{'step':<16}{'calls':>10}{'hits':>10}{'total s':>12}{'avg ms':>10}{'samples':>9}{'rows/hit':>12}{'reads/call':>12}{'seq scans':>11}\n")
+        for (tag, stats) in sorted(step_stats.items(), key=lambda item: -item[1]['seconds']):
+            calls = stats['calls'] or 1
+            samples = stats['explains']
+            rows_per_call = stats['rows_examined'] / samples if samples else 0
+            # every call examines rows, only hits find something
+            rows_per_hit = rows_per_call * calls / stats['hits'] if (samples and stats['hits']) else 0
+            reads_per_call = stats['shared_read'] / samples if samples else 0
+            report.write(
+                f"{tag:<16}{stats['calls']:>10}{stats['hits']:>10}{stats['seconds']:>12.1f}{stats['seconds'] / calls * 1000:>10.1f}"
+                f"{samples:>9}{rows_per_hit:>12.0f}{reads_per_call:>12.0f}{stats['seq_scans']:>11}\n"
+            )
+
+        report.write('\n')
+        if statements_before is None or statements_after is None:
+            report.write('pg_stat_statements is not installed, so there are no statement totals.\n')
+            return
+        deltas = []
+        for (queryid, (query, calls, total_ms, rows, hit, read)) in statements_after.items():
+            (_, calls_before, total_ms_before, rows_before, hit_before, read_before) = statements_before.get(queryid, (query, 0, 0, 0, 0, 0))
+            if calls > calls_before:
+                deltas.append((total_ms - total_ms_before, calls - calls_before, rows - rows_before, hit - hit_before, read - read_before, query))
+        report.write(f'top {top} statements during the run, by total time (pg_stat_statements)\n')
+        for (total_ms, calls, rows, hit, read, query) in sorted(deltas, reverse=True)[:top]:
+            report.write(f"{total_ms / 1000:>10.1f}s {calls:>9} calls {rows:>11} rows {hit:>11} hit {read:>11} read  {' '.join(query.split())[:200]}\n")
@@ -0,0 +1,152 @@
+import concurrent.futures
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+from .mover import HASHED_NAME, iter_shards
+
+MAGIC = b'SDKDDKH1'
+# magic, number of hashes in the file tracking table, number of files in the hash tree
+HEADER = struct.Struct('<8sQQ')
+# a hash in the file tracking table, as 32 bytes
+DATABASE_RECORD = struct.Struct('<32s')
+# a file in the hash tree: its hash and extension (names with longer ones aren't recorded, and get probed as usual)
+TREE_RECORD = struct.Struct('<32s8s')
+# records sorted in memory at a time while writing, the rest is merged from sorted runs on disk
+SORT_CHUNK = 1000000
+
+
+def _parse_tree_name(name: str):
+    match = HASHED_NAME.match(name)
+    if not match or len((match.group(2) or '').encode()) > 8:
+        return None
+    return bytes.fromhex(match.group(1)) + (match.group(2) or '').encode().ljust(8, b'\0')
+
+
+def _list_shard(shard: str):
+    with os.scandir(shard) as it:
+        return [record for record in (_parse_tree_name(entry.name) for entry in it if entry.is_file(follow_symlinks=False)) if record]
+
+
+def _write_sorted(out, records, record_size: int, scratch_dir: str):
+    """Writes `records` (bytes of `record_size`) to `out` sorted and without duplicates, sorting `SORT_CHUNK` at a time. Returns how many were written."""
+    runs = []
+    try:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= SORT_CHUNK:
+                runs.append(_write_run(chunk, scratch_dir))
+                chunk = []
+        chunk.sort()
+        merged = heapq.merge(chunk, *(_read_run(run, record_size) for run in runs))
+        count = 0
+        previous = None
+        for record in merged:
+            if record != previous:
+                out.write(record)
+                count += 1
+                previous = record
+        return count
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _write_run(chunk: list, scratch_dir: str):
+    chunk.sort()
+    run = tempfile.TemporaryFile(dir=scratch_dir)
+    run.write(b''.join(chunk))
+    run.seek(0)
+    return run
+
+
+def _read_run(run, record_size: int):
+    while True:
+        block = run.read(record_size * 4096)
+        if not block:
+            return
+        for offset in range(0, len(block), record_size):
+            yield block[offset:offset + record_size]
+
+
+def _iter_database_records(storage):
+    for file_hash in storage.iter_file_hashes():
+        try:
+            digest = bytes.fromhex(file_hash)
+        except (TypeError, ValueError):
+            continue
+        if len(digest) == DATABASE_RECORD.size:
+            yield digest
+
+
+def write_known_hashes(known_hashes_path: str, storage, root: str, threads: int = 16):
+    """
+    Writes every hash in the file tracking table (read through `storage`) and every `<hash>.<ext>` file in the hash tree
+    under `root` to `known_hashes_path`, as two sorted arrays of fixed-width records. Returns `(hashes, files)`.
+    """
+    scratch_dir = os.path.dirname(os.path.abspath(known_hashes_path))
+    with open(known_hashes_path, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, 0, 0))
+        database_count = _write_sorted(out, _iter_database_records(storage), DATABASE_RECORD.size, scratch_dir)
+        with concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='sdkdd-known') as executor:
+            tree = (record for records in executor.map(_list_shard, iter_shards(root)) for record in records)
+            tree_count = _write_sorted(out, tree, TREE_RECORD.size, scratch_dir)
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, database_count, tree_count))
+    return (database_count, tree_count)
+
+
+class KnownHashes:
+    """
+    The hashes written by `write_known_hashes`, binary searched through a read-only `mmap`,
+    so every worker shares the same pages instead of holding a set of its own.
+    """
+
+    def __init__(self, known_hashes_path: str):
+        with open(known_hashes_path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.database_count, self.tree_count) = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f'{known_hashes_path} is not a known hashes file.')
+        self.tree_offset = HEADER.size + self.database_count * DATABASE_RECORD.size
+
+    def _search(self, offset: int, count: int, record_size: int, record: bytes):
+        (low, high) = (0, count)
+        while low < high:
+            middle = (low + high) // 2
+            start = offset + middle * record_size
+            if self.data[start:start + record_size] < record:
+                low = middle + 1
+            else:
+                high = middle
+        start = offset + low * record_size
+        return low < count and self.data[start:start + record_size] == record
+
+    def in_database(self, file_hash: str):
+        """Whether `file_hash` was in the file tracking table."""
+        return self._search(HEADER.size, self.database_count, DATABASE_RECORD.size, bytes.fromhex(file_hash))
+
+    def in_tree(self, new_name: str):
+        """Whether `new_name` (`<hash>.<ext>`) was in the hash tree."""
+        record = _parse_tree_name(new_name)
+        return bool(record) and self._search(self.tree_offset, self.tree_count, TREE_RECORD.size, record)
+
+    def close(self):
+        self.data.close()
+
+
+_known = None
+
+
+def install(known_hashes_path: str):
+    """Opens the known hashes for the migrators of this process to use."""
+    global _known
+    _known = KnownHashes(known_hashes_path)
+
+
+def get():
+    """This process' `KnownHashes`, or `None` if there are none."""
+    return _known
@@ -0,0 +1,166 @@
+import collections
+import mmap
+import os
+import struct
+
+import config
+
+from .mover import flush_movers
+from .scanner import MIGRATORS
+from .utils import remove_prefix
+
+MAGIC = b'SDKDDMF1'
+# magic, number of records. the count is written last, so a manifest cut short by a crash reads as empty
+HEADER = struct.Struct('<8sQ')
+# path offset and length in the string heap, kind, status, size, mtime, inode
+RECORD = struct.Struct('<QIBB2xQdQ')
+STATUS_OFFSET = 13
+KINDS = tuple(MIGRATORS)
+
+PENDING = 0
+DONE = 1
+FAILED = 2
+STATUSES = {PENDING: 'pending', DONE: 'done', FAILED: 'failed'}
+
+
+def write_manifest(manifest_path: str, work):
+    """
+    Writes `work` (`(kind, path, owner)` tuples, owners are dropped) to a manifest, one fixed-width record per file
+    in `manifest_path`, and their paths (relative to `data_dir`) back to back in `<manifest_path>.paths`.
+    Returns the number of files written.
+    """
+    count = 0
+    offset = 0
+    with open(manifest_path, 'wb') as records, open(f'{manifest_path}.paths', 'wb') as heap:
+        records.write(HEADER.pack(MAGIC, 0))
+        for (kind, path, _) in work:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            encoded = os.fsencode(remove_prefix(path, config.data_dir).lstrip('/'))
+            heap.write(encoded)
+            records.write(RECORD.pack(offset, len(encoded), KINDS.index(kind), PENDING, stat.st_size, stat.st_mtime, stat.st_ino))
+            offset += len(encoded)
+            count += 1
+        heap.flush()
+        os.fsync(heap.fileno())
+        records.seek(0)
+        records.write(HEADER.pack(MAGIC, count))
+    return count
+
+
+class Manifest:
+    """
+    A manifest written by `write_manifest`, read (and with `writable`, updated) through `mmap`,
+    so it costs the same memory whether it lists a thousand files or fifty million.
+    """
+
+    def __init__(self, manifest_path: str, writable=False):
+        self.path = manifest_path
+        self._files = []
+        self.records = self._map(manifest_path, writable)
+        (magic, self.count) = HEADER.unpack_from(self.records) if len(self.records) >= HEADER.size else (None, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{manifest_path} is not a manifest.')
+        self.heap = self._map(f'{manifest_path}.paths', False) if self.count else b''
+
+    def _map(self, path: str, writable: bool):
+        f = open(path, 'r+b' if writable else 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, index: int):
+        """Returns `(kind, path, size, mtime, inode, status)` for the record at `index`."""
+        (offset, length, kind, status, size, mtime, inode) = RECORD.unpack_from(self.records, HEADER.size + index * RECORD.size)
+        path = os.path.join(config.data_dir, os.fsdecode(self.heap[offset:offset + length]))
+        return (KINDS[kind], path, size, mtime, inode, status)
+
+    def status(self, index: int):
+        return self.records[HEADER.size + index * RECORD.size + STATUS_OFFSET]
+
+    def size(self, index: int):
+        return RECORD.unpack_from(self.records, HEADER.size + index * RECORD.size)[4]
+
+    def set_status(self, index: int, status: int):
+        self.records[HEADER.size + index * RECORD.size + STATUS_OFFSET] = status
+
+    def flush(self):
+        self.records.flush()
+
+    def close(self):
+        for mapped in (self.records, self.heap):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        for f in self._files:
+            f.close()
+
+
+def is_manifest(manifest_path: str):
+    """Whether `manifest_path` is a complete manifest (one whose scan wasn't cut short)."""
+    try:
+        manifest = Manifest(manifest_path)
+    except (OSError, ValueError):
+        return False
+    complete = len(manifest) > 0
+    manifest.close()
+    return complete
+
+
+_manifests = {}
+
+
+def migrate_range(task):
+    """
+    Migrates the records `start` to `end` of a manifest (skipping done ones, and ones of `max_size` and up),
+    then marks them done or failed in place, once their moves are flushed. Statuses aren't touched in a dry run.
+    """
+    (manifest_path, start, end, migration_id, max_size) = task
+    manifest = _manifests.get(manifest_path)
+    if manifest is None:
+        manifest = _manifests[manifest_path] = Manifest(manifest_path, writable=True)
+    finished = []
+    for index in range(start, end):
+        (kind, path, size, _, _, status) = manifest.get(index)
+        if status == DONE or (max_size and size >= max_size):
+            continue
+        migrated = MIGRATORS[kind](path, migration_id)
+        finished.append((index, DONE if migrated else FAILED))
+    if config.dry_run or not finished:
+        return
+    # don't call anything done before it's actually in the hash tree
+    flush_movers()
+    for (index, status) in finished:
+        manifest.set_status(index, status)
+    manifest.flush()
+
+
+def migrate_manifest(pool, manifest_path: str, migration_id):
+    """
+    Migrates every file of a manifest that isn't done yet, `manifest_chunk_size` records per task.
+    Files of `lane_large_mb` and up are sent first, one per task and biggest first, so they don't make up the tail of the run.
+    """
+    manifest = Manifest(manifest_path)
+    large_size = getattr(config, 'lane_large_mb', 256) * 1024 * 1024
+    chunk_size = getattr(config, 'manifest_chunk_size', 256)
+    count = len(manifest)
+    counts = collections.Counter()
+    large = []
+    for index in range(count):
+        status = manifest.status(index)
+        counts[status] += 1
+        if status != DONE and manifest.size(index) >= large_size:
+            large.append((manifest.size(index), index))
+    manifest.close()
+    print(f'{manifest_path}: ' + ', '.join(f'{counts[status]} {name}' for (status, name) in STATUSES.items()))
+
+    large.sort(reverse=True)
+    tasks = [(manifest_path, index, index + 1, migration_id, None) for (_, index) in large]
+    tasks += [(manifest_path, start, min(start + chunk_size, count), migration_id, large_size) for start in range(0, count, chunk_size)]
+    for _ in pool.imap_unordered(migrate_range, tasks):
+        pass
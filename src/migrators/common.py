@@ -0,0 +1,129 @@
+"""
+Stages shared by every migrator: stat, hash, detect, resolve, write (helpers), move and purge.
+Each one is run through `run_stage`, so a transient error only repeats the stage it happened in.
+"""
+import datetime
+import os
+import stat as stat_module
+
+import config
+
+from .. import known_hashes, throttle
+from ..hashing import hash_fileobj
+from ..mover import get_mover
+from ..sniff import sniff_mime
+from ..utils import get_hashed_filename, remove_suffix
+
+# what a migrator returns for a file it left alone because nothing references it yet (`_defer_unowned`)
+DEFERRED = 'deferred'
+
+
+def get_web_path(path: str):
+    return path.replace(remove_suffix(config.data_dir, '/'), '')
+
+
+def plan_matches(plan, stat: os.stat_result):
+    """Whether a `sdkdd.py plan` entry still describes the file (same size and mtime as when it was planned)."""
+    return bool(plan) and plan['size'] == stat.st_size and plan['mtime'] == stat.st_mtime
+
+
+def plan_is_keyed(plan):
+    """
+    Whether the owner a `sdkdd.py plan` entry hands the migrator is all there is to look up (`keyed_only`).
+    Files the plan found several owners for are looked up again the way the plan did, so every one of them is rewritten.
+    """
+    return plan is not None and plan['keyed']
+
+
+def stat_file(path: str):
+    """Returns the file's `stat`, or `None` if it should be skipped (gone, special, empty or temporary)."""
+    if config.ignore_temp_files and path.endswith('.temp'):
+        return None
+    try:
+        stat = os.stat(path, follow_symlinks=False)
+    except FileNotFoundError:
+        return None
+    # check if the file is special (symlink, mount, empty) and skip it if so
+    if not stat_module.S_ISREG(stat.st_mode) or stat.st_size == 0 or os.path.ismount(path):
+        return None
+    return stat
+
+
+def hash_file(path: str, stat: os.stat_result, plan=None):
+    if plan:
+        return plan['hash']
+    with open(path, 'rb') as f, throttle.acquire('io', stat.st_dev):
+        return hash_fileobj(f)
+
+
+def detect_file_type(path: str, file_hash: str, plan=None):
+    """Returns `(mime, file_ext, new_filename)`."""
+    if plan:
+        return (plan['mime'], plan['ext'], plan['new_path'])
+    with throttle.acquire('cpu'):
+        mime = sniff_mime(path)
+    (new_filename, file_ext) = get_hashed_filename(file_hash, os.path.splitext(path)[1], mime)
+    return (mime, file_ext, new_filename)
+
+
+def resolve_owners(connection, resolve, web_path: str, new_filename: str, stat: os.stat_result, hints: dict, keyed_only=False):
+    """Read-only lookup of the posts/messages referencing the file with one of `src.resolver`'s resolvers."""
+    with throttle.acquire('db'):
+        return resolve(
+            connection.get(),
+            web_path,
+            new_filename,
+            datetime.datetime.fromtimestamp(stat.st_mtime),
+            keyed_only,
+            **{key: value for (key, value) in hints.items() if value}
+        )
+
+
+def record_file(storage, file_hash: str, stat: os.stat_result, mime: str, file_ext: str):
+    """
+    The file's id in the file tracking table: looked up if the preloaded hashes (see src/known_hashes.py) have it,
+    so duplicates don't cost an upsert and a dead tuple each, otherwise inserted.
+    """
+    known = known_hashes.get()
+    if known and known.in_database(file_hash):
+        file_id = storage.get_file_id(file_hash)
+        if file_id is not None:
+            return file_id
+    return storage.insert_file(file_hash, stat, mime, file_ext)
+
+
+def finish_write(storage):
+    if (config.dry_run):
+        storage.rollback()
+    else:
+        storage.commit()
+
+
+def move_file(path: str, file_hash: str, new_filename: str):
+    """
+    Moves the file through this worker's mover threads, which never overwrite anything already there,
+    and waits for it: it's only reported as migrated once it's in the hash tree.
+    """
+    # (thumbnails are moved in their own stage once everything is migrated, see src/thumbnails.py)
+    if (config.dry_run):
+        return
+    known = known_hashes.get()
+    if known and known.in_tree(os.path.basename(new_filename)):
+        # already in the hash tree when the run started: the mover would find it there and leave the source be
+        return
+    get_mover(config.data_dir).move(path, file_hash, os.path.basename(new_filename))
+
+
+def purge_owners(owners: list):
+    """BANs the cached pages of every artist whose posts were updated."""
+    if (config.dry_run or not config.ban_url):
+        return
+    # (imported here, most runs never purge anything)
+    import requests
+    for (service, user_id) in {(owner['service'], owner['user_id']) for owner in owners if owner.get('post_id')}:
+        requests.request('BAN', f"{config.ban_url}/{service}/user/" + user_id)
+
+
+def get_owner(owners: list):
+    """The owner to report for a migrated file."""
+    return owners[0] if owners else None
@@ -1,160 +1,114 @@
-import hashlib
-import os
-from ..utils import trace_unhandled_exceptions, remove_suffix, remove_prefix, replace_file_from_post
+from .. import results, throttle
+from ..resolver import resolve_inline
+from ..stages import StageConnection, run_stage
+from ..utils import trace_unhandled_exceptions
+from .common import (
+    DEFERRED,
+    detect_file_type,
+    finish_write,
+    get_owner,
+    get_web_path,
+    hash_file,
+    move_file,
+    plan_is_keyed,
+    plan_matches,
+    purge_owners,
+    record_file,
+    resolve_owners,
+    stat_file
+)
 import config
-import psycopg2
-import pathlib
-import datetime
-import magic
-import re
-import mimetypes
-import requests
-from psycopg2.extras import RealDictCursor
-from retry import retry
+import time
+
+
+def _write(connection, path, migration_id, web_path, new_filename, file_hash, stat, mime, file_ext, owners):
+    storage = connection.get()
+    updated_rows = 0
+    with throttle.acquire('db'):
+        # find and replace "inline" references, only in the posts the resolve stage found
+        for owner in owners:
+            updated_rows += storage.replace_in_post(web_path, new_filename, **owner)
+
+        if (not config.dry_run):
+            # log to general file tracking table, file post relationship (not discord) and sdkdd_migration_{migration_id}
+            file_id = record_file(storage, file_hash, stat, mime, file_ext)
+            if (updated_rows > 0):
+                storage.insert_post_relationships(file_id, path, owners, inline=True)
+            storage.log_migration(migration_id, web_path, new_filename, stat)
+        finish_write(storage)
+    return updated_rows
+
+
+def resolve_and_write(connection, path, migration_id, web_path, new_filename, file_hash, stat, mime, file_ext, hints: dict, keyed_only=False, defer_unowned=False):
+    """
+    The database stages on `connection` (a `StageConnection`). Returns `(step, owners, updated rows)`.
+    With `defer_unowned`, nothing is written for a file nothing references yet, and `updated rows` is `None`.
+    """
+    (step, owners) = run_stage(
+        'resolve', resolve_owners,
+        connection, resolve_inline, web_path, new_filename, stat, hints, keyed_only,
+        connection=connection
+    )
+    if (defer_unowned and not owners):
+        return (step, owners, None)
+    updated_rows = run_stage(
+        'write', _write,
+        connection, path, migration_id, web_path, new_filename, file_hash, stat, mime, file_ext, owners,
+        connection=connection
+    )
+    return (step, owners, updated_rows)
 
 
 @trace_unhandled_exceptions
-@retry(tries=5)
 def migrate_inline(
     path,
     migration_id,
     _service=None,
     _user_id=None,
     _post_id=None,
+    _plan=None,
+    _connection=None,
+    _defer_unowned=False
 ):
-    if not os.path.exists(path):
+    started = time.monotonic()
+    stat = run_stage('stat', stat_file, path)
+    if stat is None:
         return
 
-    # check if the file is special (symlink, hardlink, empty) and return if so
-    if os.path.islink(path) or os.path.getsize(path) == 0 or os.path.ismount(path):
-        return
+    web_path = get_web_path(path)
+    if not plan_matches(_plan, stat):
+        # hash and look up again if the file changed since `sdkdd.py plan`
+        _plan = None
+    file_hash = run_stage('hash', hash_file, path, stat, _plan)
+    (mime, file_ext, new_filename) = run_stage('detect', detect_file_type, path, file_hash, _plan)
 
-    if config.ignore_temp_files and path.endswith('.temp'):
-        return
-    
-    file_ext = os.path.splitext(path)[1]
-    web_path = path.replace(remove_suffix(config.data_dir, '/'), '')
-    service = _service or None
-    post_id = _post_id or None
-    user_id = _user_id or None
-    with open(path, 'rb') as f:
-        # get hash and filename
-        file_hash_raw = hashlib.sha256()
-        for chunk in iter(lambda: f.read(8192), b''):
-            file_hash_raw.update(chunk)
-        file_hash = file_hash_raw.hexdigest()
-        new_filename = os.path.join('/', file_hash[0:2], file_hash[2:4], file_hash)
-        
-        mime = magic.from_file(path, mime=True)
-        if (config.fix_extensions):
-            file_ext = mimetypes.guess_extension(mime or 'application/octet-stream', strict=False)
-            new_filename = new_filename + (re.sub('^.jpe$', '.jpg', file_ext or '.bin') if config.fix_jpe else file_ext or '.bin')
-        else:
-            new_filename = new_filename + (re.sub('^.jpe$', '.jpg', file_ext or '.bin') if config.fix_jpe else file_ext or '.bin')
-        
-        fname = pathlib.Path(path)
-        mtime = datetime.datetime.fromtimestamp(fname.stat().st_mtime)
-        ctime = datetime.datetime.fromtimestamp(fname.stat().st_ctime)
-
-        conn = psycopg2.connect(
-            host=config.database_host,
-            dbname=config.database_dbname,
-            user=config.database_user,
-            password=config.database_password,
-            port=5432,
-            cursor_factory=RealDictCursor
+    # (batches of small files share one, see src/scheduler.py)
+    connection = _connection or StageConnection()
+    try:
+        (step, owners, updated_rows) = resolve_and_write(
+            connection, path, migration_id, web_path, new_filename, file_hash, stat, mime, file_ext,
+            {'service': _service, 'user_id': _user_id, 'post_id': _post_id},
+            plan_is_keyed(_plan),
+            _defer_unowned
         )
+    finally:
+        connection.close()
+    if updated_rows is None:
+        # (`sdkdd.py watch`) its post or message isn't in yet, so leave it where that will point
+        return DEFERRED
 
-        # log to file tracking table
-        if (not config.dry_run):
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO files (hash, mtime, ctime, mime, ext) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash RETURNING id", (file_hash, mtime, ctime, mime, file_ext))
-            file_id = cursor.fetchone()['id']
-
-        updated_rows = 0
-        step = 99
-        if (service and user_id and post_id):
-            (_updated_rows, _) = replace_file_from_post(
-                conn,
-                service=service,
-                user_id=user_id,
-                post_id=post_id,
-                old_file=web_path,
-                new_file=new_filename
-            )
-            updated_rows = _updated_rows
-        # update "inline" path references in db, using different strategies to speed the operation up
-        # strat 1: attempt to scope out posts archived up to 1 hour after the file was modified (kemono data should almost never change)
-        if updated_rows == 0:
-            step = 1
-            (_updated_rows, post) = replace_file_from_post(
-                conn,
-                min_time=mtime,
-                max_time=mtime + datetime.timedelta(hours=1),
-                old_file=web_path,
-                new_file=new_filename
-            )
-            updated_rows = _updated_rows
-            if (post):
-                service = post['service']
-                user_id = post['user']
-                post_id = post['id']
-        
-        # NOTE: Check if filename is integer and use that for added time optimization.
-        # optimizations didn't work, simply find and replace references in inline text.
-        # ... this will take a very long time.
-        if updated_rows == 0:
-            step = 2
-            (_updated_rows, post) = replace_file_from_post(
-                conn,
-                old_file=web_path,
-                new_file=new_filename
-            )
-            updated_rows = _updated_rows
-            if (post):
-                service = post['service']
-                user_id = post['user']
-                post_id = post['id']
-        
-        # log file post relationship (not discord)
-        if (not config.dry_run and updated_rows > 0 and service and user_id and post_id):
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO file_post_relationships (file_id, filename, service, \"user\", post, inline) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING", (file_id, os.path.basename(path), service, user_id, post_id, True))
-
-        # log to sdkdd_migration_{migration_id} (see sdkdd.py for schema)
-        # log to general file tracking table (schema: serial id, hash, filename, locally stored path, remotely stored path?, last known mtime, last known ctime, extension, mimetype, service, user, post, contributor_user?)
-        if (not config.dry_run):
-            cursor = conn.cursor()
-            cursor.execute(f"INSERT INTO sdkdd_migration_{migration_id} (old_location, new_location, ctime, mtime) VALUES (%s, %s, %s, %s)", (web_path, new_filename, mtime, ctime))
-            cursor.close()
-
-        # commit db
-        if (config.dry_run):
-            conn.rollback()
-        else:
-            conn.commit()
-        
-        if (not config.dry_run):
-            new_filename_without_prefix = remove_prefix(new_filename, '/')
-            web_path_without_prefix = remove_prefix(web_path, '/')
-            # move to hashy location, do nothing if something is already there
-            # move thumbnail to hashy location
-            thumb_dir = config.thumb_dir or os.path.join(config.data_dir, 'thumbnail')
-            if os.path.isfile(os.path.join(thumb_dir, web_path_without_prefix)) and not os.path.isfile(os.path.join(thumb_dir, new_filename_without_prefix)):
-                os.makedirs(os.path.join(thumb_dir, file_hash[0:2], file_hash[2:4]), exist_ok=True)
-                os.rename(os.path.join(thumb_dir, web_path_without_prefix), os.path.join(thumb_dir, new_filename_without_prefix))
-            
-            if os.path.isfile(path) and not os.path.isfile(os.path.join(config.data_dir, new_filename_without_prefix)):
-                os.makedirs(os.path.join(config.data_dir, file_hash[0:2], file_hash[2:4]), exist_ok=True)
-                os.rename(path, os.path.join(config.data_dir, new_filename_without_prefix))
+    run_stage('move', move_file, path, file_hash, new_filename)
+    run_stage('purge', purge_owners, owners)
 
-        if (not config.dry_run and config.ban_url and service and user_id):
-            requests.request('BAN', f"{config.ban_url}/{service}/user/" + user_id)
-        
-        conn.close()
-        
-        # done!
-        if (service and user_id and post_id):
-            print(f'{web_path}\t{new_filename}\t({updated_rows} database entries updated; {service}/{user_id}/{post_id}, found at step {step})')
-        else:
-            print(f'{web_path}\t{new_filename}\t({updated_rows} database entries updated; no post/messages found)')
\ No newline at end of file
+    # done!
+    results.report(
+        kind='inline',
+        old_path=web_path,
+        new_path=new_filename,
+        hash=file_hash,
+        size=stat.st_size,
+        step=step,
+        rows=updated_rows,
+        owner=get_owner(owners),
+        seconds=time.monotonic() - started
+    )
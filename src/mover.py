@@ -0,0 +1,258 @@
+import collections
+import concurrent.futures
+import multiprocessing.util
+import os
+import re
+import threading
+import traceback
+
+import config
+
+from . import results
+from .stages import run_stage
+
+SHARD_NAMES = [f'{i:02x}' for i in range(256)]
+SHARD_NAME = re.compile('^[0-9a-f]{2}$')
+# `<hash>.<ext>`, as files are named in the hash tree
+HASHED_NAME = re.compile(r'^([0-9a-f]{64})(\.[^.]*)?$')
+
+
+def prepare_shard_tree(root: str):
+    """
+    Creates every `ab/cd` shard directory under `root` (256 * 256 of them) once,
+    so migrators never have to `makedirs` before moving a file in.
+    Returns `False` if the tree was already there.
+    """
+    # `ff/ff` is created last, so its existence means a previous run finished the tree
+    if os.path.isdir(os.path.join(root, SHARD_NAMES[-1], SHARD_NAMES[-1])):
+        return False
+
+    os.makedirs(root, exist_ok=True)
+    root_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for first in SHARD_NAMES:
+            try:
+                os.mkdir(first, dir_fd=root_fd)
+            except FileExistsError:
+                pass
+            first_fd = os.open(first, os.O_RDONLY | os.O_DIRECTORY, dir_fd=root_fd)
+            try:
+                for second in SHARD_NAMES:
+                    try:
+                        os.mkdir(second, dir_fd=first_fd)
+                    except FileExistsError:
+                        pass
+            finally:
+                os.close(first_fd)
+    finally:
+        os.close(root_fd)
+    return True
+
+
+def iter_shards(root: str):
+    """Yields every `ab/cd` directory of the hash tree under `root`."""
+    for first in sorted(os.listdir(root)):
+        if not SHARD_NAME.match(first) or not os.path.isdir(os.path.join(root, first)):
+            continue
+        for second in sorted(os.listdir(os.path.join(root, first))):
+            if SHARD_NAME.match(second):
+                yield os.path.join(root, first, second)
+
+
+class DirectoryCache:
+    """
+    Bounded cache of open directory file descriptors.
+    Descriptors are reference counted so one is never closed while another thread is renaming through it.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries = collections.OrderedDict()  # path -> [fd, refs]
+        self._lock = threading.Lock()
+
+    def acquire(self, path: str):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                entry[1] += 1
+                self._entries.move_to_end(path)
+                return entry[0]
+
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                # another thread opened it in the meantime
+                os.close(fd)
+                entry[1] += 1
+                return entry[0]
+            self._entries[path] = [fd, 1]
+            self._evict()
+            return fd
+
+    def release(self, path: str):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                entry[1] -= 1
+            self._evict()
+
+    def close(self):
+        with self._lock:
+            for (fd, _) in self._entries.values():
+                os.close(fd)
+            self._entries.clear()
+
+    def _evict(self):
+        if len(self._entries) <= self.size:
+            return
+        for path in list(self._entries):
+            if len(self._entries) <= self.size:
+                break
+            (fd, refs) = self._entries[path]
+            if refs == 0:
+                del self._entries[path]
+                os.close(fd)
+
+
+class Mover:
+    """
+    Moves files into the `ab/cd/<hash>.<ext>` tree under `root` from a small thread pool.
+    Renames go through cached directory descriptors instead of resolving full paths every time,
+    and like the migrators always did, nothing is overwritten if the target already exists.
+    `submit` buffers moves and sorts them by target shard before handing them to the threads (for bulk moves like
+    thumbnails); `move` hands one over right away and waits for it (for the migrators).
+    """
+
+    def __init__(self, root: str, threads: int = 4, batch_size: int = 256, cached_directories: int = 512):
+        self.root = root
+        self.batch_size = batch_size
+        self.directories = DirectoryCache(cached_directories)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='sdkdd-mover')
+        self._pending = []
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def submit(self, source: str, file_hash: str, new_name: str):
+        """Queues `source` to be moved to `<root>/<ab>/<cd>/<new_name>`. Errors are reported, not raised."""
+        with self._lock:
+            self._pending.append(((file_hash[0:2], file_hash[2:4]), source, new_name, None))
+            if len(self._pending) < self.batch_size:
+                return
+            batch = self._pending
+            self._pending = []
+        self._dispatch(batch)
+
+    def move(self, source: str, file_hash: str, new_name: str):
+        """
+        Moves `source` right away (along with whatever is pending), and waits for it, raising whatever the move raised.
+        For the migrators: a file is only reported as migrated once it's actually in the hash tree.
+        """
+        done = concurrent.futures.Future()
+        with self._lock:
+            self._pending.append(((file_hash[0:2], file_hash[2:4]), source, new_name, done))
+            batch = self._pending
+            self._pending = []
+        self._dispatch(batch)
+        done.result()
+
+    def flush(self):
+        """Moves everything still pending and waits for the threads to finish."""
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+        if batch:
+            self._dispatch(batch)
+        with self._lock:
+            futures = list(self._futures)
+        concurrent.futures.wait(futures)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
+        self.directories.close()
+
+    def _dispatch(self, batch):
+        # keep moves into the same shard together, so its directory inode stays hot
+        batch.sort(key=lambda move: move[0])
+        future = self._executor.submit(self._move_batch, batch)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard_future)
+
+    def _discard_future(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _move_batch(self, batch):
+        for (shard, source, new_name, done) in batch:
+            try:
+                if done:
+                    # (retried by the caller's move stage)
+                    self._move(shard, source, new_name)
+                    done.set_result(None)
+                else:
+                    run_stage('move', self._move, shard, source, new_name)
+            except Exception as error:
+                if done:
+                    done.set_exception(error)
+                else:
+                    results.report(step='move', old_path=source, error=traceback.format_exc())
+
+    def _move(self, shard, source, new_name):
+        (source_dir, source_name) = os.path.split(source)
+        target_dir = os.path.join(self.root, *shard)
+        try:
+            source_fd = self.directories.acquire(source_dir)
+        except FileNotFoundError:
+            return
+        try:
+            try:
+                target_fd = self.directories.acquire(target_dir)
+            except FileNotFoundError:
+                # shard tree wasn't prepared (or got pruned), create it the slow way
+                os.makedirs(target_dir, exist_ok=True)
+                target_fd = self.directories.acquire(target_dir)
+            try:
+                # do nothing if something is already there
+                try:
+                    os.stat(new_name, dir_fd=target_fd, follow_symlinks=False)
+                    return
+                except FileNotFoundError:
+                    pass
+                try:
+                    os.rename(source_name, new_name, src_dir_fd=source_fd, dst_dir_fd=target_fd)
+                except FileNotFoundError:
+                    pass
+            finally:
+                self.directories.release(target_dir)
+        finally:
+            self.directories.release(source_dir)
+
+
+_movers = {}
+_movers_lock = threading.Lock()
+
+
+def get_mover(root: str):
+    """Returns this process' mover for `root`, starting it (and its exit-time flush) on first use."""
+    with _movers_lock:
+        mover = _movers.get(root)
+        if not mover:
+            if not _movers:
+                # pool workers don't run atexit hooks, but they do run multiprocessing finalizers
+                multiprocessing.util.Finalize(None, close_movers, exitpriority=10)
+            # (only `move`d through, so there's nothing to batch)
+            mover = _movers[root] = Mover(root, threads=getattr(config, 'mover_threads', 4))
+        return mover
+
+
+def flush_movers():
+    for mover in _movers.values():
+        mover.flush()
+
+
+def close_movers():
+    for mover in _movers.values():
+        mover.close()
+    _movers.clear()
@@ -0,0 +1,94 @@
+import concurrent.futures
+import contextvars
+import os
+import threading
+
+import config
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from .utils import get_connection_parameters
+
+_pool = None
+_executor = None
+_pid = None
+_lock = threading.Lock()
+
+
+def get_partition_count():
+    return max(1, getattr(config, 'scan_partitions', 4))
+
+
+def _get_pool():
+    """This process' pool of read-only connections (and threads) for partitioned scans, created on first use."""
+    global _pool, _executor, _pid
+    with _lock:
+        if _pid != os.getpid():
+            # don't share connections with a parent process
+            _pool = ThreadedConnectionPool(0, get_partition_count(), cursor_factory=RealDictCursor, **get_connection_parameters())
+            _executor = concurrent.futures.ThreadPoolExecutor(get_partition_count(), thread_name_prefix='sdkdd-scan')
+            _pid = os.getpid()
+        return (_pool, _executor)
+
+
+def scan_partitions(scan, stop_at_first_match=False):
+    """
+    Runs a full table scan as `scan_partitions` smaller ones at once, each on its own connection:
+    `scan(conn, partition)` is called for every `partition` (a `(partitions, index)` tuple, see `PARTITION_MATCH`)
+    and should return a list of owners. Returns all the owners found, in every partition.
+    With `stop_at_first_match` (for lookups that can only find one owner), the scans still running are cancelled
+    once a partition finds something.
+    """
+    partitions = get_partition_count()
+    (pool, executor) = _get_pool()
+    cancelled = threading.Event()
+    active = {}
+    active_lock = threading.Lock()
+
+    def cancel():
+        cancelled.set()
+        with active_lock:
+            for conn in active.values():
+                conn.cancel()
+
+    def run(index):
+        if cancelled.is_set():
+            return []
+        conn = pool.getconn()
+        try:
+            if not conn.readonly:
+                conn.readonly = True
+            with active_lock:
+                active[index] = conn
+            try:
+                return scan(conn, (partitions, index))
+            except psycopg2.extensions.QueryCanceledError:
+                if cancelled.is_set():
+                    return []
+                raise
+            finally:
+                with active_lock:
+                    del active[index]
+        finally:
+            try:
+                conn.rollback()
+                pool.putconn(conn)
+            except psycopg2.Error:
+                pool.putconn(conn, close=True)
+
+    # (in a copy of the caller's context, so queries are still tagged when instrumenting)
+    futures = [executor.submit(contextvars.copy_context().run, run, index) for index in range(partitions)]
+    owners = []
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            found = future.result()
+            owners.extend(found)
+            if found and stop_at_first_match and not cancelled.is_set():
+                cancel()
+    except:
+        # don't leave scans running (or connections checked out) behind
+        cancel()
+        concurrent.futures.wait(futures)
+        raise
+    return owners
@@ -0,0 +1,157 @@
+import collections
+import datetime
+import multiprocessing
+import os
+import sqlite3
+import traceback
+
+import config
+
+from .hashing import hash_file
+from .resolver import RESOLVERS
+from .scanner import iter_work
+from .sniff import sniff_mime
+from .storage import PostgresStorage, open_storage
+from .utils import get_hashed_filename, remove_suffix
+
+BATCH_SIZE = 1000
+OWNER_KEYS = ('service', 'user_id', 'post_id', 'server_id', 'channel_id', 'message_id')
+
+_storage = None
+
+
+def _open_plan(plan_file: str):
+    plan_conn = sqlite3.connect(plan_file)
+    plan_conn.execute('''
+        CREATE TABLE IF NOT EXISTS plan (
+            kind text NOT NULL,
+            path text PRIMARY KEY,
+            new_path text NOT NULL,
+            hash text NOT NULL,
+            mime text,
+            ext text,
+            size integer NOT NULL,
+            mtime real NOT NULL,
+            service text,
+            user_id text,
+            post_id text,
+            server_id text,
+            channel_id text,
+            message_id text,
+            step integer,
+            rows integer NOT NULL
+        )
+    ''')
+    return plan_conn
+
+
+def plan_one(work):
+    """
+    Works out what `migrate_*` would do with one file: its hash path, and which post or message owns it,
+    using only read-only lookups. Returns a `plan` row, or `None` for files the migrators skip.
+    """
+    global _storage
+    (kind, path, owner) = work
+    try:
+        if os.path.islink(path) or not os.path.isfile(path) or os.path.getsize(path) == 0 or os.path.ismount(path):
+            return None
+        if config.ignore_temp_files and path.endswith('.temp'):
+            return None
+
+        stat = os.stat(path)
+        file_hash = hash_file(path)
+        mime = sniff_mime(path)
+        (new_filename, file_ext) = get_hashed_filename(file_hash, os.path.splitext(path)[1], mime)
+        web_path = path.replace(remove_suffix(config.data_dir, '/'), '')
+
+        if not _storage:
+            _storage = open_storage()
+            if isinstance(_storage, PostgresStorage):
+                # (not autocommit: scans use server-side cursors, which need a transaction)
+                _storage.conn.set_session(readonly=True)
+        try:
+            (step, owners) = RESOLVERS[kind](
+                _storage,
+                web_path,
+                new_filename,
+                datetime.datetime.fromtimestamp(stat.st_mtime),
+                **{key.lstrip('_'): value for (key, value) in owner.items()}
+            )
+        finally:
+            _storage.rollback()
+        rows = len(owners)
+        found_owner = owners[0] if owners else {}
+        return (
+            kind, web_path, new_filename, file_hash, mime, file_ext, stat.st_size, stat.st_mtime,
+            *[found_owner.get(key) for key in OWNER_KEYS],
+            step, rows
+        )
+    except:
+        print('Exception in plan_one on file ' + path)
+        traceback.print_exc()
+        return None
+
+
+def plan(plan_file: str):
+    """
+    Writes a plan of the whole migration to `plan_file` (SQLite), without changing or moving anything.
+    Files already in the plan are skipped, so an interrupted plan can be resumed.
+    """
+    plan_conn = _open_plan(plan_file)
+    data_dir = remove_suffix(config.data_dir, '/')
+    planned = {path for (path,) in plan_conn.execute('SELECT path FROM plan')}
+    work = (item for item in iter_work() if item[1].replace(data_dir, '') not in planned)
+
+    with multiprocessing.Pool(config.processes or multiprocessing.cpu_count()) as pool:
+        batch = []
+        for row in pool.imap_unordered(plan_one, work, chunksize=16):
+            if not row:
+                continue
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                plan_conn.executemany(f"INSERT OR REPLACE INTO plan VALUES ({', '.join(['?'] * 16)})", batch)
+                plan_conn.commit()
+                batch = []
+        if batch:
+            plan_conn.executemany(f"INSERT OR REPLACE INTO plan VALUES ({', '.join(['?'] * 16)})", batch)
+            plan_conn.commit()
+
+    print_plan_summary(plan_conn)
+    plan_conn.close()
+
+
+def print_plan_summary(plan_conn):
+    for (kind, files, size, rows, unresolved) in plan_conn.execute('''
+        SELECT kind, count(*), sum(size), sum(rows), sum(step IS NULL)
+        FROM plan
+        GROUP BY kind
+    '''):
+        print(f'{kind}: {files} files, {size} bytes, ~{rows} database entries to update, {unresolved} without a post/message')
+    steps = collections.Counter(dict(plan_conn.execute('SELECT coalesce(step, -1), count(*) FROM plan GROUP BY step')))
+    print('found at step: ' + ', '.join(f"{step if step >= 0 else 'none'}: {count}" for (step, count) in sorted(steps.items())))
+    (duplicates,) = plan_conn.execute('SELECT count(*) - count(DISTINCT hash) FROM plan').fetchone()
+    print(f'{duplicates} files are duplicates of other planned files.')
+
+
+def iter_planned_work(plan_file: str):
+    """
+    Yields `(kind, path, owner)` for every planned file, with `owner` carrying the plan itself to the migrator.
+    Files with one owner are only looked up by it; ones with several are resolved in full again (see `plan_is_keyed`).
+    """
+    plan_conn = sqlite3.connect(plan_file)
+    plan_conn.row_factory = sqlite3.Row
+    for row in plan_conn.execute('SELECT * FROM plan ORDER BY kind, path'):
+        # (only the first owner is in the plan. with more, the migrator has to find them all again)
+        keyed = row['rows'] <= 1
+        owner = {f'_{key}': row[key] for key in OWNER_KEYS if keyed and row[key] is not None}
+        owner['_plan'] = {
+            'keyed': keyed,
+            'hash': row['hash'],
+            'mime': row['mime'],
+            'ext': row['ext'],
+            'new_path': row['new_path'],
+            'size': row['size'],
+            'mtime': row['mtime']
+        }
+        yield (row['kind'], os.path.join(config.data_dir, row['path'].lstrip('/')), owner)
+    plan_conn.close()
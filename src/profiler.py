@@ -0,0 +1,97 @@
+import collections
+import cProfile
+import glob
+import multiprocessing.util
+import os
+import pstats
+import sys
+import threading
+
+import config
+
+from .stages import active_stages
+
+_profile = None
+_sampler = None
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the stacks of the threads doing migration work every `interval` seconds, counted by collapsed stack
+    (`root;caller;...;callee`, what flamegraph tools read). Stacks are rooted at the stage the thread is running
+    (`stage:hash`, `stage:resolve`...), so time can be split by stage; the main thread between files is `idle`.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name='sdkdd-sampler', daemon=True)
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stopping = threading.Event()
+
+    def run(self):
+        main_thread = threading.main_thread().ident
+        while not self._stopping.wait(self.interval):
+            for (thread, frame) in sys._current_frames().items():
+                stage = active_stages.get(thread)
+                if not stage and thread != main_thread:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':'))
+                    frame = frame.f_back
+                stack.append(f'stage:{stage}' if stage else 'idle')
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+
+def start(profile_dir: str):
+    """Starts profiling this worker (from the pool initializer). Its profile is written to `profile_dir` when it exits."""
+    global _profile, _sampler
+    _sampler = Sampler(getattr(config, 'profile_interval_ms', 10) / 1000)
+    _sampler.start()
+    if getattr(config, 'profile_deterministic', True):
+        _profile = cProfile.Profile()
+        _profile.enable()
+    # after the movers have flushed (see `get_mover`)
+    multiprocessing.util.Finalize(None, _write, args=(profile_dir,), exitpriority=1)
+
+
+def _write(profile_dir: str):
+    if _profile:
+        _profile.disable()
+        _profile.dump_stats(os.path.join(profile_dir, f'worker_{os.getpid()}.pstats'))
+    _sampler.stop()
+    with open(os.path.join(profile_dir, f'worker_{os.getpid()}.collapsed'), 'w') as f:
+        for (stack, count) in _sampler.counts.items():
+            f.write(f'{stack} {count}\n')
+
+
+def merge(profile_dir: str, output: str):
+    """
+    Merges every worker's profile in `profile_dir` into `<output>.pstats` (cProfile, for `pstats`/snakeviz)
+    and `<output>.collapsed` (sampled stacks, for flamegraph.pl/speedscope), and prints time per stage.
+    """
+    pstats_files = glob.glob(os.path.join(profile_dir, '*.pstats'))
+    if pstats_files:
+        pstats.Stats(*pstats_files).dump_stats(f'{output}.pstats')
+
+    counts = collections.Counter()
+    for path in glob.glob(os.path.join(profile_dir, '*.collapsed')):
+        with open(path) as f:
+            for line in f:
+                (stack, count) = line.rstrip('\n').rsplit(' ', 1)
+                counts[stack] += int(count)
+    with open(f'{output}.collapsed', 'w') as f:
+        for (stack, count) in counts.most_common():
+            f.write(f'{stack} {count}\n')
+
+    by_root = collections.Counter()
+    for (stack, count) in counts.items():
+        by_root[stack.split(';', 1)[0]] += count
+    total = sum(by_root.values()) or 1
+    print('sampled time by stage: ' + ', '.join(f'{root} {count / total:.1%}' for (root, count) in by_root.most_common()))
+    print(f'Profile written to {output}.collapsed' + (f' and {output}.pstats.' if pstats_files else '.'))
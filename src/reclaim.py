@@ -0,0 +1,192 @@
+import itertools
+import multiprocessing
+import os
+import re
+import sqlite3
+
+import config
+
+from .hashing import hash_file
+from .migrators.common import get_web_path
+from .sweep import LEGACY_PREFIXES, iter_discord_references, iter_post_references
+from .utils import get_connection, iter_files, remove_prefix
+
+LEGACY_ROOTS = ('files', 'attachments', 'inline')
+ACTIONS = ('report', 'delete', 'hardlink')
+BATCH_SIZE = 500
+# a legacy path anywhere in a post's content, not just in `<img>` tags, up to the end of the quoted value
+LEGACY_REFERENCE = re.compile(r'''(?:https://kemono\.party)?(/(?:files|attachments|inline)/[^"'<>]+)''')
+
+
+def find_hashed_file(file_hash: str, ext: str):
+    """Returns the path of `file_hash` in the hash tree, or `None` if it isn't on disk."""
+    shard = os.path.join(config.data_dir, file_hash[0:2], file_hash[2:4])
+    candidates = [file_hash + (ext or '.bin'), file_hash + re.sub('^.jpe$', '.jpg', ext or '.bin')]
+    for candidate in candidates:
+        if os.path.isfile(os.path.join(shard, candidate)):
+            return os.path.join(shard, candidate)
+
+    # extension was fixed differently than recorded, look for anything with the same hash
+    try:
+        with os.scandir(shard) as it:
+            for entry in it:
+                if entry.name.startswith(file_hash + '.') and entry.is_file():
+                    return entry.path
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def _hash_leftover(path: str):
+    try:
+        return (path, os.path.getsize(path), hash_file(path), None)
+    except OSError as e:
+        return (path, 0, None, str(e))
+
+
+def _open_state(state_file: str):
+    state = sqlite3.connect(state_file)
+    state.execute('''
+        CREATE TABLE IF NOT EXISTS reclaimed (
+            path text PRIMARY KEY,
+            size integer NOT NULL,
+            hash text,
+            hashed_path text,
+            status text NOT NULL
+        )
+    ''')
+    return state
+
+
+def _iter_leftovers(done: set):
+    for root in LEGACY_ROOTS:
+        if not os.path.isdir(os.path.join(config.data_dir, root)):
+            continue
+        for entry in iter_files(os.path.join(config.data_dir, root)):
+            if entry.is_symlink() or entry.path in done or entry.path.endswith('.sdkdd-reclaim'):
+                continue
+            if config.ignore_temp_files and entry.path.endswith('.temp'):
+                continue
+            yield entry.path
+
+
+def _settle(action: str, leftover: str, size: int, hashed_path: str):
+    """Verifies `leftover` against its copy in the hash tree and applies `action`, returning the new status."""
+    try:
+        hashed_stat = os.stat(hashed_path)
+        leftover_stat = os.stat(leftover, follow_symlinks=False)
+    except FileNotFoundError:
+        return 'missing'
+    if hashed_stat.st_size != size:
+        return 'size_mismatch'
+
+    try:
+        if action == 'delete':
+            os.unlink(leftover)
+            return 'deleted'
+        if action == 'hardlink':
+            if (hashed_stat.st_dev, hashed_stat.st_ino) == (leftover_stat.st_dev, leftover_stat.st_ino):
+                return 'hardlinked'
+            temp_path = leftover + '.sdkdd-reclaim'
+            os.link(hashed_path, temp_path)
+            try:
+                os.replace(temp_path, leftover)
+            except OSError:
+                os.unlink(temp_path)
+                raise
+            return 'hardlinked'
+    except OSError as e:
+        # (EXDEV if the hash tree is on another filesystem, EPERM/EACCES...) only this file is given up on
+        print(f'{leftover}\t{action} failed ({e})')
+        return 'error'
+    return 'duplicate'
+
+
+def find_legacy_references():
+    """
+    Every legacy path a post or Discord message still references, as it would if its own migration failed while
+    a duplicate of it went through. One streamed pass over `posts` and `discord_posts`, instead of a lookup per leftover.
+    """
+    referenced = set()
+    for (_, _, _, path) in itertools.chain(iter_post_references(LEGACY_REFERENCE), iter_discord_references()):
+        path = remove_prefix(path, 'https://kemono.party')
+        if path.startswith(LEGACY_PREFIXES):
+            referenced.add(path)
+            # (unquoted in content, the path ends at the first space)
+            referenced.add(path.split()[0])
+    return referenced
+
+
+def _process_batch(pg_conn, referenced: set, state, action: str, batch: list, totals: dict):
+    hashes = list({file_hash for (_, _, file_hash, _) in batch if file_hash})
+    known = {}
+    if hashes:
+        with pg_conn.cursor() as cursor:
+            cursor.execute('SELECT hash, ext FROM files WHERE hash = ANY(%s)', (hashes,))
+            known = dict(cursor.fetchall())
+        pg_conn.rollback()
+
+    rows = []
+    for (path, size, file_hash, error) in batch:
+        hashed_path = None
+        if error:
+            status = 'error'
+            print(f'{path}\tcould not be hashed ({error})')
+        elif file_hash not in known:
+            status = 'unknown'
+        else:
+            hashed_path = find_hashed_file(file_hash, known[file_hash])
+            if not hashed_path:
+                status = 'not_on_disk'
+            elif action != 'report' and get_web_path(path) in referenced:
+                status = 'referenced'
+                print(f'{path}\tis still referenced, and was left alone')
+            else:
+                status = _settle(action, path, size, hashed_path)
+        if status in ('duplicate', 'deleted', 'hardlinked'):
+            totals['bytes'] += size
+            totals['files'] += 1
+            print(f'{path}\t{hashed_path}\t({status}, {size} bytes)')
+        totals['seen'] += 1
+        rows.append((path, size, file_hash, hashed_path, status))
+
+    state.executemany('INSERT OR REPLACE INTO reclaimed (path, size, hash, hashed_path, status) VALUES (?, ?, ?, ?, ?)', rows)
+    state.commit()
+
+
+def reclaim(action: str = 'report', state_file: str = 'sdkdd_reclaim.db'):
+    """
+    Hashes everything left in the legacy trees in parallel, and for each leftover whose digest is both
+    in the `files` table and on disk in the hash tree, deletes it, replaces it with a hardlink, or just reports it.
+    Nothing is deleted or replaced while a post or message still references it by its legacy path.
+    Progress is kept in `state_file`, so an interrupted run resumes where it stopped.
+    """
+    state = _open_state(state_file)
+    # leftovers that weren't verified duplicates get checked again, they might have been migrated since
+    settled = ('deleted', 'hardlinked') if action != 'report' else ('duplicate', 'deleted', 'hardlinked')
+    done = {path for (path,) in state.execute(f"SELECT path FROM reclaimed WHERE status IN ({', '.join('?' * len(settled))})", settled)}
+
+    referenced = set()
+    if action != 'report':
+        referenced = find_legacy_references()
+        print(f'{len(referenced)} legacy paths are still referenced, and will be left alone.')
+    pg_conn = get_connection()
+    totals = {'seen': 0, 'files': 0, 'bytes': 0}
+    with multiprocessing.Pool(config.processes or multiprocessing.cpu_count()) as pool:
+        batch = []
+        for result in pool.imap_unordered(_hash_leftover, _iter_leftovers(done), chunksize=64):
+            batch.append(result)
+            if len(batch) >= BATCH_SIZE:
+                _process_batch(pg_conn, referenced, state, action, batch, totals)
+                batch = []
+        if batch:
+            _process_batch(pg_conn, referenced, state, action, batch, totals)
+
+    pg_conn.close()
+
+    print(f"\n{totals['seen']} leftovers checked this run; {totals['files']} verified duplicates ({totals['bytes']} bytes).")
+    for (status, label) in (('duplicate', 'reclaimable'), ('deleted', 'deleted'), ('hardlinked', 'replaced with hardlinks')):
+        (files, size) = state.execute('SELECT count(*), coalesce(sum(size), 0) FROM reclaimed WHERE status = ?', (status,)).fetchone()
+        if files:
+            print(f'{files} files, {size} bytes {label} in total.')
+    state.close()
@@ -0,0 +1,176 @@
+import datetime
+
+import config
+
+from . import instrument
+from .partitions import get_partition_count, scan_partitions
+from .storage import PostgresStorage, get_backend
+from .window_cache import find_file_owners_in_window, find_posts_in_window, get_window_cache
+
+# `(step, owners)` when nothing references the file
+UNRESOLVED = (None, [])
+
+
+def find_file_owners(storage, web_path: str, new_filename: str, **keys):
+    """The keys of the posts whose `file` is `web_path` (or already `new_filename`), narrowed down by `keys`."""
+    return storage.find_file_owners(web_path, new_filename, **keys)
+
+
+def find_posts_with_file(storage, web_path: str, new_filename: str, **keys):
+    """The keys of the posts referencing `web_path` anywhere (content, file or attachments), narrowed down by `keys`."""
+    return storage.find_post_owners(web_path, new_filename, **keys)
+
+
+def find_discord_owners(storage, web_path: str, new_filename: str, **keys):
+    """The keys of the Discord messages with `web_path` as an attachment, narrowed down by `keys`."""
+    return storage.find_discord_owners(web_path, new_filename, **keys)
+
+
+def guess_discord_keys(web_path: str):
+    """
+    The server, channel and message a legacy Discord attachment belongs to going by its path
+    (`/attachments/.../<server>/<channel>/<message>/<filename>`), or `None` if it's too short to be one.
+    """
+    segments = web_path.split('/')
+    if (len(segments) < 6):
+        return None
+    return {'server_id': segments[-4], 'channel_id': segments[-3], 'message_id': segments[-2]}
+
+
+def resolve_file(
+    storage,
+    web_path: str,
+    new_filename: str,
+    mtime: datetime.datetime,
+    keyed_only=False,
+    service=None,
+    user_id=None,
+    post_id=None
+):
+    """
+    Finds the posts whose `file` is `web_path` (or already `new_filename`), without changing anything.
+    Tries the given keys first, then the lookup strategies from cheapest to a full table scan, unless `keyed_only`.
+    Returns `(step, owners)`: the strategy that found them, and each post's `service`, `user_id` and `post_id`.
+    """
+    lookups = []
+    if (service and user_id and post_id):
+        lookups.append((99, find_file_owners, {'service': service, 'user_id': user_id, 'post_id': post_id}))
+    if (not keyed_only):
+        # strat 1: attempt to derive the user and post id from the original path
+        if (len(web_path.split('/')) >= 4):
+            lookups.append((1, find_file_owners, {'user_id': web_path.split('/')[-3], 'post_id': web_path.split('/')[-2]}))
+        # strat 2: attempt to scope out posts archived up to 1 hour after the file was modified (kemono data should almost never change)
+        lookups.append((2, _in_window(find_file_owners, find_file_owners_in_window), {'min_time': mtime, 'max_time': mtime + datetime.timedelta(hours=1)}))
+        # optimizations didn't work, scan the entire table
+        lookups.append((3, find_file_owners, {}))
+    return _resolve_with('files', storage, web_path, new_filename, lookups)
+
+
+def resolve_attachment(
+    storage,
+    web_path: str,
+    new_filename: str,
+    mtime: datetime.datetime,
+    keyed_only=False,
+    service=None,
+    user_id=None,
+    post_id=None,
+    server_id=None,
+    channel_id=None,
+    message_id=None
+):
+    """Finds the posts or Discord messages with `web_path` as an attachment. See `resolve_file`."""
+    if (server_id and channel_id and message_id):
+        # known to be a Discord attachment (discord_dumper.py, `discord_sql`)
+        return resolve_discord_attachment(storage, web_path, new_filename, mtime, keyed_only, server_id, channel_id, message_id)
+    lookups = []
+    if (service and user_id and post_id):
+        lookups.append((99, find_posts_with_file, {'service': service, 'user_id': user_id, 'post_id': post_id}))
+    if (not keyed_only):
+        if (len(web_path.split('/')) >= 4):
+            lookups.append((1, find_posts_with_file, {'user_id': web_path.split('/')[-3], 'post_id': web_path.split('/')[-2]}))
+        lookups.extend(_discord_guesses(web_path))
+        lookups.append((4, _in_window(find_posts_with_file, find_posts_in_window), {'min_time': mtime, 'max_time': mtime + datetime.timedelta(hours=1)}))
+        lookups.append((5, find_posts_with_file, {}))
+        lookups.append((6, find_discord_owners, {}))
+    return _resolve_with('attachments', storage, web_path, new_filename, lookups)
+
+
+def resolve_discord_attachment(
+    storage,
+    web_path: str,
+    new_filename: str,
+    mtime: datetime.datetime,
+    keyed_only=False,
+    server_id=None,
+    channel_id=None,
+    message_id=None
+):
+    """Finds the Discord messages with `web_path` as an attachment, without looking at posts. See `resolve_file`."""
+    lookups = []
+    if (server_id and channel_id and message_id):
+        lookups.append((99, find_discord_owners, {'server_id': server_id, 'channel_id': channel_id, 'message_id': message_id}))
+    if (not keyed_only):
+        lookups.extend(_discord_guesses(web_path))
+        lookups.append((6, find_discord_owners, {}))
+    return _resolve_with('attachments', storage, web_path, new_filename, lookups)
+
+
+def _discord_guesses(web_path: str):
+    """strat 2: the message the path says it belongs to. strat 3: any message in that channel (indexed, unlike a full scan)."""
+    keys = guess_discord_keys(web_path)
+    if not keys:
+        return []
+    return [(2, find_discord_owners, keys), (3, find_discord_owners, {'channel_id': keys['channel_id']})]
+
+
+def resolve_inline(
+    storage,
+    web_path: str,
+    new_filename: str,
+    mtime: datetime.datetime,
+    keyed_only=False,
+    service=None,
+    user_id=None,
+    post_id=None
+):
+    """Finds the posts with `web_path` inlined in their content. See `resolve_file`."""
+    lookups = []
+    if (service and user_id and post_id):
+        lookups.append((99, find_posts_with_file, {'service': service, 'user_id': user_id, 'post_id': post_id}))
+    if (not keyed_only):
+        lookups.append((1, _in_window(find_posts_with_file, find_posts_in_window), {'min_time': mtime, 'max_time': mtime + datetime.timedelta(hours=1)}))
+        # NOTE: Check if filename is integer and use that for added time optimization.
+        lookups.append((2, find_posts_with_file, {}))
+    return _resolve_with('inline', storage, web_path, new_filename, lookups)
+
+
+def _in_window(find, find_in_window):
+    """The window cache's version of a time window lookup, unless the cache is turned off (or there's no Postgres to cache)."""
+    return find_in_window if get_backend() == 'postgres' and get_window_cache() else find
+
+
+def _resolve_with(kind, storage, web_path, new_filename, lookups):
+    for (step, find, keys) in lookups:
+        with instrument.lookup(kind, step) as lookup:
+            if (not keys and storage.partitioned and get_partition_count() > 1):
+                # full table scans are split up and run in parallel. a legacy discord attachment belongs to one message,
+                # so that scan can stop at the first partition finding it; posts can share a file, so theirs can't
+                stop_at_first_match = find is find_discord_owners and getattr(config, 'scan_stop_at_first_match', False)
+                owners = scan_partitions(
+                    lambda conn, partition: find(PostgresStorage(conn), web_path, new_filename, partition=partition),
+                    stop_at_first_match
+                )
+            else:
+                owners = find(storage, web_path, new_filename, **keys)
+            lookup['found'] = bool(owners)
+        if owners:
+            return (step, owners)
+    return UNRESOLVED
+
+
+RESOLVERS = {
+    'files': resolve_file,
+    'attachments': resolve_attachment,
+    'inline': resolve_inline,
+}
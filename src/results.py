@@ -0,0 +1,159 @@
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import config
+
+_queue = None
+# (process start, initializer done) until this worker's first file is reported
+_startup = None
+
+
+def install(result_queue, started=None):
+    """
+    Makes `report` in this process send records to `result_queue`. Called from the pool initializer.
+    With `started` (when the process started), how long it took to get to its first file is reported along with it.
+    """
+    global _queue, _startup
+    _queue = result_queue
+    if started:
+        _startup = (started, time.time())
+
+
+def installed():
+    return _queue is not None
+
+
+def format_record(record: dict):
+    """The human-readable line migrators used to print for every file."""
+    if record.get('error'):
+        return f"Exception in {record.get('step') or 'migration'} on file {record.get('old_path')}\n{record['error']}"
+    owner = record.get('owner')
+    if owner and owner.get('server_id'):
+        found = f"discord/{owner['server_id']}/{owner['channel_id']}/{owner['message_id']}, found at step {record['step']}"
+    elif owner:
+        found = f"{owner['service']}/{owner['user_id']}/{owner['post_id']}, found at step {record['step']}"
+    else:
+        found = 'no post/messages found'
+    return f"{record['old_path']}\t{record['new_path']}\t({record['rows']} database entries updated; {found})"
+
+
+def report(**record):
+    """
+    Sends a result record (old/new path, hash, step, rows updated, owner keys, timing, error...) to the result log.
+    Outside of a migration pool, the record is printed the way it always was instead.
+    """
+    global _startup
+    record['pid'] = os.getpid()
+    record['time'] = time.time()
+    if _queue is None:
+        print(format_record(record))
+        return
+    if _startup and record.get('old_path'):
+        (started, ready) = _startup
+        _startup = None
+        _queue.put({'kind': 'worker_startup', 'pid': record['pid'], 'time': record['time'], 'bootstrap': ready - started, 'first_file': record['time'] - started})
+    _queue.put(record)
+
+
+class ResultLog(threading.Thread):
+    """
+    Collects result records from every worker over a queue, and is the only thing writing them out:
+    buffered to `sdkdd_results_<migration_id>.jsonl` (rotated every `results_rotate_mb` megabytes),
+    with a summary printed to the console every `results_summary_interval` seconds instead of a line per file.
+    """
+
+    def __init__(self, migration_id, context=None):
+        super().__init__(name='sdkdd-results', daemon=True)
+        self.queue = (context or multiprocessing).Queue()
+        self.base_path = f'sdkdd_results_{migration_id}'
+        self.rotate_bytes = getattr(config, 'results_rotate_mb', 256) * 1024 * 1024
+        self.summary_interval = getattr(config, 'results_summary_interval', 10)
+        self.rotations = 0
+        self.counts = {'files': 0, 'found': 0, 'rows': 0, 'errors': 0, 'bytes': 0}
+        # per-step query counters from each worker, when `instrument_queries` is on (see src/instrument.py)
+        self.query_stats = []
+        # seconds from process start to initialized, and to the first file done, for each worker
+        self.startups = []
+        self.started = time.monotonic()
+        self._file = None
+        # bytes in the current file. (`tell()` would flush the write buffer on every record)
+        self._written = 0
+
+    def _open(self):
+        self._file = open(self.base_path + '.jsonl', 'a', buffering=1024 * 1024)
+        self._written = os.path.getsize(self.base_path + '.jsonl')
+
+    def _rotate(self):
+        self._file.close()
+        self.rotations += 1
+        os.replace(self.base_path + '.jsonl', f'{self.base_path}.{self.rotations}.jsonl')
+        self._open()
+
+    def run(self):
+        self._open()
+        last_summary = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=1)
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record:
+                self.write(record)
+            if time.monotonic() - last_summary >= self.summary_interval:
+                self._file.flush()
+                print(self.summary())
+                last_summary = time.monotonic()
+        self._file.close()
+
+    def write(self, record: dict):
+        if record.get('kind') == 'query_stats':
+            self.query_stats.append(record)
+        elif record.get('kind') == 'worker_startup':
+            self.startups.append((record['bootstrap'], record['first_file']))
+        elif record.get('error'):
+            self.counts['errors'] += 1
+            # errors are rare and worth seeing right away
+            print(format_record(record))
+        elif record.get('new_path'):
+            self.counts['files'] += 1
+            self.counts['rows'] += record.get('rows') or 0
+            self.counts['bytes'] += record.get('size') or 0
+            if record.get('owner'):
+                self.counts['found'] += 1
+        # (ascii only, so characters are bytes)
+        line = json.dumps(record, default=str) + '\n'
+        self._file.write(line)
+        self._written += len(line)
+        if self._written >= self.rotate_bytes:
+            self._rotate()
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (
+            f"({self.counts['files']} files migrated, {self.counts['found']} with a post/message, "
+            f"{self.counts['rows']} database entries updated, {self.counts['errors']} errors; "
+            f"{self.counts['files'] / elapsed:.1f} files/s, {self.counts['bytes'] / elapsed / 1024 / 1024:.1f} MiB/s)"
+        )
+
+    def startup_summary(self):
+        if not self.startups:
+            return None
+        bootstrap = sorted(startup[0] for startup in self.startups)
+        first_file = sorted(startup[1] for startup in self.startups)
+        return (
+            f'(worker startup: {len(self.startups)} workers, {bootstrap[len(bootstrap) // 2] * 1000:.0f} ms to initialize '
+            f'and {first_file[len(first_file) // 2] * 1000:.0f} ms to the first file (median), {first_file[-1] * 1000:.0f} ms at worst)'
+        )
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+        print(self.summary())
+        if self.startup_summary():
+            print(self.startup_summary())
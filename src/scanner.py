@@ -0,0 +1,137 @@
+import itertools
+import os
+import sqlite3
+
+import config
+
+from .migrators.attachments import migrate_attachment
+from .migrators.files import migrate_file
+from .migrators.inline import migrate_inline
+from .utils import iter_files, remove_prefix
+
+# legacy tree (under `data_dir`) -> migrator for the files in it
+MIGRATORS = {
+    'files': migrate_file,
+    'attachments': migrate_attachment,
+    'inline': migrate_inline,
+}
+
+
+def kind_of(web_path: str):
+    """Returns which legacy tree (`files`, `attachments`, `inline`) a web path like `/files/...` is in, if any."""
+    kind = web_path.lstrip('/').split('/', 1)[0]
+    return kind if kind in MIGRATORS else None
+
+
+def iter_legacy_work():
+    """Yields `(kind, path, owner)` for every file in the legacy trees enabled by the `scan_*` options."""
+    for kind in MIGRATORS:
+        if not getattr(config, f'scan_{kind}'):
+            continue
+        if not os.path.exists(os.path.join(config.data_dir, kind)):
+            print(f'"{kind}" directory is missing, and will be skipped.')
+            continue
+        for entry in iter_files(os.path.join(config.data_dir, kind)):
+            yield (kind, entry.path, {})
+
+
+def iter_sql_file_work():
+    """
+    Yields `(kind, path, owner)` for every file listed in `sql_file` that wasn't migrated yet,
+    with `owner` holding the post (or Discord message) keys to pass on to the migrator.
+    """
+    sqlite_conn = sqlite3.connect(config.sql_file)
+    if config.discord_sql:
+        messages_to_fix = sqlite_conn.execute('''
+            SELECT
+                discord_posts_dump.discord_server_id,
+                discord_posts_dump.discord_channel_id,
+                discord_posts_dump.discord_message_id,
+                discord_posts_dump.file_path
+            FROM discord_posts_dump, hashdeep_to_migrate
+            WHERE
+                discord_posts_dump.file_path = hashdeep_to_migrate.path
+                AND discord_posts_dump.file_path not in (
+                  SELECT a.file_path
+                  FROM discord_posts_dump a, migration_log b
+                  WHERE b.migration_original_path = a.file_path
+                )
+        ''')
+        for (message_server, message_channel, message_id, file_location) in messages_to_fix:
+            if file_location.startswith('/attachments/') and config.scan_attachments:
+                yield ('attachments', os.path.join(config.data_dir, remove_prefix(file_location, '/')), {
+                    '_server_id': message_server,
+                    '_channel_id': message_channel,
+                    '_message_id': message_id
+                })
+    else:
+        posts_to_fix = sqlite_conn.execute('''
+            SELECT
+                posts_dump.service,
+                posts_dump.user_id,
+                posts_dump.post_id,
+                posts_dump.file_path
+            FROM posts_dump, hashdeep_to_migrate
+            WHERE
+                posts_dump.file_path = hashdeep_to_migrate.path
+                AND posts_dump.file_path not in (
+                  SELECT a.file_path
+                  FROM posts_dump a, migration_log b
+                  WHERE b.migration_original_path = a.file_path
+                )
+        ''')
+        for (post_service, post_user_id, post_id, file_location) in posts_to_fix:
+            kind = kind_of(file_location)
+            if kind and getattr(config, f'scan_{kind}'):
+                yield (kind, os.path.join(config.data_dir, remove_prefix(file_location, '/')), {
+                    '_service': post_service,
+                    '_user_id': post_user_id,
+                    '_post_id': post_id
+                })
+    sqlite_conn.close()
+
+
+# dumper.py / discord_dumper.py header -> owner keys to pass on to the migrator, in column order
+TSV_OWNER_KEYS = {
+    ('service', 'user_id', 'post_id', 'file_path'): ('_service', '_user_id', '_post_id'),
+    ('discord_server_id', 'discord_channel_id', 'discord_message_id', 'file_path'): ('_server_id', '_channel_id', '_message_id'),
+}
+
+
+def _iter_tsv_rows(tsv_file, header: tuple):
+    for line in tsv_file:
+        row = line.rstrip('\n').split('\t')
+        if len(row) == len(header):
+            yield row
+
+
+def iter_tsv_work(tsv_file):
+    """
+    Yields `(kind, path, owner)` for every file in `dumper.py` or `discord_dumper.py` output as it is read from `tsv_file`
+    (a pipe works), with `owner` holding the post (or Discord message) keys to pass on to the migrator.
+    Consecutive rows for the same file are one work item; if they name several posts or messages, `owner` is empty,
+    so the migrator looks them all up. Files that aren't in a legacy tree (anymore) are skipped.
+    """
+    header = tuple(tsv_file.readline().rstrip('\n').split('\t'))
+    if header not in TSV_OWNER_KEYS:
+        raise ValueError(f'Not `dumper.py` or `discord_dumper.py` output (header: {header}).')
+    owner_keys = TSV_OWNER_KEYS[header]
+    # (compared with the previous row only, so memory doesn't grow with the dump)
+    for (file_location, rows) in itertools.groupby(_iter_tsv_rows(tsv_file, header), key=lambda row: row[-1]):
+        kind = kind_of(file_location)
+        if not kind or not getattr(config, f'scan_{kind}'):
+            continue
+        if owner_keys[0] == '_server_id' and kind != 'attachments':
+            continue
+        path = os.path.join(config.data_dir, remove_prefix(file_location, '/'))
+        if not os.path.isfile(path):
+            continue
+        owners = {tuple(row[:-1]) for row in rows}
+        yield (kind, path, dict(zip(owner_keys, owners.pop())) if len(owners) == 1 else {})
+
+
+def iter_work():
+    """Yields `(kind, path, owner)` for everything to migrate, from `sql_file` if one is configured, otherwise by scanning."""
+    if config.sql_file:
+        return iter_sql_file_work()
+    return iter_legacy_work()
@@ -0,0 +1,151 @@
+import collections
+import functools
+import heapq
+import os
+import threading
+
+import config
+
+from .scanner import MIGRATORS
+from .stages import SharedStageConnection
+
+LANES = ('large', 'medium', 'small')
+# share of the pool each lane gets while every lane has work. idle slots are lent to the other lanes
+LANE_SHARES = {'large': 0.25, 'medium': 0.25, 'small': 0.5}
+
+
+def migrate_one(kind: str, path: str, migration_id, owner: dict):
+    MIGRATORS[kind](path, migration_id, **owner)
+
+
+def migrate_batch(items: list, migration_id):
+    """Migrates a batch of small files in one task, on one database connection."""
+    connection = SharedStageConnection()
+    try:
+        for (kind, path, owner) in items:
+            MIGRATORS[kind](path, migration_id, _connection=connection, **owner)
+    finally:
+        connection.reset()
+
+
+def get_size(path: str, owner: dict):
+    if owner.get('_plan'):
+        return owner['_plan']['size']
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        # the migrator will skip it
+        return 0
+
+
+class LaneScheduler:
+    """
+    Feeds a migration pool by file size instead of scan order, so a few huge files don't end up being the whole tail of a run.
+    Work is sorted into lanes by `st_size`: `large` files (`lane_large_mb` and up) are started biggest first,
+    `small` ones (under `lane_small_kb`) are sent `lane_batch_size` at a time, and the rest go as they come.
+    Only as many tasks as there are workers are handed to the pool at once, each lane getting its `lane_shares` of them.
+    Work is read (and stat'ed) on a thread of its own, so migrating starts right away and the lanes fill up as the scan goes.
+    """
+
+    def __init__(self, pool, processes: int, migration_id):
+        self.pool = pool
+        self.processes = processes
+        self.migration_id = migration_id
+        self.large_size = getattr(config, 'lane_large_mb', 256) * 1024 * 1024
+        self.small_size = getattr(config, 'lane_small_kb', 1024) * 1024
+        self.batch_size = getattr(config, 'lane_batch_size', 32)
+        shares = getattr(config, 'lane_shares', LANE_SHARES)
+        self.shares = {lane: max(1, round(shares.get(lane, 0) * processes)) for lane in LANES}
+
+        self.condition = threading.Condition()
+        self.large = []  # heap of (-size, n, item)
+        self.medium = collections.deque()
+        self.small = collections.deque()  # full batches
+        self.small_batch = []
+        self.in_flight = collections.Counter()
+        self.reading = True
+        self.read_error = None
+        self.queued = 0
+
+    def _read(self, work):
+        try:
+            for (kind, path, owner) in work:
+                size = get_size(path, owner)
+                with self.condition:
+                    if size >= self.large_size:
+                        heapq.heappush(self.large, (-size, self.queued, (kind, path, owner)))
+                    elif size < self.small_size:
+                        self.small_batch.append((kind, path, owner))
+                        if len(self.small_batch) >= self.batch_size:
+                            self.small.append(self.small_batch)
+                            self.small_batch = []
+                    else:
+                        self.medium.append((kind, path, owner))
+                    self.queued += 1
+                    self.condition.notify()
+        except BaseException as error:
+            self.read_error = error
+        finally:
+            with self.condition:
+                self.reading = False
+                self.condition.notify()
+
+    def _has_work(self, lane: str):
+        if lane == 'large':
+            return bool(self.large)
+        if lane == 'medium':
+            return bool(self.medium)
+        # a partial batch only goes out at the end, or rather than leave every worker idle
+        return bool(self.small) or bool(self.small_batch and (not self.reading or not any(self.in_flight.values())))
+
+    def _take(self, lane: str):
+        if lane == 'large':
+            return heapq.heappop(self.large)[2]
+        if lane == 'medium':
+            return self.medium.popleft()
+        if self.small:
+            return self.small.popleft()
+        (batch, self.small_batch) = (self.small_batch, [])
+        return batch
+
+    def _next_lane(self):
+        """The lane to start a task from: one under its share, otherwise any with work, largest files first."""
+        if sum(self.in_flight.values()) >= self.processes:
+            return None
+        for lane in LANES:
+            if self._has_work(lane) and self.in_flight[lane] < self.shares[lane]:
+                return lane
+        for lane in LANES:
+            if self._has_work(lane):
+                return lane
+        return None
+
+    def _done(self, lane: str, _):
+        """A task of `lane` finished (the pool's callback and error callback, called with its result or error)."""
+        with self.condition:
+            self.in_flight[lane] -= 1
+            self.condition.notify()
+
+    def run(self, work):
+        """Migrates everything in `work` (`(kind, path, owner)` tuples), returning once it's all done."""
+        reader = threading.Thread(target=self._read, args=(work,), name='sdkdd-lanes', daemon=True)
+        reader.start()
+        with self.condition:
+            while True:
+                lane = self._next_lane()
+                if lane is None:
+                    if not self.reading and not any(self._has_work(other) for other in LANES) and not any(self.in_flight.values()):
+                        break
+                    self.condition.wait()
+                    continue
+                task = self._take(lane)
+                self.in_flight[lane] += 1
+                callback = functools.partial(self._done, lane)
+                if lane == 'small':
+                    self.pool.apply_async(migrate_batch, args=(task, self.migration_id), callback=callback, error_callback=callback)
+                else:
+                    (kind, path, owner) = task
+                    self.pool.apply_async(migrate_one, args=(kind, path, self.migration_id, owner), callback=callback, error_callback=callback)
+        reader.join()
+        if self.read_error:
+            raise self.read_error
@@ -0,0 +1,25 @@
+import mimetypes
+import threading
+
+_local = threading.local()
+
+
+def get_magic():
+    """This thread's libmagic handle, opened (and its database loaded) on first use."""
+    handle = getattr(_local, 'magic', None)
+    if handle is None:
+        # (imported here, so processes that never sniff anything don't load libmagic)
+        import magic
+        handle = _local.magic = magic.Magic(mime=True)
+    return handle
+
+
+def sniff_mime(path: str):
+    """The MIME type of the file at `path`, from its contents."""
+    return get_magic().from_file(path)
+
+
+def warm_up():
+    """Loads the libmagic database and the `mimetypes` tables now, rather than while the first file is timed."""
+    mimetypes.init()
+    get_magic()
@@ -0,0 +1,120 @@
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import config
+import psycopg2
+
+from .storage import ERRORS, PostgresStorage, open_storage
+
+# stage -> (tries, base delay, max delay) in seconds. override any of them with `stage_retry_policies` in config.py.
+RETRY_POLICIES = {
+    'stat': (3, 0.1, 1),
+    'hash': (3, 1, 10),
+    'detect': (2, 0.1, 1),
+    'resolve': (5, 0.5, 30),
+    'write': (5, 0.5, 30),
+    'move': (3, 0.5, 5),
+    'purge': (5, 1, 30),
+}
+
+
+# thread id -> stage it's running, for the profiler (see src/profiler.py)
+active_stages = {}
+
+
+def is_transient(error: BaseException):
+    """Whether retrying might help: dropped connections, locked databases, serialization failures and deadlocks, HTTP hiccups, I/O errors."""
+    if isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        return True
+    # (sqlite's OperationalError is also what a bad query raises)
+    if isinstance(error, sqlite3.OperationalError) and 'locked' in str(error):
+        return True
+    # `requests` is only imported once something is purged, and can't have raised anything before that
+    requests = sys.modules.get('requests')
+    if requests and isinstance(error, requests.RequestException):
+        return True
+    if isinstance(error, (FileNotFoundError, NotADirectoryError, IsADirectoryError, PermissionError)):
+        return False
+    return isinstance(error, OSError)
+
+
+def get_retry_policy(stage: str):
+    return getattr(config, 'stage_retry_policies', {}).get(stage) or RETRY_POLICIES[stage]
+
+
+def run_stage(stage: str, func, *args, connection=None):
+    """
+    Runs one stage of a migration, retrying only that stage on transient errors,
+    with exponential backoff and full jitter between tries.
+    `connection` (a `StageConnection`) is reset before a retry, rolling back whatever the stage had done.
+    Errors that give up are tagged with `sdkdd_stage`, so they're reported against the right stage.
+    """
+    (tries, base_delay, max_delay) = get_retry_policy(stage)
+    thread = threading.get_ident()
+    outer_stage = active_stages.get(thread)
+    active_stages[thread] = stage
+    try:
+        for attempt in range(1, tries + 1):
+            try:
+                return func(*args)
+            except Exception as error:
+                if attempt >= tries or not is_transient(error):
+                    error.sdkdd_stage = stage
+                    raise
+                if connection:
+                    connection.reset()
+                time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1))))
+    finally:
+        if outer_stage:
+            active_stages[thread] = outer_stage
+        else:
+            del active_stages[thread]
+
+
+class StageConnection:
+    """
+    Storage (see src/storage) shared by the stages of one migration, opened on first use and reopened after a reset.
+    With a `pool` (a psycopg2 `ThreadedConnectionPool`), its connection is checked out of the pool instead, and handed back on close.
+    """
+
+    def __init__(self, pool=None):
+        self._pool = pool
+        self._storage = None
+
+    def get(self):
+        if self._storage is None:
+            self._storage = PostgresStorage(self._pool.getconn()) if self._pool else open_storage()
+        return self._storage
+
+    def reset(self):
+        if self._storage is not None:
+            if self._pool:
+                self._pool.putconn(self._storage.conn, close=True)
+            else:
+                self._storage.close()
+        self._storage = None
+
+    def close(self):
+        if self._pool and self._storage is not None:
+            try:
+                self._storage.rollback()
+                self._pool.putconn(self._storage.conn)
+            except psycopg2.Error:
+                self._pool.putconn(self._storage.conn, close=True)
+            self._storage = None
+            return
+        self.reset()
+
+
+class SharedStageConnection(StageConnection):
+    """A `StageConnection` used by several migrations in a row: closing it only rolls back what was left open. `reset` closes it."""
+
+    def close(self):
+        if self._storage is not None:
+            try:
+                self._storage.rollback()
+            except ERRORS:
+                self.reset()
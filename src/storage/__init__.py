@@ -0,0 +1,29 @@
+"""
+The database the migrators look up and update posts in, behind one interface (see `PostgresStorage`):
+the instance's Postgres database, or an embedded SQLite one with the same semantics (`SQLiteStorage`),
+so benchmarks and CI can run migrations on one machine with no services. Picked with `storage` in config.py.
+"""
+import sqlite3
+
+import config
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from ..utils import get_connection
+from .postgres import PostgresStorage
+from .sqlite import SQLiteStorage
+
+# what a storage can raise for its connection, on top of the usual errors
+ERRORS = (psycopg2.Error, sqlite3.Error)
+
+
+def get_backend():
+    """`postgres` or `sqlite`, by `storage` (`postgres`, or `sqlite:<database file>`)."""
+    return getattr(config, 'storage', 'postgres').split(':', 1)[0]
+
+
+def open_storage():
+    """Opens a new connection to the configured storage."""
+    if get_backend() == 'sqlite':
+        return SQLiteStorage.connect(config.storage.split(':', 1)[1])
+    return PostgresStorage(get_connection(cursor_factory=RealDictCursor))
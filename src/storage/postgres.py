@@ -0,0 +1,159 @@
+import datetime
+import os
+
+import psycopg2
+
+from .. import instrument
+from ..utils import (
+    DISCORD_ATTACHMENT_MATCH,
+    PARTITION_MATCH,
+    create_migration_log,
+    find_posts_with_file,
+    replace_file_from_post,
+    replace_file_in_discord_attachments
+)
+
+FILE_PATH_MATCH = "(file ->> 'path' = %s OR file ->> 'path' = %s OR file ->> 'path' = %s)"
+
+
+class PostgresStorage:
+    """
+    The instance database, on one psycopg2 connection (with a `RealDictCursor` factory).
+    Every storage has these methods: the lookups the resolvers are made of (`find_*`, read-only),
+    the updates and inserts of the write stage, and `commit`/`rollback`/`close` for the transaction they're in.
+    Paths are matched as legacy (`web_path`), legacy with the domain, or already hashed (`new_filename`).
+    """
+
+    # whether full table scans can be split up (see src/partitions.py)
+    partitioned = True
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def find_file_owners(self, web_path: str, new_filename: str, service=None, user_id=None, post_id=None, min_time=None, max_time=None, partition=None):
+        """The keys of the posts whose `file` is `web_path`, by post, by time added, by partition or out of all of them."""
+        paths = (web_path, 'https://kemono.party' + web_path, new_filename)
+        with self.conn.cursor() as cursor:
+            if (service and user_id and post_id):
+                instrument.execute(cursor, f'SELECT service, "user", id FROM posts WHERE service = %s AND "user" = %s AND id = %s AND {FILE_PATH_MATCH}', (service, user_id, post_id, *paths))
+            elif (user_id and post_id):
+                instrument.execute(cursor, f'SELECT service, "user", id FROM posts WHERE id = %s AND "user" = %s AND {FILE_PATH_MATCH}', (post_id, user_id, *paths))
+            elif (min_time and max_time):
+                instrument.execute(cursor, f'SELECT service, "user", id FROM posts WHERE added >= %s AND added < %s AND {FILE_PATH_MATCH}', (min_time, max_time, *paths))
+            elif (partition):
+                instrument.execute(cursor, f'SELECT service, "user", id FROM posts WHERE {FILE_PATH_MATCH} AND ' + PARTITION_MATCH.format(column='"user"'), (*paths, *partition))
+            else:
+                instrument.execute(cursor, f'SELECT service, "user", id FROM posts WHERE {FILE_PATH_MATCH}', paths)
+            return [{'service': post['service'], 'user_id': post['user'], 'post_id': post['id']} for post in cursor]
+
+    def find_post_owners(self, web_path: str, new_filename: str, **keys):
+        """The keys of the posts referencing `web_path` anywhere (content, file or attachments). See `find_posts_with_file`."""
+        return find_posts_with_file(self.conn, web_path, new_filename, **keys)
+
+    def find_discord_owners(self, web_path: str, new_filename: str, server_id=None, channel_id=None, message_id=None, partition=None):
+        """
+        The keys of the Discord messages with `web_path` as an attachment, narrowed down by message or by channel.
+        Attachments are matched in SQL, so only matching keys come back.
+        """
+        paths = (web_path, 'https://kemono.party' + web_path, new_filename)
+        with self.conn.cursor() as cursor:
+            if (server_id and channel_id and message_id):
+                instrument.execute(cursor, f'SELECT server, channel, id FROM discord_posts WHERE server = %s AND channel = %s AND id = %s AND {DISCORD_ATTACHMENT_MATCH}', (server_id, channel_id, message_id, *paths))
+            elif (channel_id):
+                instrument.execute(cursor, f'SELECT server, channel, id FROM discord_posts WHERE channel = %s AND {DISCORD_ATTACHMENT_MATCH}', (channel_id, *paths))
+            elif (partition):
+                instrument.execute(cursor, f'SELECT server, channel, id FROM discord_posts WHERE {DISCORD_ATTACHMENT_MATCH} AND ' + PARTITION_MATCH.format(column='channel'), (*paths, *partition))
+            else:
+                instrument.execute(cursor, f'SELECT server, channel, id FROM discord_posts WHERE {DISCORD_ATTACHMENT_MATCH}', paths)
+            return [{'server_id': message['server'], 'channel_id': message['channel'], 'message_id': message['id']} for message in cursor]
+
+    def update_post_file(self, web_path: str, new_filename: str, service, user_id, post_id):
+        """Points a post's `file` at `new_filename`, if it's `web_path`. Returns the number of posts updated."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE posts SET file = jsonb_set(file, '{{path}}', %s, false) WHERE service = %s AND \"user\" = %s AND id = %s AND {FILE_PATH_MATCH}",
+                (f'"{new_filename}"', service, user_id, post_id, web_path, 'https://kemono.party' + web_path, new_filename)
+            )
+            return cursor.rowcount
+
+    def replace_in_post(self, web_path: str, new_filename: str, **keys):
+        """Replaces `web_path` with `new_filename` everywhere in the posts matching `keys`. Returns the number of posts updated."""
+        return replace_file_from_post(self.conn, old_file=web_path, new_file=new_filename, **keys)[0]
+
+    def replace_in_discord_message(self, web_path: str, new_filename: str, server_id, channel_id, message_id):
+        """Points a Discord message's attachments that are `web_path` at `new_filename`. Returns the number of messages updated."""
+        return replace_file_in_discord_attachments(self.conn, web_path, new_filename, server_id, channel_id, message_id)
+
+    def insert_file(self, file_hash: str, stat: os.stat_result, mime: str, file_ext: str):
+        """Logs the file to the file tracking table, returning its id."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO files (hash, mtime, ctime, mime, ext) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (hash) DO UPDATE SET hash = EXCLUDED.hash RETURNING id",
+                (file_hash, datetime.datetime.fromtimestamp(stat.st_mtime), datetime.datetime.fromtimestamp(stat.st_ctime), mime, file_ext)
+            )
+            return cursor.fetchone()['id']
+
+    def get_file_id(self, file_hash: str):
+        """The file's id in the file tracking table, or `None` if it isn't there. Unlike `insert_file`, writes nothing."""
+        with self.conn.cursor() as cursor:
+            cursor.execute('SELECT id FROM files WHERE hash = %s', (file_hash,))
+            row = cursor.fetchone()
+            return row['id'] if row else None
+
+    def iter_file_hashes(self):
+        """Every hash in the file tracking table, read through a server-side cursor."""
+        with self.conn.cursor(f'sdkdd_hashes_{os.getpid()}', cursor_factory=psycopg2.extensions.cursor) as cursor:
+            # (rows are tiny)
+            cursor.itersize = 100000
+            cursor.execute('SELECT hash FROM files')
+            for (file_hash,) in cursor:
+                yield file_hash
+
+    def insert_post_relationships(self, file_id, path: str, owners: list, inline: bool):
+        with self.conn.cursor() as cursor:
+            for owner in owners:
+                if owner.get('post_id'):
+                    cursor.execute(
+                        "INSERT INTO file_post_relationships (file_id, filename, service, \"user\", post, inline) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                        (file_id, os.path.basename(path), owner['service'], owner['user_id'], owner['post_id'], inline)
+                    )
+
+    def insert_discord_relationships(self, file_id, path: str, owners: list):
+        with self.conn.cursor() as cursor:
+            for owner in owners:
+                if owner.get('message_id'):
+                    cursor.execute(
+                        "INSERT INTO file_discord_message_relationships (file_id, filename, server, channel, id) VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                        (file_id, os.path.basename(path), owner['server_id'], owner['channel_id'], owner['message_id'])
+                    )
+
+    def create_migration_log(self, migration_id):
+        create_migration_log(self.conn, migration_id)
+
+    def log_migration(self, migration_id, web_path: str, new_filename: str, stat: os.stat_result):
+        """Logs to `sdkdd_migration_{migration_id}` (see `create_migration_log`)."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO sdkdd_migration_{migration_id} (old_location, new_location, ctime, mtime) VALUES (%s, %s, %s, %s)",
+                (web_path, new_filename, datetime.datetime.fromtimestamp(stat.st_ctime), datetime.datetime.fromtimestamp(stat.st_mtime))
+            )
+
+    def iter_migration_log(self, migration_id):
+        """`(old_location, new_location)` for every file logged to `sdkdd_migration_{migration_id}`, read through a server-side cursor."""
+        with self.conn.cursor(f'sdkdd_migration_log_{migration_id}_{os.getpid()}', cursor_factory=psycopg2.extensions.cursor) as cursor:
+            cursor.itersize = 10000
+            cursor.execute(f'SELECT old_location, new_location FROM sdkdd_migration_{migration_id}')
+            for (old_location, new_location) in cursor:
+                yield (old_location, new_location)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
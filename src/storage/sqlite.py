@@ -0,0 +1,238 @@
+import datetime
+import json
+import os
+import sqlite3
+
+from ..utils import replace_in_post
+
+# the parts of the instance schema sdkdd touches. json columns are json text, `jsonb[]` ones json arrays
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS posts (
+        id text NOT NULL,
+        "user" text NOT NULL,
+        service text NOT NULL,
+        added timestamp NOT NULL,
+        content text NOT NULL DEFAULT '',
+        file text NOT NULL DEFAULT '{}',
+        attachments text NOT NULL DEFAULT '[]',
+        PRIMARY KEY (id, "user", service)
+    );
+    CREATE INDEX IF NOT EXISTS posts_added ON posts (added);
+    CREATE TABLE IF NOT EXISTS discord_posts (
+        id text NOT NULL,
+        server text NOT NULL,
+        channel text NOT NULL,
+        added timestamp NOT NULL,
+        attachments text NOT NULL DEFAULT '[]',
+        PRIMARY KEY (id, server, channel)
+    );
+    CREATE INDEX IF NOT EXISTS discord_posts_channel ON discord_posts (channel);
+    CREATE TABLE IF NOT EXISTS files (
+        id integer PRIMARY KEY,
+        hash text NOT NULL UNIQUE,
+        mtime timestamp NOT NULL,
+        ctime timestamp NOT NULL,
+        mime text,
+        ext text,
+        added timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS file_post_relationships (
+        file_id integer NOT NULL REFERENCES files (id),
+        filename text NOT NULL,
+        service text NOT NULL,
+        "user" text NOT NULL,
+        post text NOT NULL,
+        inline boolean NOT NULL DEFAULT 0,
+        PRIMARY KEY (file_id, service, "user", post)
+    );
+    CREATE TABLE IF NOT EXISTS file_discord_message_relationships (
+        file_id integer NOT NULL REFERENCES files (id),
+        filename text NOT NULL,
+        server text NOT NULL,
+        channel text NOT NULL,
+        id text NOT NULL,
+        PRIMARY KEY (file_id, server, channel, id)
+    );
+'''
+
+FILE_PATH_MATCH = "json_extract(file, '$.path') IN (?, ?, ?)"
+DISCORD_ATTACHMENT_MATCH = "EXISTS (SELECT 1 FROM json_each(discord_posts.attachments) a WHERE json_extract(a.value, '$.path') IN (?, ?, ?))"
+
+
+def _timestamp(value):
+    # stored as text, which sorts like the timestamps it is
+    return value.isoformat(' ') if isinstance(value, datetime.datetime) else value
+
+
+def _post_keys(service=None, user_id=None, post_id=None, min_time=None, max_time=None, partition=None):
+    """The `WHERE` clause and parameters narrowing posts down the way `_select_posts` does."""
+    if (service and user_id and post_id):
+        return ('service = ? AND "user" = ? AND id = ?', (service, user_id, post_id))
+    if (user_id and post_id):
+        return ('"user" = ? AND id = ?', (user_id, post_id))
+    if (min_time and max_time):
+        return ('added >= ? AND added < ?', (_timestamp(min_time), _timestamp(max_time)))
+    # (never partitioned, see `partitioned`)
+    return ('1 = 1', ())
+
+
+class SQLiteStorage:
+    """
+    An embedded SQLite database with the instance's schema (see `SCHEMA`), with the same methods and semantics
+    as `PostgresStorage`, for benchmarks and CI. Lookups that Postgres does with jsonb operators are done with
+    SQLite's json functions, and the ones done in Python (`replace_in_post`) are done by the same code.
+    """
+
+    partitioned = False
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    @classmethod
+    def connect(cls, database: str):
+        """Opens `database` (a file, `:memory:` or a `file:` URI), creating the schema if it isn't there yet."""
+        conn = sqlite3.connect(database, timeout=60, uri=database.startswith('file:'))
+        conn.row_factory = sqlite3.Row
+        if database != ':memory:':
+            # so concurrent workers don't block each other's reads
+            conn.execute('PRAGMA journal_mode = WAL')
+        conn.executescript(SCHEMA)
+        return cls(conn)
+
+    def add_post(self, service: str, user_id: str, post_id: str, added: datetime.datetime, content='', file=None, attachments=()):
+        """Inserts a post (`file` and `attachments` being `{'name': ..., 'path': ...}` dicts), for seeding a database."""
+        self.conn.execute(
+            'INSERT INTO posts (id, "user", service, added, content, file, attachments) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (post_id, user_id, service, _timestamp(added), content, json.dumps(file or {}), json.dumps(list(attachments)))
+        )
+
+    def add_discord_message(self, server_id: str, channel_id: str, message_id: str, added: datetime.datetime, attachments=()):
+        """Inserts a Discord message, for seeding a database."""
+        self.conn.execute(
+            'INSERT INTO discord_posts (id, server, channel, added, attachments) VALUES (?, ?, ?, ?, ?)',
+            (message_id, server_id, channel_id, _timestamp(added), json.dumps(list(attachments)))
+        )
+
+    def _select_posts(self, **keys):
+        (where, params) = _post_keys(**keys)
+        for row in self.conn.execute(f'SELECT service, "user", id, content, file, attachments FROM posts WHERE {where}', params):
+            post_data = dict(row)
+            post_data['file'] = json.loads(post_data['file'])
+            post_data['attachments'] = json.loads(post_data['attachments'])
+            yield post_data
+
+    def find_file_owners(self, web_path: str, new_filename: str, **keys):
+        paths = (web_path, 'https://kemono.party' + web_path, new_filename)
+        (where, params) = _post_keys(**keys)
+        rows = self.conn.execute(f'SELECT service, "user", id FROM posts WHERE {where} AND {FILE_PATH_MATCH}', (*params, *paths))
+        return [{'service': post['service'], 'user_id': post['user'], 'post_id': post['id']} for post in rows]
+
+    def find_post_owners(self, web_path: str, new_filename: str, **keys):
+        return [
+            {'service': post_data['service'], 'user_id': post_data['user'], 'post_id': post_data['id']}
+            for post_data in self._select_posts(**keys) if replace_in_post(post_data, web_path, new_filename)
+        ]
+
+    def find_discord_owners(self, web_path: str, new_filename: str, server_id=None, channel_id=None, message_id=None, partition=None):
+        paths = (web_path, 'https://kemono.party' + web_path, new_filename)
+        if (server_id and channel_id and message_id):
+            (where, params) = ('server = ? AND channel = ? AND id = ?', (server_id, channel_id, message_id))
+        elif (channel_id):
+            (where, params) = ('channel = ?', (channel_id,))
+        else:
+            (where, params) = ('1 = 1', ())
+        rows = self.conn.execute(f'SELECT server, channel, id FROM discord_posts WHERE {where} AND {DISCORD_ATTACHMENT_MATCH}', (*params, *paths))
+        return [{'server_id': message['server'], 'channel_id': message['channel'], 'message_id': message['id']} for message in rows]
+
+    def update_post_file(self, web_path: str, new_filename: str, service, user_id, post_id):
+        return self.conn.execute(
+            f"UPDATE posts SET file = json_set(file, '$.path', ?) WHERE service = ? AND \"user\" = ? AND id = ? AND {FILE_PATH_MATCH}",
+            (new_filename, service, user_id, post_id, web_path, 'https://kemono.party' + web_path, new_filename)
+        ).rowcount
+
+    def replace_in_post(self, web_path: str, new_filename: str, **keys):
+        updated_rows = 0
+        for post_data in list(self._select_posts(**keys)):
+            if not replace_in_post(post_data, web_path, new_filename):
+                continue
+            self.conn.execute(
+                'UPDATE posts SET content = ?, file = ?, attachments = ? WHERE service = ? AND "user" = ? AND id = ?',
+                (post_data['content'], json.dumps(post_data['file']), json.dumps(post_data['attachments']), post_data['service'], post_data['user'], post_data['id'])
+            )
+            updated_rows += 1
+        return updated_rows
+
+    def replace_in_discord_message(self, web_path: str, new_filename: str, server_id, channel_id, message_id):
+        paths = (web_path, 'https://kemono.party' + web_path, new_filename)
+        return self.conn.execute(
+            f'''
+                UPDATE discord_posts
+                SET attachments = (
+                    SELECT json_group_array(CASE WHEN json_extract(a.value, '$.path') IN (?, ?) THEN json_set(a.value, '$.path', ?) ELSE json(a.value) END)
+                    FROM json_each(discord_posts.attachments) a
+                )
+                WHERE server = ? AND channel = ? AND id = ? AND {DISCORD_ATTACHMENT_MATCH}
+            ''',
+            (*paths[:2], new_filename, server_id, channel_id, message_id, *paths)
+        ).rowcount
+
+    def insert_file(self, file_hash: str, stat: os.stat_result, mime: str, file_ext: str):
+        self.conn.execute(
+            'INSERT INTO files (hash, mtime, ctime, mime, ext) VALUES (?, ?, ?, ?, ?) ON CONFLICT (hash) DO NOTHING',
+            (file_hash, _timestamp(datetime.datetime.fromtimestamp(stat.st_mtime)), _timestamp(datetime.datetime.fromtimestamp(stat.st_ctime)), mime, file_ext)
+        )
+        return self.conn.execute('SELECT id FROM files WHERE hash = ?', (file_hash,)).fetchone()['id']
+
+    def get_file_id(self, file_hash: str):
+        row = self.conn.execute('SELECT id FROM files WHERE hash = ?', (file_hash,)).fetchone()
+        return row['id'] if row else None
+
+    def iter_file_hashes(self):
+        for (file_hash,) in self.conn.execute('SELECT hash FROM files'):
+            yield file_hash
+
+    def insert_post_relationships(self, file_id, path: str, owners: list, inline: bool):
+        self.conn.executemany(
+            'INSERT INTO file_post_relationships (file_id, filename, service, "user", post, inline) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+            [(file_id, os.path.basename(path), owner['service'], owner['user_id'], owner['post_id'], inline) for owner in owners if owner.get('post_id')]
+        )
+
+    def insert_discord_relationships(self, file_id, path: str, owners: list):
+        self.conn.executemany(
+            'INSERT INTO file_discord_message_relationships (file_id, filename, server, channel, id) VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+            [(file_id, os.path.basename(path), owner['server_id'], owner['channel_id'], owner['message_id']) for owner in owners if owner.get('message_id')]
+        )
+
+    def create_migration_log(self, migration_id):
+        self.conn.execute(
+            f'''
+                CREATE TABLE IF NOT EXISTS sdkdd_migration_{migration_id} (
+                    "old_location" text NOT NULL,
+                    "new_location" text NOT NULL,
+                    "ctime" timestamp NOT NULL,
+                    "mtime" timestamp NOT NULL
+                )
+            '''
+        )
+
+    def log_migration(self, migration_id, web_path: str, new_filename: str, stat: os.stat_result):
+        self.conn.execute(
+            f'INSERT INTO sdkdd_migration_{migration_id} (old_location, new_location, ctime, mtime) VALUES (?, ?, ?, ?)',
+            (web_path, new_filename, _timestamp(datetime.datetime.fromtimestamp(stat.st_ctime)), _timestamp(datetime.datetime.fromtimestamp(stat.st_mtime)))
+        )
+
+    def iter_migration_log(self, migration_id):
+        for (old_location, new_location) in self.conn.execute(f'SELECT old_location, new_location FROM sdkdd_migration_{migration_id}'):
+            yield (old_location, new_location)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        try:
+            self.conn.close()
+        except sqlite3.Error:
+            pass
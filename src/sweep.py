@@ -0,0 +1,123 @@
+import collections
+import multiprocessing
+import os
+import re
+
+import config
+
+from .mover import HASHED_NAME, iter_shards
+from .utils import get_connection, remove_prefix, remove_suffix
+
+LEGACY_PREFIXES = ('/files/', '/attachments/', '/inline/')
+HASHED_PATH = re.compile(r'^/([0-9a-f]{2})/([0-9a-f]{2})/(([0-9a-f]{64})(\.[^/.]*)?)$')
+INLINE_IMAGES = re.compile(r'''<img\s[^>]*?src\s*=\s*["']([^"']+)["']''', re.IGNORECASE)
+STATUSES = ('ok', 'dangling', 'legacy')
+
+
+def list_shard(shard: str):
+    """Returns the names of the hashed files in one `ab/cd` shard."""
+    try:
+        with os.scandir(shard) as it:
+            return [entry.name for entry in it if HASHED_NAME.match(entry.name)]
+    except FileNotFoundError:
+        return []
+
+
+def index_hash_tree(root: str, processes: int):
+    """Lists every file in the hash tree under `root` from `processes` processes at once, as a set of names."""
+    index = set()
+    with multiprocessing.Pool(processes) as pool:
+        for names in pool.imap_unordered(list_shard, iter_shards(root), chunksize=64):
+            index.update(names)
+    return index
+
+
+def classify(path: str, index: set):
+    """Whether a referenced path is in the hash tree (`ok`), isn't (`dangling`), still legacy (`legacy`), or something else (`None`)."""
+    path = remove_prefix(path, 'https://kemono.party')
+    match = HASHED_PATH.match(path)
+    if match:
+        (first, second, name, file_hash) = match.group(1, 2, 3, 4)
+        return 'ok' if file_hash[0:2] == first and file_hash[2:4] == second and name in index else 'dangling'
+    if path.startswith(LEGACY_PREFIXES):
+        return 'legacy'
+    return None
+
+
+def iter_post_references(content_pattern=INLINE_IMAGES):
+    """
+    Yields `(service, user, id, path)` for every file, attachment and inline image of every post, in one pass over `posts`.
+    Paths in `content` are what `content_pattern`'s first group matches.
+    """
+    conn = get_connection()
+    with conn.cursor('sdkdd_sweep_posts') as cursor:
+        cursor.itersize = getattr(config, 'scan_itersize', 2000)
+        cursor.execute('''
+            SELECT service, "user", id, file ->> 'path', array(SELECT a ->> 'path' FROM unnest(attachments) a), content
+            FROM posts
+        ''')
+        for (service, user_id, post_id, file_path, attachment_paths, content) in cursor:
+            for path in [file_path, *(attachment_paths or []), *content_pattern.findall(content or '')]:
+                if path:
+                    yield (service, user_id, post_id, path)
+    conn.close()
+
+
+def iter_discord_references():
+    """Yields `('discord', server, '<channel>/<id>', path)` for every attachment of every Discord message."""
+    conn = get_connection()
+    with conn.cursor('sdkdd_sweep_discord') as cursor:
+        cursor.itersize = getattr(config, 'scan_itersize', 2000)
+        cursor.execute('SELECT server, channel, id, array(SELECT a ->> \'path\' FROM unnest(attachments) a) FROM discord_posts')
+        for (server_id, channel_id, message_id, attachment_paths) in cursor:
+            for path in attachment_paths or []:
+                if path:
+                    yield ('discord', server_id, f'{channel_id}/{message_id}', path)
+    conn.close()
+
+
+def iter_unregistered(index: set):
+    """Yields the names of hash tree files with no `files` row."""
+    registered = set()
+    conn = get_connection()
+    with conn.cursor('sdkdd_sweep_files') as cursor:
+        cursor.itersize = 100000
+        cursor.execute('SELECT hash FROM files')
+        for (file_hash,) in cursor:
+            registered.add(file_hash)
+    conn.close()
+    for name in index:
+        if HASHED_NAME.match(name).group(1) not in registered:
+            yield name
+
+
+def sweep(report_file: str):
+    """
+    Checks every path referenced from `posts` and `discord_posts` against an index of the hash tree,
+    and writes dangling references, references to legacy paths, and hash tree files without a `files` row
+    to `report_file` (tab separated: status, service, user/server, post/message, path). Prints counts per service.
+    """
+    root = remove_suffix(config.data_dir, '/')
+    index = index_hash_tree(root, config.processes or multiprocessing.cpu_count())
+    print(f'Indexed {len(index)} files in the hash tree.')
+
+    counts = collections.defaultdict(collections.Counter)
+    with open(report_file, 'w') as report:
+        for references in (iter_post_references(), iter_discord_references()):
+            for (service, owner_id, post_id, path) in references:
+                status = classify(path, index)
+                if status is None:
+                    continue
+                counts[service][status] += 1
+                if status != 'ok':
+                    report.write(f'{status}\t{service}\t{owner_id}\t{post_id}\t{path}\n')
+
+        unregistered = 0
+        for name in iter_unregistered(index):
+            report.write(f'unregistered\t\t\t\t/{name[0:2]}/{name[2:4]}/{name}\n')
+            unregistered += 1
+
+    for (service, service_counts) in sorted(counts.items()):
+        print(f'{service}: ' + ', '.join(f'{service_counts[status]} {status}' for status in STATUSES))
+    print(f'{unregistered} files in the hash tree have no `files` row.')
+    print(f'Details are in {report_file}.')
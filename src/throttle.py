@@ -0,0 +1,157 @@
+import contextlib
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+import config
+
+from .utils import get_connection
+
+CPU = 0
+DB = 1
+IO_SLOTS = 8  # devices are spread over this many `io` limits by `st_dev`
+
+_limiter = None
+
+
+class Limiter:
+    """
+    Concurrency limits shared by every migration process: one for CPU work, one for database work,
+    and one per storage device (well, per `st_dev % IO_SLOTS`) for hashing I/O.
+    Limits are changed by the `Controller` in the parent process while workers are waiting on them.
+    """
+
+    def __init__(self, maximum: int, context=multiprocessing):
+        self.maximum = maximum
+        self.condition = context.Condition()
+        # the database is what the live site feels first, so start it off at half and let it grow
+        self.limits = context.Array('i', [maximum, max(1, maximum // 2)] + [maximum] * IO_SLOTS, lock=False)
+        self.in_use = context.Array('i', 2 + IO_SLOTS, lock=False)
+        self.devices = context.Array('q', [-1] * IO_SLOTS, lock=False)
+
+    def slot(self, resource: str, device: int = None):
+        if resource == 'cpu':
+            return CPU
+        if resource == 'db':
+            return DB
+        return 2 + (device or 0) % IO_SLOTS
+
+    @contextlib.contextmanager
+    def acquire(self, resource: str, device: int = None):
+        slot = self.slot(resource, device)
+        with self.condition:
+            if device is not None:
+                self.devices[slot - 2] = device
+            while self.in_use[slot] >= self.limits[slot]:
+                self.condition.wait(1)
+            self.in_use[slot] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_use[slot] -= 1
+                self.condition.notify_all()
+
+    def adjust(self, slot: int, overloaded: bool):
+        """AIMD: halve the limit when a signal is over its target, otherwise allow one more."""
+        with self.condition:
+            if overloaded:
+                self.limits[slot] = max(1, self.limits[slot] // 2)
+            else:
+                self.limits[slot] = min(self.maximum, self.limits[slot] + 1)
+            self.condition.notify_all()
+            return self.limits[slot]
+
+
+def install(limiter: Limiter):
+    """Makes `acquire` in this process wait on `limiter`. Called from the pool initializer."""
+    global _limiter
+    _limiter = limiter
+
+
+def acquire(resource: str, device: int = None):
+    """Waits for a `cpu`, `db`, or `io` (on `device`) slot, if adaptive throttling is on."""
+    if not _limiter:
+        return contextlib.nullcontext()
+    return _limiter.acquire(resource, device)
+
+
+def create_limiter(processes: int, context=multiprocessing):
+    if not getattr(config, 'throttle', False):
+        return None
+    return Limiter(processes, context)
+
+
+def disk_queue_depth(device: int):
+    """Requests in flight on the block device behind `device`, or `None` if it isn't one (NFS and the like)."""
+    try:
+        with open(f'/sys/dev/block/{os.major(device)}:{os.minor(device)}/inflight') as f:
+            return sum(int(count) for count in f.read().split())
+    except (OSError, ValueError):
+        return None
+
+
+class Controller(threading.Thread):
+    """
+    Watches database latency, active backends, disk queue depth and load average from the parent process,
+    and grows or shrinks the `Limiter`'s limits every `throttle_interval` seconds to stay under their targets.
+    """
+
+    def __init__(self, limiter: Limiter):
+        super().__init__(name='sdkdd-throttle', daemon=True)
+        self.limiter = limiter
+        self.interval = getattr(config, 'throttle_interval', 5)
+        self.target_latency = getattr(config, 'throttle_target_db_latency_ms', 50) / 1000
+        self.max_active_backends = getattr(config, 'throttle_max_active_backends', 32)
+        self.max_disk_queue = getattr(config, 'throttle_max_disk_queue', 16)
+        self.max_load = getattr(config, 'throttle_max_load_per_cpu', 1.0) * multiprocessing.cpu_count()
+        self._stopping = threading.Event()
+        self._latency = None
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        conn = None
+        while not self._stopping.wait(self.interval):
+            try:
+                conn = conn or get_connection()
+                self.tick(conn)
+            except:
+                print('Exception in throttle controller')
+                traceback.print_exc()
+                if conn:
+                    conn.close()
+                conn = None
+        if conn:
+            conn.close()
+
+    def tick(self, pg_connection):
+        # database: how long a trivial round trip takes, and how busy the backends are
+        started = time.monotonic()
+        with pg_connection.cursor() as cursor:
+            cursor.execute(getattr(config, 'throttle_probe_query', 'SELECT 1'))
+            cursor.fetchall()
+            latency = time.monotonic() - started
+            cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE state = 'active' AND pid <> pg_backend_pid()")
+            (active_backends,) = cursor.fetchone()
+        pg_connection.rollback()
+        self._latency = latency if self._latency is None else 0.7 * self._latency + 0.3 * latency
+        db_limit = self.limiter.adjust(DB, self._latency > self.target_latency or active_backends > self.max_active_backends)
+
+        # cpu: load average over every core of this host
+        cpu_limit = self.limiter.adjust(CPU, os.getloadavg()[0] > self.max_load)
+
+        # io: queue depth of every device workers have been hashing on
+        io_limits = []
+        for (i, device) in enumerate(self.limiter.devices):
+            if device < 0:
+                continue
+            depth = disk_queue_depth(device)
+            if depth is not None:
+                io_limits.append(f'{os.major(device)}:{os.minor(device)}={self.limiter.adjust(2 + i, depth > self.max_disk_queue)}')
+
+        print(f"(throttle: db {db_limit} ({self._latency * 1000:.1f}ms, {active_backends} active), cpu {cpu_limit}, io {' '.join(io_limits) or '-'})")
@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import config
+
+from .mover import Mover
+from .storage import open_storage
+from .utils import iter_files
+
+LEGACY_ROOTS = ('files', 'attachments', 'inline')
+
+
+def get_thumb_dir():
+    return config.thumb_dir or os.path.join(config.data_dir, 'thumbnail')
+
+
+def thumbnail_key(web_path: str):
+    """Compact (64 bit) set key for a legacy web path like `/files/1234/5678/image.png`."""
+    return int.from_bytes(hashlib.blake2b(web_path.encode('utf-8', 'surrogateescape'), digest_size=8).digest(), 'little')
+
+
+def index_thumbnails(thumb_dir: str):
+    """
+    Enumerates the legacy thumbnail trees once, returning the keys of every thumbnail found.
+    Keys can collide, which only ever costs a failed rename for a thumbnail that isn't there.
+    """
+    index = set()
+    for root in LEGACY_ROOTS:
+        if not os.path.isdir(os.path.join(thumb_dir, root)):
+            continue
+        for entry in iter_files(os.path.join(thumb_dir, root)):
+            index.add(thumbnail_key('/' + os.path.relpath(entry.path, thumb_dir)))
+    return index
+
+
+def migrate_thumbnails(migration_id):
+    """
+    Moves the thumbnails of everything logged in `sdkdd_migration_{migration_id}` to their hashed locations,
+    consulting a pre-scanned index instead of probing the thumbnail volume for every file.
+    Thumbnails left in the legacy trees afterwards that have no source file are reported as orphans, apart from those of
+    migrated duplicates, whose hashed thumbnail was already there (the mover never overwrites), which are listed separately.
+    """
+    thumb_dir = get_thumb_dir()
+    if not os.path.isdir(thumb_dir):
+        print(f'Thumbnail directory {thumb_dir} is missing, and will be skipped.')
+        return
+
+    index = index_thumbnails(thumb_dir)
+    print(f'Found {len(index)} legacy thumbnails in {thumb_dir}.')
+
+    mover = Mover(
+        thumb_dir,
+        threads=getattr(config, 'thumbnail_threads', 8),
+        batch_size=getattr(config, 'mover_batch_size', 256)
+    )
+    moved = 0
+    # keys of the thumbnails handed to the mover, to tell duplicates from orphans afterwards
+    submitted = set()
+    if index:
+        storage = open_storage()
+        try:
+            for (old_location, new_location) in storage.iter_migration_log(migration_id):
+                key = thumbnail_key(old_location)
+                if key not in index:
+                    continue
+                submitted.add(key)
+                new_name = os.path.basename(new_location)
+                mover.submit(os.path.join(thumb_dir, old_location.lstrip('/')), new_name, new_name)
+                moved += 1
+        finally:
+            storage.close()
+    mover.close()
+    print(f'Moved {moved} thumbnails to hashed locations.')
+
+    # whatever is still in the legacy trees belongs to a duplicate whose hashed thumbnail was already there,
+    # to a file that wasn't migrated, or to nothing at all
+    (orphans, duplicates) = (0, 0)
+    with open(f'sdkdd_orphan_thumbnails_{migration_id}.txt', 'w') as report, open(f'sdkdd_duplicate_thumbnails_{migration_id}.txt', 'w') as duplicate_report:
+        for root in LEGACY_ROOTS:
+            if not os.path.isdir(os.path.join(thumb_dir, root)):
+                continue
+            for entry in iter_files(os.path.join(thumb_dir, root)):
+                relative_path = os.path.relpath(entry.path, thumb_dir)
+                if os.path.exists(os.path.join(config.data_dir, relative_path)):
+                    continue
+                if thumbnail_key('/' + relative_path) in submitted:
+                    duplicate_report.write('/' + relative_path + '\n')
+                    duplicates += 1
+                else:
+                    report.write('/' + relative_path + '\n')
+                    orphans += 1
+    if duplicates:
+        print(f'{duplicates} thumbnails of duplicates were left behind, their hashed thumbnail was already there (see sdkdd_duplicate_thumbnails_{migration_id}.txt).')
+    if orphans:
+        print(f'{orphans} orphan thumbnails have no source file (see sdkdd_orphan_thumbnails_{migration_id}.txt).')
@@ -1,23 +1,80 @@
 from psycopg2.extras import RealDictCursor
 
+from . import instrument, results
+
 import traceback
 import functools
+import itertools
 import psycopg2
 import config
 import json
+import mimetypes
+import os
+import re
+import sys
 
 
 def trace_unhandled_exceptions(func):
+    """
+    Reports whatever `func` raises instead of raising it, and returns whether it got through without an error
+    (or what it returned, if it returned anything).
+    """
     @functools.wraps(func)
     def wrapped_func(*args, **kwargs):
         try:
-            func(*args, **kwargs)
+            result = func(*args, **kwargs)
+            return True if result is None else result
         except:
-            print('Exception in ' + func.__name__ + ' on file ' + args[0])
-            traceback.print_exc()
+            # errors given up on by `run_stage` know which stage they happened in
+            results.report(step=getattr(sys.exc_info()[1], 'sdkdd_stage', func.__name__), old_path=args[0], error=traceback.format_exc())
+            return False
     return wrapped_func
 
 
+def get_connection_parameters():
+    """`psycopg2.connect` arguments for the instance database."""
+    return {
+        'host': config.database_host,
+        'dbname': config.database_dbname,
+        'user': config.database_user,
+        'password': config.database_password,
+        'port': 5432
+    }
+
+
+def get_connection(**kwargs):
+    """Opens a new connection to the instance database. Extra arguments are passed on to `psycopg2.connect`."""
+    return psycopg2.connect(**get_connection_parameters(), **kwargs)
+
+
+def get_hashed_filename(file_hash: str, file_ext: str, mime: str):
+    """
+    Returns `(new_filename, file_ext)`: where a file with `file_hash` goes in the hash tree (like `/ab/cd/abcd....png`),
+    and the extension to record for it, which is guessed from `mime` instead of kept if `fix_extensions` is on.
+    """
+    if (config.fix_extensions):
+        file_ext = mimetypes.guess_extension(mime or 'application/octet-stream', strict=False)
+    new_ext = file_ext or '.bin'
+    if (config.fix_jpe):
+        new_ext = re.sub('^.jpe$', '.jpg', new_ext)
+    return (os.path.join('/', file_hash[0:2], file_hash[2:4], file_hash) + new_ext, file_ext)
+
+
+def create_migration_log(pg_connection: psycopg2.extensions.connection, migration_id):
+    """Creates the `sdkdd_migration_{migration_id}` table every migrated file gets logged to."""
+    with pg_connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+                CREATE TABLE IF NOT EXISTS sdkdd_migration_{migration_id} (
+                    "old_location" text NOT NULL,
+                    "new_location" text NOT NULL,
+                    "ctime" timestamp NOT NULL,
+                    "mtime" timestamp NOT NULL
+                );
+            """
+        )
+
+
 def remove_suffix(input_string, suffix):
     if suffix and input_string.endswith(suffix):
         return input_string[:-len(suffix)]
@@ -30,6 +87,128 @@ def remove_prefix(input_string, prefix):
     return input_string
 
 
+def iter_files(root: str):
+    """
+    Yields a `DirEntry` for every non-directory entry under `root`, walking it with `scandir`
+    so no extra `stat` is needed to tell files and directories apart.
+    """
+    directories = [root]
+    while directories:
+        with os.scandir(directories.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                else:
+                    yield entry
+
+
+# only what `replace_in_post`/`replace_in_discord_message` look at (and the keys), so scans don't drag whole rows along
+POST_COLUMNS = 'service, "user", id, content, file, attachments'
+DISCORD_MESSAGE_COLUMNS = 'server, channel, id, attachments'
+# whether a Discord message has one of three paths (legacy, legacy with the domain, hashed) as an attachment
+DISCORD_ATTACHMENT_MATCH = "EXISTS (SELECT 1 FROM unnest(attachments) a WHERE a ->> 'path' IN (%s, %s, %s))"
+# matches one `(partitions, index)` partition of a table, by a hash of the given column (see src/partitions.py)
+PARTITION_MATCH = '(hashtext({column}) & 2147483647) %% %s = %s'
+
+_scan_ids = itertools.count()
+
+
+def _scan_cursor(pg_connection, keyed: bool):
+    """
+    A plain cursor for lookups by key, or a named (server-side) one for range and full table scans,
+    which fetches `scan_itersize` rows at a time instead of buffering the whole result in the worker.
+    """
+    if keyed:
+        return pg_connection.cursor()
+    cursor = pg_connection.cursor(f'sdkdd_scan_{os.getpid()}_{next(_scan_ids)}')
+    cursor.itersize = getattr(config, 'scan_itersize', 2000)
+    return cursor
+
+
+def _select_posts(pg_connection, service=None, user_id=None, post_id=None, min_time=None, max_time=None, partition=None):
+    """
+    Returns a cursor over the posts matching the given keys (or all of them), to be used as a context manager.
+    Full scans can be narrowed down to one `(partitions, index)` partition of the table, by artist.
+    """
+    cursor = _scan_cursor(pg_connection, keyed=bool(user_id and post_id))
+    if service and user_id and post_id:
+        instrument.execute(cursor, f'SELECT {POST_COLUMNS} FROM posts WHERE service = %s AND "user" = %s AND id = %s', (service, user_id, post_id))
+    elif user_id and post_id:
+        instrument.execute(cursor, f'SELECT {POST_COLUMNS} FROM posts WHERE "user" = %s AND id = %s', (user_id, post_id))
+    elif min_time and max_time:
+        instrument.execute(cursor, f'SELECT {POST_COLUMNS} FROM posts WHERE added >= %s AND added < %s', (min_time, max_time))
+    elif partition:
+        instrument.execute(cursor, f'SELECT {POST_COLUMNS} FROM posts WHERE ' + PARTITION_MATCH.format(column='"user"'), partition)
+    else:
+        instrument.execute(cursor, f'SELECT {POST_COLUMNS} FROM posts')
+    return cursor
+
+
+def _select_discord_messages(pg_connection, server_id=None, channel_id=None, message_id=None, min_time=None, max_time=None, partition=None):
+    """Like `_select_posts`, for Discord messages (partitioned by channel)."""
+    cursor = _scan_cursor(pg_connection, keyed=bool(server_id and message_id))
+    if server_id and channel_id and message_id:
+        instrument.execute(cursor, f'SELECT {DISCORD_MESSAGE_COLUMNS} FROM discord_posts WHERE server = %s AND channel = %s AND id = %s', (server_id, channel_id, message_id))
+    elif server_id and message_id:
+        instrument.execute(cursor, f'SELECT {DISCORD_MESSAGE_COLUMNS} FROM discord_posts WHERE server = %s AND id = %s', (server_id, message_id))
+    elif min_time and max_time:
+        instrument.execute(cursor, f'SELECT {DISCORD_MESSAGE_COLUMNS} FROM discord_posts WHERE added >= %s AND added < %s', (min_time, max_time))
+    elif partition:
+        instrument.execute(cursor, f'SELECT {DISCORD_MESSAGE_COLUMNS} FROM discord_posts WHERE ' + PARTITION_MATCH.format(column='channel'), partition)
+    else:
+        instrument.execute(cursor, f'SELECT {DISCORD_MESSAGE_COLUMNS} FROM discord_posts')
+    return cursor
+
+
+def replace_in_post(post_data: dict, old_file: str, new_file: str):
+    """
+    Replaces all instances of `old_file` with `new_file` in a post's content, file and attachments, in place.
+    Returns whether the post references `new_file` afterwards.
+    """
+    post_data['content'] = post_data['content'].replace('https://kemono.party' + old_file, new_file)
+    post_data['content'] = post_data['content'].replace(old_file, new_file)
+    if post_data['file'].get('path'):
+        post_data['file']['path'] = post_data['file']['path'].replace('https://kemono.party' + old_file, new_file)
+        post_data['file']['path'] = post_data['file']['path'].replace(old_file, new_file)
+    for (i, _) in enumerate(post_data['attachments']):
+        if post_data['attachments'][i].get('path'):
+            post_data['attachments'][i]['path'] = post_data['attachments'][i]['path'].replace('https://kemono.party' + old_file, new_file)
+            post_data['attachments'][i]['path'] = post_data['attachments'][i]['path'].replace(old_file, new_file)
+    return new_file in json.dumps(post_data, default=str)
+
+
+def replace_in_discord_message(message_data: dict, old_file: str, new_file: str):
+    """Like `replace_in_post`, for a Discord message's attachments."""
+    for (i, _) in enumerate(message_data['attachments']):
+        if message_data['attachments'][i].get('path'):
+            message_data['attachments'][i]['path'] = message_data['attachments'][i]['path'].replace('https://kemono.party' + old_file, new_file)
+            message_data['attachments'][i]['path'] = message_data['attachments'][i]['path'].replace(old_file, new_file)
+    return new_file in json.dumps(message_data, default=str)
+
+
+def find_posts_with_file(pg_connection: psycopg2.extensions.connection, old_file: str, new_file: str, **keys):
+    """
+    Read-only counterpart of `replace_file_from_post`: returns the keys (`service`, `user_id`, `post_id`)
+    of every post that references `old_file` (or already `new_file`), narrowed down by `keys` the same way.
+    """
+    owners = []
+    with _select_posts(pg_connection, **keys) as cursor:
+        for post_data in cursor:
+            if replace_in_post(post_data, old_file, new_file):
+                owners.append({'service': post_data['service'], 'user_id': post_data['user'], 'post_id': post_data['id']})
+    return owners
+
+
+def find_discord_messages_with_file(pg_connection: psycopg2.extensions.connection, old_file: str, new_file: str, **keys):
+    """Read-only counterpart of `replace_file_from_discord_message`. See `find_posts_with_file`."""
+    owners = []
+    with _select_discord_messages(pg_connection, **keys) as cursor:
+        for message_data in cursor:
+            if replace_in_discord_message(message_data, old_file, new_file):
+                owners.append({'server_id': message_data['server'], 'channel_id': message_data['channel'], 'message_id': message_data['id']})
+    return owners
+
+
 def replace_file_from_post(
     pg_connection: psycopg2.extensions.connection,
     old_file: str,
@@ -47,38 +226,19 @@ def replace_file_from_post(
     Otherwise, a one query find/update is probably more ideal.
     """
     updated_rows = 0
-    with pg_connection.cursor() as cursor:
-        if service and user_id and post_id:
-            cursor.execute('SELECT * FROM posts WHERE service = %s AND "user" = %s AND id = %s', (service, user_id, post_id))
-        elif user_id and post_id:
-            cursor.execute('SELECT * FROM posts WHERE "user" = %s AND id = %s', (user_id, post_id))
-        elif min_time and max_time:
-            cursor.execute('SELECT * FROM posts WHERE added >= %s AND added < %s', (min_time, max_time))
-        else:
-            cursor.execute('SELECT * FROM posts')
+    with _select_posts(pg_connection, service, user_id, post_id, min_time, max_time) as cursor:
 
         first_post = None
         for post_data in cursor:
-            original_post_data = post_data
-
             # Replace.
-            post_data['content'] = post_data['content'].replace('https://kemono.party' + old_file, new_file)
-            post_data['content'] = post_data['content'].replace(old_file, new_file)
-            if post_data['file'].get('path'):
-                post_data['file']['path'] = post_data['file']['path'].replace('https://kemono.party' + old_file, new_file)
-                post_data['file']['path'] = post_data['file']['path'].replace(old_file, new_file)
-            for (i, _) in enumerate(post_data['attachments']):
-                if post_data['attachments'][i].get('path'):
-                    post_data['attachments'][i]['path'] = post_data['attachments'][i]['path'].replace('https://kemono.party' + old_file, new_file)
-                    post_data['attachments'][i]['path'] = post_data['attachments'][i]['path'].replace(old_file, new_file)
-            if (original_post_data != post_data or new_file in json.dumps(post_data, default=str)):
+            if replace_in_post(post_data, old_file, new_file):
                 updated_rows += 1
                 first_post = first_post or post_data
             else:
                 continue
+            keys = (post_data['service'], post_data['user'], post_data['id'])
 
             # Format.
-            post_data['embed'] = json.dumps(post_data['embed'])
             post_data['file'] = json.dumps(post_data['file'])
             for i in range(len(post_data['attachments'])):
                 post_data['attachments'][i] = json.dumps(post_data['attachments'][i])
@@ -91,12 +251,33 @@ def replace_file_from_post(
                 updates=','.join([f'"{column}" = {data[i]}' for (i, column) in enumerate(columns)]),
                 conditions='service = %s AND "user" = %s AND id = %s'
             )
-            with pg_connection.cursor() as cursor:
-                cursor.execute(query, list(post_data.values()) + list((service, user_id, post_id,)))
+            with pg_connection.cursor() as update_cursor:
+                update_cursor.execute(query, list(post_data.values()) + list(keys))
 
         return (updated_rows, first_post)
 
 
+def replace_file_in_discord_attachments(pg_connection: psycopg2.extensions.connection, old_file: str, new_file: str, server_id, channel_id, message_id):
+    """
+    Points the attachments of a Discord message that are `old_file` to `new_file`, inside the `attachments` array
+    in one `UPDATE`; nothing else in the row is touched. Returns the number of messages updated (0 or 1).
+    """
+    with pg_connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+                UPDATE discord_posts
+                SET attachments = array(
+                    SELECT CASE WHEN a ->> 'path' IN (%s, %s) THEN jsonb_set(a, '{{path}}', to_jsonb(%s::text)) ELSE a END
+                    FROM unnest(attachments) WITH ORDINALITY AS t(a, n)
+                    ORDER BY n
+                )
+                WHERE server = %s AND channel = %s AND id = %s AND {DISCORD_ATTACHMENT_MATCH}
+            """,
+            (old_file, 'https://kemono.party' + old_file, new_file, server_id, channel_id, message_id, old_file, 'https://kemono.party' + old_file, new_file)
+        )
+        return cursor.rowcount
+
+
 def replace_file_from_discord_message(
     pg_connection: psycopg2.extensions.connection,
     old_file: str,
@@ -114,51 +295,31 @@ def replace_file_from_discord_message(
     Otherwise, a one query find/update is probably more ideal.
     """
     updated_rows = 0
-    with pg_connection.cursor() as cursor:
-        if server_id and channel_id and message_id:
-            cursor.execute('SELECT * FROM discord_posts WHERE server = %s AND channel = %s AND id = %s', (server_id, channel_id, message_id))
-        elif server_id and message_id:
-            cursor.execute('SELECT * FROM discord_posts WHERE server = %s AND id = %s', (server_id, message_id))
-        elif min_time and max_time:
-            cursor.execute('SELECT * FROM discord_posts WHERE added >= %s AND added < %s', (min_time, max_time))
-        else:
-            cursor.execute('SELECT * FROM discord_posts')
+    with _select_discord_messages(pg_connection, server_id, channel_id, message_id, min_time, max_time) as cursor:
 
         first_message = None
         for post_data in cursor:
-            original_message_data = post_data
-
             # Replace.
-            for (i, _) in enumerate(post_data['attachments']):
-                if post_data['attachments'][i].get('path'):
-                    post_data['attachments'][i]['path'] = post_data['attachments'][i]['path'].replace('https://kemono.party' + old_file, new_file)
-                    post_data['attachments'][i]['path'] = post_data['attachments'][i]['path'].replace(old_file, new_file)
-            if (original_message_data != post_data or new_file in json.dumps(post_data, default=str)):
+            if replace_in_discord_message(post_data, old_file, new_file):
                 updated_rows += 1
                 first_message = first_message or post_data
             else:
                 continue
+            keys = (post_data['server'], post_data['channel'], post_data['id'])
 
             # Format.
-            post_data['author'] = json.dumps(post_data['author'])
             for i in range(len(post_data['attachments'])):
                 post_data['attachments'][i] = json.dumps(post_data['attachments'][i])
-            for i in range(len(post_data['mentions'])):
-                post_data['mentions'][i] = json.dumps(post_data['mentions'][i])
-            for i in range(len(post_data['embeds'])):
-                post_data['embeds'][i] = json.dumps(post_data['embeds'][i])
 
             # Update.
             columns = post_data.keys()
             data = ['%s'] * len(post_data.values())
             data[list(columns).index('attachments')] = '%s::jsonb[]'
-            data[list(columns).index('mentions')] = '%s::jsonb[]'
-            data[list(columns).index('embeds')] = '%s::jsonb[]'
             query = 'UPDATE discord_posts SET {updates} WHERE {conditions}'.format(
                 updates=','.join([f'"{column}" = {data[i]}' for (i, column) in enumerate(columns)]),
                 conditions='server = %s AND channel = %s AND id = %s'
             )
-            with pg_connection.cursor() as cursor:
-                cursor.execute(query, list(post_data.values()) + list((server_id, channel_id, message_id,)))
+            with pg_connection.cursor() as update_cursor:
+                update_cursor.execute(query, list(post_data.values()) + list(keys))
 
         return (updated_rows, first_message)
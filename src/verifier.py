@@ -0,0 +1,131 @@
+import mimetypes
+import multiprocessing
+import os
+import time
+import traceback
+
+import config
+
+from . import throttle
+from .hashing import InodeCache, hash_file_cached
+from .mover import HASHED_NAME, iter_shards
+from .sniff import sniff_mime
+from .throttle import Controller, create_limiter
+from .utils import remove_suffix
+from .worker import init_worker
+
+_cache = None
+_refresh = False
+_rate = None
+
+
+class RateLimit:
+    """Keeps the bytes read by one process under `bytes_per_second`, on average since it started."""
+
+    def __init__(self, bytes_per_second: float):
+        self.bytes_per_second = bytes_per_second
+        self.started = time.monotonic()
+        self.bytes = 0
+
+    def consume(self, size: int):
+        self.bytes += size
+        ahead = self.bytes / self.bytes_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def init_verifier(limiter=None, refresh=False, processes=1):
+    global _cache, _refresh, _rate
+    init_worker(limiter)
+    _cache = InodeCache(getattr(config, 'hash_cache', 'sdkdd_hash_cache.db'))
+    _refresh = refresh
+    mb_per_second = getattr(config, 'verify_mb_per_second', 100)
+    _rate = RateLimit(mb_per_second * 1024 * 1024 / processes) if mb_per_second else None
+
+
+def extension_matches(file_ext: str, mime: str):
+    """Whether `file_ext` is one of the extensions of the sniffed `mime` (types `mimetypes` doesn't know always match)."""
+    expected = mimetypes.guess_all_extensions(mime or 'application/octet-stream', strict=False)
+    if not expected or mime == 'application/octet-stream':
+        return True
+    return file_ext.lower() in expected or (file_ext.lower() == '.jpg' and '.jpe' in expected)
+
+
+def verify_shard(shard: str):
+    """
+    Re-hashes every file in one `ab/cd` shard and sniffs its type.
+    Returns `(shard, files, size, hash_mismatches, extension_mismatches)`, with mismatches as `(name, actual hash)`
+    and `(name, mime, expected extension)`.
+    """
+    (files, size, hash_mismatches, extension_mismatches) = (0, 0, [], [])
+    try:
+        entries = list(os.scandir(shard))
+    except FileNotFoundError:
+        return (shard, files, size, hash_mismatches, extension_mismatches)
+    for entry in entries:
+        match = HASHED_NAME.match(entry.name)
+        if not match or not entry.is_file(follow_symlinks=False):
+            continue
+        try:
+            stat = entry.stat(follow_symlinks=False)
+            with throttle.acquire('io', stat.st_dev):
+                (file_hash, cached) = hash_file_cached(entry.path, _cache, stat, refresh=_refresh)
+            if not cached and _rate:
+                _rate.consume(stat.st_size)
+            with throttle.acquire('cpu'):
+                mime = sniff_mime(entry.path)
+        except FileNotFoundError:
+            continue
+        except:
+            print(f'Exception in verify on file {entry.path}')
+            traceback.print_exc()
+            continue
+        files += 1
+        size += stat.st_size
+        if file_hash != match.group(1):
+            hash_mismatches.append((entry.name, file_hash))
+        if not extension_matches(match.group(2) or '', mime):
+            extension_mismatches.append((entry.name, mime, mimetypes.guess_extension(mime, strict=False)))
+    _cache.commit()
+    return (shard, files, size, hash_mismatches, extension_mismatches)
+
+
+def verify(output_file: str, extensions_file: str, refresh=False):
+    """
+    Verifies every file in the hash tree under `data_dir` against its name, from all processes at once.
+    Files whose content doesn't match their hash are written to `output_file` as `<old hash>,<correct hash>,<path>`
+    lines (what `hashfixer.py` reads from `shinofix.txt`), and files whose extension doesn't match their type
+    to `extensions_file` as `<path>,<mime>,<expected extension>`.
+    Unchanged files hashed before are skipped using the hash cache, unless `refresh`.
+    """
+    root = remove_suffix(config.data_dir, '/')
+    processes = config.processes or multiprocessing.cpu_count()
+    limiter = create_limiter(processes)
+    if limiter:
+        controller = Controller(limiter)
+        controller.start()
+
+    (files, size, hash_mismatched, extension_mismatched) = (0, 0, 0, 0)
+    started = time.monotonic()
+    last_summary = started
+    with open(output_file, 'w') as output, open(extensions_file, 'w') as extensions, \
+            multiprocessing.Pool(processes, initializer=init_verifier, initargs=(limiter, refresh, processes)) as pool:
+        for (shard, shard_files, shard_size, hash_mismatches, extension_mismatches) in pool.imap_unordered(verify_shard, iter_shards(root), chunksize=4):
+            relative_shard = os.path.relpath(shard, root)
+            for (name, file_hash) in hash_mismatches:
+                output.write(f'{name.split(".")[0]},{file_hash},{relative_shard}/{name}\n')
+            for (name, mime, expected) in extension_mismatches:
+                extensions.write(f'{relative_shard}/{name},{mime},{expected}\n')
+            output.flush()
+            extensions.flush()
+            files += shard_files
+            size += shard_size
+            hash_mismatched += len(hash_mismatches)
+            extension_mismatched += len(extension_mismatches)
+            if time.monotonic() - last_summary >= getattr(config, 'results_summary_interval', 10):
+                elapsed = time.monotonic() - started
+                print(f'({files} files verified, {hash_mismatched} hash and {extension_mismatched} extension mismatches; {files / elapsed:.1f} files/s, {size / elapsed / 1024 / 1024:.1f} MiB/s)')
+                last_summary = time.monotonic()
+    if limiter:
+        controller.stop()
+    print(f'{files} files verified: {hash_mismatched} don\'t match their hash, {extension_mismatched} don\'t match their type.')
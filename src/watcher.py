@@ -0,0 +1,275 @@
+import ctypes
+import errno
+import functools
+import multiprocessing
+import os
+import queue
+import select
+import signal
+import struct
+import threading
+import time
+
+import config
+
+from .migrators.common import DEFERRED
+from .scanner import MIGRATORS, iter_legacy_work, kind_of
+from .utils import remove_suffix
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Just enough of inotify(7), through libc, to watch the legacy trees for finished files."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        self._out_of_watches = False
+
+    def add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC and not self._out_of_watches:
+                self._out_of_watches = True
+                print(f'Ran out of inotify watches at {path}; raise fs.inotify.max_user_watches. Unwatched directories are only picked up by reconciliation.')
+            elif error not in (errno.ENOSPC, errno.ENOENT, errno.ENOTDIR):
+                print(f'Could not watch {path}: {os.strerror(error)}')
+            return None
+        self.directories[wd] = path
+        return wd
+
+    def add_tree(self, root: str):
+        """Watches `root` and every directory under it. Returns the files already in directories that were just created."""
+        files = []
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            if self.add_watch(directory) is None:
+                continue
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        else:
+                            files.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        return files
+
+    def read_events(self, timeout: float):
+        """Yields `(directory, mask, name)` for the events that arrive within `timeout` seconds."""
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        data = os.read(self.fd, 1024 * 1024)
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            directory = self.directories.get(wd)
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+            yield (directory, mask, name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def migrate_watched(kind: str, path: str, migration_id):
+    """
+    Migrates one file, unless nothing references it yet: instances that haven't upgraded write the file before its
+    post or message, which would then point at a file already moved away. Returns whether it was left for later.
+    """
+    return MIGRATORS[kind](path, migration_id, _defer_unowned=True) == DEFERRED
+
+
+def _reconcile(found):
+    """
+    Walks the legacy trees at idle priority, for files whose events were missed (or came before the watch did).
+    Puts `(kind, path)` on `found` for every file, then `None`.
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError):
+        os.nice(19)
+    try:
+        for (kind, path, _) in iter_legacy_work():
+            found.put((kind, path))
+    finally:
+        found.put(None)
+
+
+class Watcher:
+    """
+    Feeds files written to the legacy `files`, `attachments`, and `inline` trees to the migrators as they are finished,
+    `watch_debounce_seconds` after the last time they were closed (or moved in). Every `watch_reconcile_interval` seconds,
+    a low priority walk of the trees picks up whatever the events missed, `watch_reconcile_batch` files per loop.
+    """
+
+    def __init__(self, pool, migration_id):
+        self.pool = pool
+        self.migration_id = migration_id
+        self.data_dir = remove_suffix(config.data_dir, '/')
+        self.debounce = getattr(config, 'watch_debounce_seconds', 5)
+        self.reconcile_interval = getattr(config, 'watch_reconcile_interval', 3600)
+        self.reconcile_batch = max(1, getattr(config, 'watch_reconcile_batch', 1000))
+        self.inotify = Inotify()
+        self.pending = {}
+        # path -> ((size, mtime), last time it was handed over or seen unchanged by reconciliation)
+        self.submitted = {}
+        self.stopping = threading.Event()
+        self._found = multiprocessing.Queue()
+        # files left for the next reconciliation, from the pool's result thread
+        self._deferred = queue.SimpleQueue()
+        self._reconciler = None
+        self._last_reconcile = None
+        self._reconcile_started = None
+
+    def _file_changed(self, path: str):
+        """Queues a file to be migrated once it has been left alone for `debounce` seconds."""
+        if config.ignore_temp_files and path.endswith('.temp'):
+            return
+        self.pending[path] = time.monotonic() + self.debounce
+
+    def _submit(self, path: str, kind=None, settled_only=False):
+        """Hands a file over to the pool. With `settled_only`, files modified within `debounce` seconds are debounced instead."""
+        try:
+            stat = os.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            return
+        if settled_only and time.time() - stat.st_mtime < self.debounce:
+            # could still be being written
+            self._file_changed(path)
+            return
+        # don't hand the same file over again unless it changed (leftovers stay in the legacy trees)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        previous = self.submitted.get(path)
+        self.submitted[path] = (signature, time.monotonic())
+        if previous and previous[0] == signature:
+            return
+        kind = kind or kind_of(path.replace(self.data_dir, ''))
+        if kind:
+            self.pool.apply_async(migrate_watched, args=(kind, path, self.migration_id), callback=functools.partial(self._migrated, path))
+
+    def _migrated(self, path: str, deferred: bool):
+        if deferred:
+            self._deferred.put(path)
+
+    def _requeue_deferred(self):
+        """Forgets handing over the files nothing referenced yet, so the next reconciliation hands them over again."""
+        while True:
+            try:
+                path = self._deferred.get_nowait()
+            except queue.Empty:
+                return
+            self.submitted.pop(path, None)
+
+    def _handle(self, directory, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            print('inotify queue overflowed, reconciling.')
+            self._last_reconcile = None
+            return
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # anything written before the new directory was watched is picked up here
+                for file_path in self.inotify.add_tree(path):
+                    self._file_changed(file_path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._file_changed(path)
+
+    def _start_reconcile(self):
+        if self._reconcile_started is not None:
+            # the last walk is still going, or what it found hasn't all been handled yet
+            return
+        self._reconciler = multiprocessing.Process(target=_reconcile, args=(self._found,), name='sdkdd-reconcile', daemon=True)
+        self._reconciler.start()
+        self._last_reconcile = self._reconcile_started = time.monotonic()
+
+    def _prune_submitted(self, since: float):
+        """Forgets the files not handed over or seen since `since` (migrated ones are gone from the legacy trees)."""
+        for (path, (_, seen)) in list(self.submitted.items()):
+            if seen < since:
+                del self.submitted[path]
+
+    def _drain_reconciled(self):
+        """Handles up to `reconcile_batch` of the files reconciliation found. Returns whether there may be more waiting."""
+        for _ in range(self.reconcile_batch):
+            try:
+                found = self._found.get_nowait()
+            except queue.Empty:
+                return False
+            if found is None:
+                # the walk saw every file still there, so whatever it didn't see since it started is gone
+                self._prune_submitted(self._reconcile_started)
+                self._reconcile_started = None
+            elif found[1] not in self.pending:
+                self._submit(found[1], found[0], settled_only=True)
+        return True
+
+    def run(self):
+        for kind in MIGRATORS:
+            root = os.path.join(self.data_dir, kind)
+            if getattr(config, f'scan_{kind}') and os.path.isdir(root):
+                self.inotify.add_tree(root)
+        print(f'Watching {len(self.inotify.directories)} directories.')
+        # catch up on everything written before the watches were in place
+        self._start_reconcile()
+
+        backlog = False
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            # (don't wait on events while reconciliation has files waiting)
+            timeout = 0 if backlog else min([deadline - now for deadline in self.pending.values()] + [1])
+            for (directory, mask, name) in self.inotify.read_events(max(timeout, 0)):
+                self._handle(directory, mask, name)
+
+            now = time.monotonic()
+            for (path, deadline) in list(self.pending.items()):
+                if deadline <= now:
+                    del self.pending[path]
+                    self._submit(path)
+
+            self._requeue_deferred()
+            backlog = self._drain_reconciled()
+            if self._last_reconcile is None or now - self._last_reconcile >= self.reconcile_interval:
+                self._start_reconcile()
+
+        if self._reconciler and self._reconciler.is_alive():
+            self._reconciler.terminate()
+        self.inotify.close()
+
+    def stop(self, *_):
+        self.stopping.set()
+
+
+def watch(pool, migration_id):
+    """Runs a `Watcher` until SIGINT/SIGTERM."""
+    watcher = Watcher(pool, migration_id)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
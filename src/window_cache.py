@@ -0,0 +1,136 @@
+import collections
+import datetime
+import os
+import queue
+import re
+import threading
+
+import config
+import psycopg2.extensions
+
+from .utils import get_connection
+
+BUCKET = datetime.timedelta(hours=1)
+# paths referenced from post content; a path this misses only means falling back to the next strategy
+CONTENT_REFERENCES = re.compile(r'''(?:src|href)\s*=\s*["']([^"']+)["']''')
+
+_cache = None
+_pid = None
+
+
+class WindowCache:
+    """
+    LRU cache of the posts `added` in each hour, with just their keys and the paths they reference,
+    for the "added within an hour of the file's mtime" strategies: files imported together share almost the same mtime,
+    so one bucket query answers thousands of lookups. The next bucket is prefetched in the background whenever one is used.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._prefetching = {}
+        self._prefetch_queue = queue.Queue()
+        self._prefetch_thread = None
+
+    def _fetch(self, pg_connection, start: datetime.datetime):
+        """Returns `(added, owner, file_path, references)` for every post added in the bucket starting at `start`."""
+        rows = []
+        with pg_connection.cursor(f'sdkdd_window_{os.getpid()}_{threading.get_ident()}', cursor_factory=psycopg2.extensions.cursor) as cursor:
+            cursor.itersize = getattr(config, 'scan_itersize', 2000)
+            cursor.execute('''
+                SELECT service, "user", id, added, file ->> 'path', array(SELECT a ->> 'path' FROM unnest(attachments) a), content
+                FROM posts
+                WHERE added >= %s AND added < %s
+            ''', (start, start + BUCKET))
+            for (service, user_id, post_id, added, file_path, attachment_paths, content) in cursor:
+                references = [path for path in [file_path, *(attachment_paths or [])] if path]
+                references.extend(CONTENT_REFERENCES.findall(content or ''))
+                rows.append((added, {'service': service, 'user_id': user_id, 'post_id': post_id}, file_path, references))
+        return rows
+
+    def _store(self, start: datetime.datetime, rows: list):
+        with self._lock:
+            self.buckets[start] = rows
+            self.buckets.move_to_end(start)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+
+    def get(self, pg_connection, start: datetime.datetime):
+        with self._lock:
+            prefetching = self._prefetching.get(start)
+        if prefetching:
+            prefetching.wait(60)
+        with self._lock:
+            rows = self.buckets.get(start)
+            if rows is not None:
+                self.buckets.move_to_end(start)
+        if rows is None:
+            rows = self._fetch(pg_connection, start)
+            self._store(start, rows)
+        # work mostly moves forward in time
+        self.prefetch(start + BUCKET)
+        return rows
+
+    def prefetch(self, start: datetime.datetime):
+        with self._lock:
+            if start in self.buckets or start in self._prefetching:
+                return
+            self._prefetching[start] = threading.Event()
+            if not self._prefetch_thread:
+                self._prefetch_thread = threading.Thread(target=self._prefetch_loop, name='sdkdd-window-prefetch', daemon=True)
+                self._prefetch_thread.start()
+        self._prefetch_queue.put(start)
+
+    def _prefetch_loop(self):
+        conn = None
+        while True:
+            start = self._prefetch_queue.get()
+            try:
+                conn = conn or get_connection()
+                rows = self._fetch(conn, start)
+                conn.rollback()
+                self._store(start, rows)
+            except Exception:
+                # just a prefetch, the bucket gets fetched again when it's needed
+                if conn:
+                    conn.close()
+                conn = None
+            finally:
+                with self._lock:
+                    self._prefetching.pop(start).set()
+
+    def rows(self, pg_connection, min_time: datetime.datetime, max_time: datetime.datetime):
+        """Cached rows of the posts added in `[min_time, max_time)`."""
+        rows = []
+        start = min_time.replace(minute=0, second=0, microsecond=0)
+        while start < max_time:
+            rows.extend(row for row in self.get(pg_connection, start) if min_time <= row[0] < max_time)
+            start += BUCKET
+        return rows
+
+
+def get_window_cache():
+    """This process' window cache, or `None` if `window_cache_buckets` is 0."""
+    global _cache, _pid
+    size = getattr(config, 'window_cache_buckets', 24)
+    if not size:
+        return None
+    if _pid != os.getpid():
+        _cache = WindowCache(size)
+        _pid = os.getpid()
+    return _cache
+
+
+def find_file_owners_in_window(storage, web_path: str, new_filename: str, min_time=None, max_time=None):
+    """`find_file_owners` for a time window, answered from the window cache."""
+    paths = (web_path, 'https://kemono.party' + web_path, new_filename)
+    return [dict(owner) for (_, owner, file_path, _) in get_window_cache().rows(storage.conn, min_time, max_time) if file_path in paths]
+
+
+def find_posts_in_window(storage, web_path: str, new_filename: str, min_time=None, max_time=None):
+    """`find_posts_with_file` for a time window, answered from the window cache."""
+    return [
+        dict(owner) for (_, owner, _, references) in get_window_cache().rows(storage.conn, min_time, max_time)
+        if any(web_path in reference or new_filename in reference for reference in references)
+    ]
@@ -0,0 +1,232 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+
+import config
+from psycopg2.extras import Json, RealDictCursor, execute_values
+
+from .mover import flush_movers
+from .results import ResultLog
+from .scanner import MIGRATORS, iter_work
+from .throttle import Controller, create_limiter
+from .utils import create_migration_log, get_connection, remove_prefix, remove_suffix
+from .worker import get_context, init_worker
+
+ENQUEUE_BATCH_SIZE = 1000
+
+
+def create_work_queue(pg_connection, migration_id):
+    with pg_connection.cursor() as cursor:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS sdkdd_work_{migration_id} (
+                "id" bigserial PRIMARY KEY,
+                "kind" text NOT NULL,
+                "path" text NOT NULL,
+                "owner" jsonb NOT NULL DEFAULT '{{}}',
+                "status" text NOT NULL DEFAULT 'pending',
+                "lease_owner" text,
+                "lease_expires" timestamptz,
+                "attempts" integer NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS sdkdd_work_{migration_id}_claim_idx
+                ON sdkdd_work_{migration_id} (id) WHERE status IN ('pending', 'leased');
+        ''')
+
+
+def enqueue(migration_id):
+    """
+    Fills `sdkdd_work_{migration_id}` with everything to migrate, from the scanner or `sql_file`.
+    Paths are stored as web paths, so hosts that mount `data_dir` somewhere else can work on them too.
+    """
+    conn = get_connection()
+    create_migration_log(conn, migration_id)
+    create_work_queue(conn, migration_id)
+    conn.commit()
+
+    data_dir = remove_suffix(config.data_dir, '/')
+    queued = 0
+    batch = []
+    with conn.cursor() as cursor:
+        for (kind, path, owner) in iter_work():
+            batch.append((kind, remove_prefix(path, data_dir), Json(owner)))
+            if len(batch) >= ENQUEUE_BATCH_SIZE:
+                execute_values(cursor, f'INSERT INTO sdkdd_work_{migration_id} (kind, path, owner) VALUES %s', batch)
+                conn.commit()
+                queued += len(batch)
+                batch = []
+        if batch:
+            execute_values(cursor, f'INSERT INTO sdkdd_work_{migration_id} (kind, path, owner) VALUES %s', batch)
+            conn.commit()
+            queued += len(batch)
+    conn.close()
+    return queued
+
+
+def claim(pg_connection, migration_id, lease_owner: str, batch_size: int, lease_seconds: int, max_attempts: int):
+    """
+    Leases up to `batch_size` pending items (or items whose lease expired) to `lease_owner`.
+    `SKIP LOCKED` lets every worker on every host claim concurrently without handing out the same item twice.
+    """
+    with pg_connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(f'''
+            UPDATE sdkdd_work_{migration_id} work
+            SET
+                status = 'leased',
+                lease_owner = %(lease_owner)s,
+                lease_expires = now() + %(lease_seconds)s * interval '1 second',
+                attempts = work.attempts + 1
+            WHERE work.id IN (
+                SELECT id
+                FROM sdkdd_work_{migration_id}
+                WHERE
+                    (status = 'pending' OR (status = 'leased' AND lease_expires < now()))
+                    AND attempts < %(max_attempts)s
+                ORDER BY id
+                LIMIT %(batch_size)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING work.id, work.kind, work.path, work.owner, work.attempts
+        ''', {
+            'lease_owner': lease_owner,
+            'lease_seconds': lease_seconds,
+            'max_attempts': max_attempts,
+            'batch_size': batch_size
+        })
+        items = cursor.fetchall()
+    pg_connection.commit()
+    return items
+
+
+def finish(pg_connection, migration_id, lease_owner: str, ids: list, status: str = 'done'):
+    """Marks leased items as `status` (or puts them back with `pending`), as long as `lease_owner` still holds them."""
+    with pg_connection.cursor() as cursor:
+        cursor.execute(f'''
+            UPDATE sdkdd_work_{migration_id}
+            SET status = %s, lease_owner = NULL, lease_expires = NULL
+            WHERE id = ANY(%s) AND lease_owner = %s
+        ''', (status, ids, lease_owner))
+    pg_connection.commit()
+
+
+def remaining(pg_connection, migration_id, max_attempts: int):
+    """Returns how many items are still pending or leased (and could still be retried)."""
+    with pg_connection.cursor() as cursor:
+        cursor.execute(f'''
+            SELECT count(*)
+            FROM sdkdd_work_{migration_id}
+            WHERE status IN ('pending', 'leased') AND attempts < %s
+        ''', (max_attempts,))
+        (count,) = cursor.fetchone()
+    pg_connection.commit()
+    return count
+
+
+def expire(pg_connection, migration_id, max_attempts: int):
+    """
+    Marks items `failed` whose last attempt's lease expired (their worker died on them), since they'd never be claimed again.
+    Returns the web paths of every failed item.
+    """
+    with pg_connection.cursor() as cursor:
+        cursor.execute(f'''
+            UPDATE sdkdd_work_{migration_id}
+            SET status = 'failed', lease_owner = NULL, lease_expires = NULL
+            WHERE status = 'leased' AND attempts >= %s AND lease_expires < now()
+        ''', (max_attempts,))
+        cursor.execute(f"SELECT path FROM sdkdd_work_{migration_id} WHERE status = 'failed' ORDER BY id")
+        paths = [path for (path,) in cursor.fetchall()]
+    pg_connection.commit()
+    return paths
+
+
+def _heartbeat(migration_id, lease_owner: str, lease_seconds: int, stop: threading.Event):
+    conn = get_connection()
+    while not stop.wait(lease_seconds / 3):
+        with conn.cursor() as cursor:
+            cursor.execute(f'''
+                UPDATE sdkdd_work_{migration_id}
+                SET lease_expires = now() + %s * interval '1 second'
+                WHERE lease_owner = %s AND status = 'leased'
+            ''', (lease_seconds, lease_owner))
+        conn.commit()
+    conn.close()
+
+
+def work(migration_id, limiter=None, result_queue=None):
+    """
+    Claims and migrates batches from `sdkdd_work_{migration_id}` until nothing is left to claim.
+    Leases are extended by a heartbeat thread while the batch is being migrated; if this process dies,
+    they expire and another worker (on any host) picks the batch up again.
+    """
+    init_worker(limiter, result_queue)
+    batch_size = getattr(config, 'work_batch_size', 50)
+    lease_seconds = getattr(config, 'work_lease_seconds', 300)
+    max_attempts = getattr(config, 'work_max_attempts', 5)
+    lease_owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(migration_id, lease_owner, lease_seconds, stop), daemon=True)
+    heartbeat.start()
+
+    conn = get_connection()
+    try:
+        while True:
+            items = claim(conn, migration_id, lease_owner, batch_size, lease_seconds, max_attempts)
+            if not items:
+                # other hosts may still hold leases that could expire, wait for them before giving up
+                if remaining(conn, migration_id, max_attempts) == 0:
+                    break
+                time.sleep(min(lease_seconds / 3, 30))
+                continue
+
+            statuses = {'done': [], 'pending': [], 'failed': []}
+            for item in items:
+                path = os.path.join(config.data_dir, remove_prefix(item['path'], '/'))
+                if MIGRATORS[item['kind']](path, migration_id, **item['owner']):
+                    statuses['done'].append(item['id'])
+                else:
+                    # (the error is in the results log) retried, by any host, until `work_max_attempts`
+                    statuses['pending' if item['attempts'] < max_attempts else 'failed'].append(item['id'])
+            # don't call it done before the files are actually in the hash tree
+            flush_movers()
+            for (status, ids) in statuses.items():
+                if ids:
+                    finish(conn, migration_id, lease_owner, ids, status)
+    finally:
+        stop.set()
+        conn.close()
+
+
+def work_in_parallel(migration_id, processes: int = None):
+    processes = processes or config.processes or multiprocessing.cpu_count()
+    context = get_context()
+    limiter = create_limiter(processes, context)
+    if limiter:
+        controller = Controller(limiter)
+        controller.start()
+    result_log = ResultLog(f'{migration_id}_{socket.gethostname()}', context)
+    result_log.start()
+    workers = [context.Process(target=work, args=(migration_id, limiter, result_log.queue)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if limiter:
+        controller.stop()
+    result_log.stop()
+    report_failed(migration_id)
+
+
+def report_failed(migration_id):
+    """Prints how many items failed for good (see `expire`), and writes their paths to sdkdd_failed_<migration_id>.txt."""
+    max_attempts = getattr(config, 'work_max_attempts', 5)
+    conn = get_connection()
+    failed = expire(conn, migration_id, max_attempts)
+    conn.close()
+    if not failed:
+        return
+    with open(f'sdkdd_failed_{migration_id}.txt', 'w') as report:
+        report.writelines(path + '\n' for path in failed)
+    print(f'{len(failed)} files failed {max_attempts} times and were given up on (see sdkdd_failed_{migration_id}.txt).')
@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+import time
+
+import config
+
+from . import known_hashes, profiler, results, sniff, throttle
+
+# imported once by the fork server, so workers start with them already loaded instead of importing them each
+PRELOAD = ['__main__', 'config', 'psycopg2', 'psycopg2.extras', 'magic', 'src.scheduler', 'src.manifest', 'src.known_hashes', 'src.watcher', 'src.worker']
+
+
+def get_context():
+    """
+    The multiprocessing context migration processes are started from, by `start_method` (`forkserver` by default):
+    workers are forked from a small server process with `PRELOAD` imported, rather than from the parent,
+    which by then holds the scan state (and whose pages a fork would copy as they're written to).
+    """
+    start_method = getattr(config, 'start_method', 'forkserver')
+    context = multiprocessing.get_context(start_method)
+    if start_method == 'forkserver':
+        context.set_forkserver_preload(PRELOAD)
+    return context
+
+
+def get_process_start_time():
+    """When this process was started (as a `time.time()`), from /proc. Falls back to now."""
+    try:
+        with open('/proc/self/stat') as f:
+            # (the process name can have spaces in it, the fields after it can't)
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime '))
+        return boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+def init_worker(limiter=None, result_queue=None, profile_dir=None, known_hashes_file=None, measure_startup=True):
+    """
+    Pool initializer, runs in every migration process before it takes on any work.
+    Without `measure_startup` (when it runs in a process that was started long before, like the asyncio engine's),
+    the process' startup isn't reported.
+    """
+    if profile_dir:
+        profiler.start(profile_dir)
+    if limiter:
+        throttle.install(limiter)
+    if known_hashes_file:
+        known_hashes.install(known_hashes_file)
+    sniff.warm_up()
+    if result_queue:
+        results.install(result_queue, started=get_process_start_time() if measure_startup else None)